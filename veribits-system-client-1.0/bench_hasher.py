@@ -0,0 +1,492 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for file_hasher
+Creates synthetic file trees and measures FileHasher throughput
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import threading
+import hashlib
+import contextlib
+import tracemalloc
+from typing import Dict, List
+
+from file_hasher import (FileHasher, HASH_ALGORITHMS, HashSet, ResultStore, build_hash_set, digest_size, make_result,
+                         read_paths)
+
+
+@contextlib.contextmanager
+def quiet_stderr():
+    """Silence FileHasher progress output while timing"""
+    saved = sys.stderr
+    sys.stderr = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stderr.close()
+        sys.stderr = saved
+
+
+def make_small_file_tree(root: str, num_files: int, file_size: int, files_per_dir: int = 500) -> str:
+    """
+    Create a tree of small files
+
+    Args:
+        root: Directory to create the tree in
+        num_files: Number of files to create
+        file_size: Size of each file in bytes
+        files_per_dir: Files per directory
+
+    Returns:
+        Path of the tree
+    """
+    tree = os.path.join(root, f'small_{num_files}_{file_size}')
+    payload = os.urandom(file_size)
+    for i in range(num_files):
+        dirpath = os.path.join(tree, f'd{i // files_per_dir:05d}')
+        if i % files_per_dir == 0:
+            os.makedirs(dirpath, exist_ok=True)
+        with open(os.path.join(dirpath, f'f{i:08d}'), 'wb') as f:
+            f.write(payload)
+    return tree
+
+
+def run_scan(tree: str, **kwargs) -> Dict:
+    """
+    Hash a tree and time it (without the network lookups done by scan())
+
+    Returns:
+        Dict with files, seconds and files_per_sec
+    """
+    hasher = FileHasher(root_paths=[tree], **kwargs)
+    with quiet_stderr():
+        start = time.perf_counter()
+        hasher._run_pipeline()
+        elapsed = time.perf_counter() - start
+    return {
+        'files': hasher.file_count,
+        'seconds': elapsed,
+        'files_per_sec': hasher.file_count / elapsed if elapsed else 0.0
+    }
+
+
+def bench_scaling(args):
+    """files/s on a small-file tree for the thread and process backends"""
+    tree = make_small_file_tree(args.workdir, args.files, args.file_size)
+    max_procs = args.max_processes or os.cpu_count() or 1
+    counts = []
+    n = 1
+    while n < max_procs:
+        counts.append(n)
+        n *= 2
+    counts.append(max_procs)
+
+    print(f"{args.files} files of {args.file_size} bytes, {args.threads} threads, cpu_count={os.cpu_count()}")
+    print(f"{'backend':<12} {'procs':>5} {'files/s':>12} {'seconds':>9}")
+    stats = run_scan(tree, num_threads=args.threads)
+    print(f"{'threads':<12} {'-':>5} {stats['files_per_sec']:>12.0f} {stats['seconds']:>9.2f}")
+    for procs in counts:
+        stats = run_scan(tree, num_threads=max(args.threads, procs), worker_mode='processes',
+                         num_processes=procs, batch_size=args.batch_size)
+        print(f"{'processes':<12} {procs:>5} {stats['files_per_sec']:>12.0f} {stats['seconds']:>9.2f}")
+
+
+def bench_files_from(args):
+    """files/s hashing a NUL-delimited path list (--files-from) against a directory scan of the same tree"""
+    tree = make_small_file_tree(args.workdir, args.files, args.file_size)
+    list_path = os.path.join(args.workdir, 'files.list')
+    with open(list_path, 'wb') as f:
+        for dirpath, _, names in os.walk(tree):
+            for name in names:
+                f.write(os.fsencode(os.path.join(dirpath, name)) + b'\0')
+
+    print(f"{args.files} files of {args.file_size} bytes, {args.threads} threads")
+    print(f"{'source':<12} {'backend':<10} {'files/s':>12} {'seconds':>9}")
+    run_scan(tree, num_threads=args.threads)  # warm the page cache
+    for backend in ('threads', 'processes'):
+        stats = run_scan(tree, num_threads=args.threads, worker_mode=backend)
+        print(f"{'walk':<12} {backend:<10} {stats['files_per_sec']:>12.0f} {stats['seconds']:>9.2f}")
+        with open(list_path, 'rb') as f:
+            stats = run_scan(tree, num_threads=args.threads, worker_mode=backend, files=read_paths(f))
+        print(f"{'files-from':<12} {backend:<10} {stats['files_per_sec']:>12.0f} {stats['seconds']:>9.2f}")
+
+
+def account_rate(threads: int, per_thread: int) -> float:
+    """Calls per second of FileHasher._account (counters and result building) from many threads"""
+    hasher = FileHasher(root_paths=[], num_threads=threads, hash_algorithms=['sha256'])
+    digests = {'sha256': '0' * 64}
+    barrier = threading.Barrier(threads + 1)
+
+    def worker():
+        barrier.wait()
+        for i in range(per_thread):
+            hasher._account('/bench/file', None, digests, False)
+            hasher.metrics.observe('hash', 0.0001)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return threads * per_thread / elapsed if elapsed else 0.0
+
+
+def bench_contention(args):
+    """files/s on a small-file tree and raw accounting calls/s from 1 to 64 threads"""
+    tree = make_small_file_tree(args.workdir, args.files, args.file_size)
+    print(f"{args.files} files of {args.file_size} bytes, cpu_count={os.cpu_count()}")
+    print(f"{'threads':>7} {'files/s':>10} {'account/s':>11}")
+    for threads in args.threads:
+        stats = run_scan(tree, num_threads=threads, dedup_hardlinks=False)
+        rate = account_rate(threads, max(1, args.accounts // threads))
+        print(f"{threads:>7} {stats['files_per_sec']:>10.0f} {rate:>11.0f}")
+
+
+def parse_size(text: str) -> int:
+    """Parse a size such as 4096, 64K, 10M or 2G"""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    text = text.strip().upper().rstrip('IB')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def format_size(size: int) -> str:
+    """Format a byte count as 1K, 64M, ..."""
+    for unit, scale in (('G', 1024 ** 3), ('M', 1024 ** 2), ('K', 1024)):
+        if size >= scale and size % scale == 0:
+            return f'{size // scale}{unit}'
+    return str(size)
+
+
+def make_file(path: str, size: int, block: int = 8 * 1024 * 1024):
+    """Create a file of random data"""
+    payload = os.urandom(min(size, block))
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            f.write(payload[:remaining])
+            remaining -= len(payload)
+
+
+def read_path_legacy(file_path: str, chunk_size: int) -> str:
+    """The original _hash_file loop: one new bytes object per chunk"""
+    hasher = hashlib.sha512()
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def measure(func, size: int, repeat: int) -> Dict:
+    """
+    Time func() and trace its Python allocations in a separate run
+
+    Returns:
+        Dict with mb_per_sec and peak_kib (peak traced allocation)
+    """
+    func()  # warm the page cache
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'mb_per_sec': size / (1024 * 1024) / best if best else 0.0, 'peak_kib': peak / 1024}
+
+
+def bench_read_path(args):
+    """MB/s and allocation peak of read() vs readinto vs mmap in _hash_file"""
+    sizes = [parse_size(s) for s in args.sizes]
+    readinto = FileHasher(root_paths=[], chunk_size=args.chunk_size, hash_algorithms=['sha512'], mmap_threshold=0)
+    mapped = FileHasher(root_paths=[], chunk_size=args.chunk_size, hash_algorithms=['sha512'], mmap_threshold=1)
+
+    print(f"sha512, chunk size {args.chunk_size}, warm page cache, best of {args.repeat}")
+    print(f"{'size':>6} {'path':<9} {'MB/s':>9} {'peak KiB':>10}")
+    for size in sizes:
+        path = os.path.join(args.workdir, f'read_{size}')
+        make_file(path, size)
+        paths = [
+            ('read', lambda: read_path_legacy(path, args.chunk_size)),
+            ('readinto', lambda: readinto._hash_file(path)),
+            ('mmap', lambda: mapped._hash_file(path)),
+        ]
+        for name, func in paths:
+            stats = measure(func, size, args.repeat)
+            print(f"{format_size(size):>6} {name:<9} {stats['mb_per_sec']:>9.1f} {stats['peak_kib']:>10.1f}")
+        os.remove(path)
+
+
+def make_sparse_file(path: str, size: int, extents: List[int], extent_size: int = 64 * 1024):
+    """
+    Create a sparse file with random data at the given offsets and holes elsewhere
+
+    Args:
+        path: File to create
+        size: Logical file size
+        extents: Offsets of the data extents
+        extent_size: Size of each data extent
+    """
+    with open(path, 'wb') as f:
+        f.truncate(size)
+        for offset in extents:
+            f.seek(offset)
+            f.write(os.urandom(min(extent_size, size - offset)))
+
+
+def bench_sparse(args):
+    """Sparse files: digest equality with a dense read and speedup from skipping holes"""
+    size = parse_size(args.size)
+    layouts = [
+        ('all-hole', []),
+        ('head+tail', [0, size - 64 * 1024]),
+        ('1%-data', list(range(0, size, 100 * 64 * 1024))),
+        ('dense', None),
+    ]
+    hasher = FileHasher(root_paths=[], chunk_size=args.chunk_size, hash_algorithms=['sha512'], fadvise=False)
+
+    print(f"{format_size(size)} files, sha512, chunk size {args.chunk_size}")
+    print(f"{'layout':<10} {'alloc':>8} {'dense s':>9} {'sparse s':>9} {'speedup':>8} {'equal':>6}")
+    failures = 0
+    for name, extents in layouts:
+        path = os.path.join(args.workdir, f'sparse_{name}')
+        if extents is None:
+            make_file(path, size)
+        else:
+            make_sparse_file(path, size, extents)
+        allocated = os.stat(path).st_blocks * 512
+
+        start = time.perf_counter()
+        dense = read_path_legacy(path, args.chunk_size)
+        dense_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        digests = hasher._hash_file(path)
+        sparse_seconds = time.perf_counter() - start
+
+        equal = digests is not None and digests['sha512'] == dense
+        failures += not equal
+        speedup = dense_seconds / sparse_seconds if sparse_seconds else 0.0
+        print(f"{name:<10} {format_size(allocated) if allocated else '0':>8} {dense_seconds:>9.2f} "
+              f"{sparse_seconds:>9.2f} {speedup:>7.1f}x {'yes' if equal else 'NO':>6}")
+        os.remove(path)
+    if failures:
+        sys.exit(f"{failures} layout(s) hashed differently from a dense read")
+
+
+def bench_tree_hash(args):
+    """MB/s of one large file: linear digests vs the tree_sha256 digest by thread count"""
+    size = parse_size(args.size)
+    path = os.path.join(args.workdir, 'tree_hash')
+    make_file(path, size)
+    runs = [(algo, 1) for algo in ('sha256', 'sha512')]
+    runs += [('tree_sha256', threads) for threads in args.threads]
+
+    print(f"{format_size(size)} file, warm page cache, best of {args.repeat}, cpu_count={os.cpu_count()}")
+    print(f"{'digest':<12} {'threads':>7} {'MB/s':>9}")
+    for algo, threads in runs:
+        hasher = FileHasher(root_paths=[], num_threads=threads, hash_algorithms=[algo], fadvise=False)
+        stats = measure(lambda: hasher._hash_file(path), size, args.repeat)
+        print(f"{algo:<12} {threads:>7} {stats['mb_per_sec']:>9.1f}")
+    os.remove(path)
+
+
+def bench_algorithms(args):
+    """MB/s of each hash algorithm, and of several at once: sequential vs one thread each"""
+    size = parse_size(args.size)
+    path = os.path.join(args.workdir, 'algorithms')
+    make_file(path, size)
+
+    print(f"{format_size(size)} file, warm page cache, best of {args.repeat}, cpu_count={os.cpu_count()}")
+    print(f"{'algorithm':<24} {'MB/s':>9}")
+    for algo in HASH_ALGORITHMS:
+        hasher = FileHasher(root_paths=[], num_threads=1, hash_algorithms=[algo], fadvise=False)
+        stats = measure(lambda: hasher._hash_file(path), size, args.repeat)
+        print(f"{algo:<24} {stats['mb_per_sec']:>9.1f}")
+
+    print(f"\n{'algorithms':<24} {'sequential':>11} {'parallel':>9}")
+    for combo in args.combos:
+        algos = combo.split(',')
+        row = []
+        for threshold in (0, 1):
+            hasher = FileHasher(root_paths=[], num_threads=1, hash_algorithms=algos, fadvise=False,
+                                mmap_threshold=0, parallel_digest_threshold=threshold)
+            row.append(measure(lambda: hasher._hash_file(path), size, args.repeat)['mb_per_sec'])
+        print(f"{combo:<24} {row[0]:>11.1f} {row[1]:>9.1f}")
+    os.remove(path)
+
+
+def synthetic_results(num_files: int, algorithms: List[str], files_per_dir: int = 50):
+    """(dir_name, result) pairs with realistic path lengths and random digests"""
+    sizes = [digest_size(algo) for algo in algorithms]
+    for i in range(num_files):
+        dir_name = f'/usr/share/app-{i // 5000:04d}/lib/module_{i // files_per_dir:06d}'
+        digests = {algo: os.urandom(size).hex() for algo, size in zip(algorithms, sizes)}
+        yield dir_name, make_result(f'{dir_name}/component_{i:08d}.py', algorithms, digests)
+
+
+def bench_memory(args):
+    """Bytes of RAM per file result: ResultStore vs per-file dicts"""
+    algorithms = args.hash
+    print(f"{args.files} files, {args.files_per_dir} per directory, {', '.join(algorithms)}")
+    print(f"{'store':<10} {'bytes/file':>11} {'add s':>7} {'read s':>7}")
+    for name in ('dicts', 'compact'):
+        tracemalloc.start()
+        start = time.perf_counter()
+        if name == 'dicts':
+            store = {}
+            for dir_name, result in synthetic_results(args.files, algorithms, args.files_per_dir):
+                store.setdefault(dir_name, {'files': []})['files'].append(result)
+        else:
+            store = ResultStore(algorithms)
+            for dir_name, result in synthetic_results(args.files, algorithms, args.files_per_dir):
+                store.add(dir_name, result)
+        added = time.perf_counter() - start
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        start = time.perf_counter()
+        if name == 'dicts':
+            count = sum(len(data['files']) for data in store.values())
+        else:
+            count = sum(len(entry['files']) for entry in store.directories())
+        read = time.perf_counter() - start
+        assert count == args.files
+        print(f"{name:<10} {current / args.files:>11.1f} {added:>7.1f} {read:>7.1f}")
+        del store
+
+
+def bench_match_db(args):
+    """Hash set build time and lookups/s for hits and misses, with and without the Bloom filter"""
+    size = digest_size(args.algorithm)
+    source = os.path.join(args.workdir, 'digests.txt')
+    hits = []
+    with open(source, 'w') as f:
+        for i in range(args.digests):
+            digest = os.urandom(size)
+            if i < args.lookups:
+                hits.append(digest)
+            f.write(digest.hex() + '\n')
+    misses = [os.urandom(size) for _ in range(args.lookups)]
+
+    path = os.path.join(args.workdir, 'match.vbhs')
+    start = time.perf_counter()
+    stats = build_hash_set([source], path, args.algorithm, run_size=args.run_size)
+    built = time.perf_counter() - start
+    print(f"{stats['digests']} {args.algorithm} digests built in {built:.1f}s "
+          f"({stats['digests'] / built:.0f} digests/s), file {os.path.getsize(path) // (1024 * 1024)} MiB")
+
+    print(f"{'lookup':<16} {'warm/s':>10} {'cold/s':>10}")
+    for name, digests, method in (('hit', hits, '__contains__'), ('miss', misses, '__contains__'),
+                                  ('miss, no bloom', misses, '_search')):
+        row = []
+        for cold in (False, True):
+            if cold and hasattr(os, 'posix_fadvise'):
+                # Evict the set from the page cache before mapping it again
+                fd = os.open(path, os.O_RDONLY)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+                os.close(fd)
+            with HashSet(path) as hash_set:
+                lookup = getattr(hash_set, method)
+                start = time.perf_counter()
+                found = sum(1 for digest in digests if lookup(digest))
+                row.append(len(digests) / (time.perf_counter() - start))
+            assert found == (len(digests) if digests is hits else 0)
+        print(f"{name:<16} {row[0]:>10.0f} {row[1]:>10.0f}")
+    with HashSet(path) as hash_set:
+        passed = sum(1 for digest in misses if hash_set.may_contain(digest))
+        print(f"Bloom false positives: {passed / len(misses):.2%} "
+              f"(expected {stats['false_positive_rate']:.2%})")
+
+
+def main():
+    """Main entry point"""
+    parser = argparse.ArgumentParser(description='file_hasher benchmarks')
+    parser.add_argument('--workdir', default=None, help='Directory for generated data (default: a temp dir)')
+    parser.add_argument('--keep', action='store_true', help='Keep generated data')
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    scaling = sub.add_parser('scaling', help=bench_scaling.__doc__)
+    scaling.add_argument('--files', type=int, default=20000)
+    scaling.add_argument('--file-size', type=int, default=512)
+    scaling.add_argument('--threads', type=int, default=32)
+    scaling.add_argument('--batch-size', type=int, default=256)
+    scaling.add_argument('--max-processes', type=int, default=None)
+    scaling.set_defaults(func=bench_scaling)
+
+    files_from = sub.add_parser('files-from', help=bench_files_from.__doc__)
+    files_from.add_argument('--files', type=int, default=20000)
+    files_from.add_argument('--file-size', type=int, default=512)
+    files_from.add_argument('--threads', type=int, default=32)
+    files_from.set_defaults(func=bench_files_from)
+
+    read_path = sub.add_parser('read-path', help=bench_read_path.__doc__)
+    read_path.add_argument('--sizes', nargs='+', default=['1K', '64K', '1M', '64M', '1G'],
+                           help='File sizes to test (default: 1K 64K 1M 64M 1G; add 10G for the full range)')
+    read_path.add_argument('--chunk-size', type=int, default=65536)
+    read_path.add_argument('--repeat', type=int, default=3)
+    read_path.set_defaults(func=bench_read_path)
+
+    sparse = sub.add_parser('sparse', help=bench_sparse.__doc__)
+    sparse.add_argument('--size', default='1G', help='Logical size of each file (default: 1G)')
+    sparse.add_argument('--chunk-size', type=int, default=65536)
+    sparse.set_defaults(func=bench_sparse)
+
+    tree_hash = sub.add_parser('tree-hash', help=bench_tree_hash.__doc__)
+    tree_hash.add_argument('--size', default='1G', help='File size (default: 1G)')
+    tree_hash.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    tree_hash.add_argument('--repeat', type=int, default=3)
+    tree_hash.set_defaults(func=bench_tree_hash)
+
+    algorithms = sub.add_parser('algorithms', help=bench_algorithms.__doc__)
+    algorithms.add_argument('--size', default='256M', help='File size (default: 256M)')
+    algorithms.add_argument('--combos', nargs='+', default=['sha256,sha512', 'sha256,sha512,sha1,md5'],
+                            help='Comma-separated algorithm sets to hash together')
+    algorithms.add_argument('--repeat', type=int, default=3)
+    algorithms.set_defaults(func=bench_algorithms)
+
+    contention = sub.add_parser('contention', help=bench_contention.__doc__)
+    contention.add_argument('--files', type=int, default=20000)
+    contention.add_argument('--file-size', type=int, default=64)
+    contention.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32, 64])
+    contention.add_argument('--accounts', type=int, default=400000,
+                            help='Total _account calls per thread count (default: 400000)')
+    contention.set_defaults(func=bench_contention)
+
+    memory = sub.add_parser('memory', help=bench_memory.__doc__)
+    memory.add_argument('--files', type=int, default=1000000)
+    memory.add_argument('--files-per-dir', type=int, default=50)
+    memory.add_argument('--hash', nargs='+', default=['sha512'], choices=list(HASH_ALGORITHMS))
+    memory.set_defaults(func=bench_memory)
+
+    match_db = sub.add_parser('match-db', help=bench_match_db.__doc__)
+    match_db.add_argument('--digests', type=int, default=2000000)
+    match_db.add_argument('--lookups', type=int, default=200000)
+    match_db.add_argument('--algorithm', default='sha256', choices=['sha256', 'sha512', 'sha1', 'md5'])
+    match_db.add_argument('--run-size', type=int, default=4000000)
+    match_db.set_defaults(func=bench_match_db)
+
+    args = parser.parse_args()
+    created = args.workdir is None
+    args.workdir = args.workdir or tempfile.mkdtemp(prefix='bench_hasher_', dir=os.getcwd())
+    try:
+        args.func(args)
+    finally:
+        if created and not args.keep:
+            shutil.rmtree(args.workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,19 +7,120 @@ Generates SHA512 hashes for all files on the system
 import os
 import sys
 import json
+import gzip
+import uuid
+import random
+import stat
+import time
 import hashlib
+import mmap
+import struct
+import math
+import re
+import errno
+import bisect
+import heapq
+import tempfile
+import sqlite3
 import socket
+import select
+import signal
 import platform
+import textwrap
 import threading
-from pathlib import Path
+import queue
+import multiprocessing
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from collections import defaultdict
-from typing import Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from collections import defaultdict, deque
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
 import urllib.request
 import urllib.error
 
 
+class TreeHash:
+    """
+    Merkle tree digest over fixed-size leaves (digest type 'tree_sha256')
+
+    The file is split into LEAF_SIZE leaves; each leaf digest is
+    SHA-256(0x00 || leaf) and each inner node SHA-256(0x01 || left || right),
+    pairing nodes left to right and carrying an odd last node up unchanged.
+    An empty file is a single empty leaf. Because leaves are independent,
+    one large file can be hashed by many threads; update() computes the
+    same digest sequentially.
+    """
+
+    name = 'tree_sha256'
+    digest_size = 32
+    LEAF_SIZE = 4 * 1024 * 1024
+
+    def __init__(self):
+        self.leaves = []
+        self._leaf = self.new_leaf()
+        self._filled = 0
+
+    @staticmethod
+    def new_leaf():
+        """Hash object for one leaf"""
+        return hashlib.sha256(b'\x00')
+
+    def update(self, data):
+        """Feed the next bytes of the file"""
+        view = memoryview(data)
+        while len(view):
+            take = min(self.LEAF_SIZE - self._filled, len(view))
+            self._leaf.update(view[:take])
+            self._filled += take
+            view = view[take:]
+            if self._filled == self.LEAF_SIZE:
+                self.leaves.append(self._leaf.digest())
+                self._leaf = self.new_leaf()
+                self._filled = 0
+
+    @classmethod
+    def root(cls, leaves: List[bytes]) -> bytes:
+        """Combine leaf digests into the root digest"""
+        level = leaves
+        while len(level) > 1:
+            paired = [hashlib.sha256(b'\x01' + level[i] + level[i + 1]).digest()
+                      for i in range(0, len(level) - 1, 2)]
+            if len(level) % 2:
+                paired.append(level[-1])
+            level = paired
+        return level[0]
+
+    def digest(self) -> bytes:
+        """Root digest of the data fed so far"""
+        leaves = self.leaves
+        if self._filled or not leaves:
+            leaves = leaves + [self._leaf.digest()]
+        return self.root(leaves)
+
+    def hexdigest(self) -> str:
+        """Root digest as hex"""
+        return self.digest().hex()
+
+
+# Digest types selectable with --hash, by output name
+HASH_ALGORITHMS = {
+    'sha256': hashlib.sha256,
+    'sha512': hashlib.sha512,
+    'sha1': hashlib.sha1,
+    'md5': hashlib.md5,
+    'blake2b': hashlib.blake2b,
+    'sha3_256': hashlib.sha3_256,
+    TreeHash.name: TreeHash,
+}
+
+
+def digest_size(algo: str) -> int:
+    """Size in bytes of a digest type's raw digest"""
+    factory = HASH_ALGORITHMS.get(algo)
+    if factory is None:
+        return hashlib.new(algo).digest_size
+    return factory().digest_size
+
+
 def load_config(config_path: str = 'config.json') -> Optional[Dict]:
     """
     Load configuration from JSON file
@@ -39,334 +140,5106 @@ def load_config(config_path: str = 'config.json') -> Optional[Dict]:
     return None
 
 
-def upload_results(results: Dict, config: Dict) -> bool:
+def make_result(file_path: str, algorithms: List[str], file_hashes: Dict[str, str]) -> Dict:
     """
-    Upload scan results to API endpoint
+    Build a file entry in the output schema
 
     Args:
-        results: Scan results dictionary
-        config: Config dict with endpoint_url, email, and api_key
+        file_path: Path to file
+        algorithms: Hash algorithms of the scan
+        file_hashes: Dict mapping algorithm name to hex digest
 
     Returns:
-        True if successful, False otherwise
+        Dict with file_name and file_hash (one algorithm) or file_hash_<algo> keys
     """
-    try:
-        endpoint = config.get('endpoint_url')
-        if not endpoint:
-            print("Error: endpoint_url not found in config", file=sys.stderr)
-            return False
+    result = {'file_name': file_path}
 
-        # Prepare request
-        data = json.dumps(results).encode('utf-8')
-        headers = {
-            'Content-Type': 'application/json',
-            'User-Agent': 'FileHasher/1.0',
-            'X-API-Key': config.get('api_key', ''),
-            'X-User-Email': config.get('email', '')
-        }
+    # Add hashes with appropriate keys
+    if len(algorithms) == 1:
+        # Single algorithm - use 'file_hash' for backward compatibility
+        result['file_hash'] = file_hashes[algorithms[0]]
+    else:
+        # Multiple algorithms - use separate keys
+        for algo in algorithms:
+            result[f'file_hash_{algo}'] = file_hashes[algo]
 
-        print(f"Uploading results to {endpoint}...", file=sys.stderr)
+    return result
 
-        req = urllib.request.Request(endpoint, data=data, headers=headers, method='POST')
 
-        with urllib.request.urlopen(req, timeout=30) as response:
-            status_code = response.getcode()
-            response_data = response.read().decode('utf-8')
+# Digest key of a quick fingerprint (--mode quick) in place of the full digests
+QUICK_KEY = 'quick'
 
-            if status_code == 200 or status_code == 201:
-                print(f"Upload successful! Status: {status_code}", file=sys.stderr)
-                if response_data:
-                    print(f"Response: {response_data}", file=sys.stderr)
-                return True
-            else:
+
+def make_quick_result(file_path: str, fingerprint: Dict) -> Dict:
+    """
+    Build a file entry for a quick fingerprint
+
+    Args:
+        file_path: Path to file
+        fingerprint: Dict with the quick digest and file size
+
+    Returns:
+        Dict with file_name, file_size and quick_hash
+    """
+    return {'file_name': file_path, 'file_size': fingerprint['size'], 'quick_hash': fingerprint[QUICK_KEY]}
+
+
+def is_quick(result: Dict) -> bool:
+    """Whether a file entry holds a quick fingerprint rather than full digests"""
+    return 'quick_hash' in result
+
+
+def result_digests(result: Dict, algorithms: List[str]) -> Dict[str, str]:
+    """
+    Get the hex digests from a file entry in the output schema
+
+    Args:
+        result: File entry built by make_result
+        algorithms: Hash algorithms of the scan
+
+    Returns:
+        Dict mapping algorithm name to hex digest
+    """
+    if len(algorithms) == 1:
+        return {algorithms[0]: result['file_hash']}
+    return {algo: result[f'file_hash_{algo}'] for algo in algorithms}
+
+
+def same_content(old: Dict, new: Dict, algorithms: List[str]) -> bool:
+    """
+    Whether two file entries describe the same content
+
+    Quick entries compare by fingerprint and size; a quick entry never
+    matches a full one, so switching --mode reports the file as modified.
+
+    Args:
+        old: Previous file entry
+        new: Current file entry
+        algorithms: Hash algorithms of the scan
+
+    Returns:
+        True if the entries match
+    """
+    if is_quick(old) or is_quick(new):
+        return (is_quick(old) and is_quick(new) and old['quick_hash'] == new['quick_hash']
+                and old.get('file_size') == new.get('file_size'))
+    return result_digests(old, algorithms) == result_digests(new, algorithms)
+
+
+# Default number of file records per upload request
+UPLOAD_BATCH_SIZE = 5000
+
+
+def _post_batch(endpoint: str, body: bytes, headers: Dict, timeout: float, max_retries: int) -> bool:
+    """
+    POST one upload batch, retrying with exponential backoff
+
+    Connection errors, timeouts, HTTP 429 and 5xx responses are retried;
+    other HTTP errors fail immediately.
+
+    Returns:
+        True if the server acknowledged the batch
+    """
+    delay = 1.0
+    for attempt in range(max_retries + 1):
+        retry_after = None
+        try:
+            req = urllib.request.Request(endpoint, data=body, headers=headers, method='POST')
+            with urllib.request.urlopen(req, timeout=timeout) as response:
+                status_code = response.getcode()
+                response_data = response.read().decode('utf-8', 'replace')
+
+                if 200 <= status_code < 300:
+                    return True
                 print(f"Upload failed with status {status_code}: {response_data}", file=sys.stderr)
                 return False
 
-    except urllib.error.HTTPError as e:
-        print(f"HTTP Error {e.code}: {e.reason}", file=sys.stderr)
+        except urllib.error.HTTPError as e:
+            print(f"HTTP Error {e.code}: {e.reason}", file=sys.stderr)
+            try:
+                error_body = e.read().decode('utf-8')
+                print(f"Error details: {error_body}", file=sys.stderr)
+            except Exception:
+                pass
+            if e.code != 429 and e.code < 500:
+                return False
+            try:
+                retry_after = float(e.headers.get('Retry-After'))
+            except (TypeError, ValueError):
+                retry_after = None
+        except Exception as e:
+            print(f"Upload failed: {e}", file=sys.stderr)
+
+        if attempt == max_retries:
+            break
+        wait = retry_after if retry_after is not None else min(delay, 60.0) * random.uniform(0.5, 1.5)
+        print(f"Retrying in {wait:.1f}s ({attempt + 1}/{max_retries})...", file=sys.stderr)
+        time.sleep(wait)
+        delay *= 2
+
+    return False
+
+
+def _iter_batches(records, batch_size: int):
+    """
+    Group (dir_name, result) pairs into directories[] lists of batch_size files
+
+    Yields:
+        (directories, file_count) per batch
+    """
+    directories = []
+    count = 0
+    for dir_name, result in records:
+        if not directories or directories[-1]['dir_name'] != dir_name:
+            directories.append({'dir_name': dir_name, 'files': []})
+        directories[-1]['files'].append(result)
+        count += 1
+        if count >= batch_size:
+            yield directories, count
+            directories = []
+            count = 0
+    if count:
+        yield directories, count
+
+
+def _load_checkpoint(checkpoint_path: Optional[str], source: Dict) -> Tuple[str, int]:
+    """
+    Find where a previous upload of the same source stopped
+
+    Returns:
+        (scan session id, index of the first batch still to send)
+    """
+    if checkpoint_path and os.path.exists(checkpoint_path):
         try:
-            error_body = e.read().decode('utf-8')
-            print(f"Error details: {error_body}", file=sys.stderr)
-        except:
+            with open(checkpoint_path, 'r') as f:
+                checkpoint = json.load(f)
+            if checkpoint.get('source') == source:
+                return checkpoint['session'], checkpoint['acked'] + 1
+        except (OSError, ValueError, KeyError):
             pass
+    return str(uuid.uuid4()), 0
+
+
+def _save_checkpoint(checkpoint_path: Optional[str], source: Dict, session: str, acked: int):
+    """Record the last acknowledged batch (written atomically)"""
+    if not checkpoint_path:
+        return
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'source': source, 'session': session, 'acked': acked}, f)
+    os.replace(tmp_path, checkpoint_path)
+
+
+def upload_records(header: Dict, records, totals: Callable[[], Dict], config: Dict,
+                   batch_size: int = UPLOAD_BATCH_SIZE, checkpoint_path: Optional[str] = None,
+                   source: Optional[Dict] = None) -> bool:
+    """
+    Upload scan results to API endpoint in gzip-compressed batches
+
+    Every batch is a document in the regular output schema holding up to
+    batch_size files, tagged with a scan session id and batch index (also
+    sent as an Idempotency-Key). The last batch carries the totals. With a
+    checkpoint_path, acknowledged batches are recorded so a rerun for the
+    same source resumes after the last acknowledged batch.
+
+    Args:
+        header: Header fields of the scan
+        records: Iterable of (dir_name, result) pairs
+        totals: Called after the last record to get total_files/total_errors
+        config: Config dict with endpoint_url, email and api_key (optionally
+            upload_retries and upload_timeout)
+        batch_size: Files per request
+        checkpoint_path: File used to resume interrupted uploads
+        source: Identity of the uploaded data, stored in the checkpoint
+
+    Returns:
+        True if every batch was acknowledged, False otherwise
+    """
+    endpoint = config.get('endpoint_url')
+    if not endpoint:
+        print("Error: endpoint_url not found in config", file=sys.stderr)
         return False
+    max_retries = int(config.get('upload_retries', 5))
+    timeout = float(config.get('upload_timeout', 60))
+
+    session, first_batch = _load_checkpoint(checkpoint_path, source)
+    if first_batch:
+        print(f"Resuming upload session {session} at batch {first_batch}", file=sys.stderr)
+
+    print(f"Uploading results to {endpoint} in batches of {batch_size} files...", file=sys.stderr)
+
+    batches = _iter_batches(records, batch_size)
+    current = next(batches, ([], 0))
+    index = 0
+    while True:
+        # Look ahead one batch so the last one can be flagged as final
+        following = next(batches, None)
+        final = following is None
+
+        if index >= first_batch:
+            directories, count = current
+            payload = dict(header)
+            payload['scan_session'] = session
+            payload['batch_index'] = index
+            payload['batch_final'] = final
+            if final:
+                payload.update(totals())
+                payload['batch_count'] = index + 1
+            payload['directories'] = directories
+
+            # Prepare request
+            data = gzip.compress(json.dumps(payload).encode('utf-8'))
+            headers = {
+                'Content-Type': 'application/json',
+                'Content-Encoding': 'gzip',
+                'User-Agent': 'FileHasher/1.0',
+                'X-API-Key': config.get('api_key', ''),
+                'X-User-Email': config.get('email', ''),
+                'X-Scan-Session': session,
+                'X-Batch-Index': str(index),
+                'X-Batch-Final': '1' if final else '0',
+                'Idempotency-Key': f'{session}-{index}'
+            }
+
+            if not _post_batch(endpoint, data, headers, timeout, max_retries):
+                print(f"Upload stopped at batch {index}", file=sys.stderr)
+                return False
+            _save_checkpoint(checkpoint_path, source, session, index)
+            print(f"Uploaded batch {index} ({count} files, {len(data)} bytes)", file=sys.stderr)
+
+        if final:
+            break
+        current = following
+        index += 1
+
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    print(f"Upload successful! {index + 1} batch(es), session {session}", file=sys.stderr)
+    return True
+
+
+def upload_file(path: str, config: Dict, batch_size: int = UPLOAD_BATCH_SIZE) -> bool:
+    """
+    Upload an output file (any format), resuming a previous interrupted upload
+
+    Progress is checkpointed to <path>.upload-checkpoint until the upload
+    completes.
+
+    Args:
+        path: Output file written by a ResultWriter
+        config: Config dict with endpoint_url, email, and api_key
+        batch_size: Files per request
+
+    Returns:
+        True if successful, False otherwise
+    """
+    try:
+        st = os.stat(path)
+        source = {'path': os.path.abspath(path), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                  'batch_size': batch_size}
+        with ManifestReader(path) as reader:
+            return upload_records(reader.header, reader, lambda: reader.totals, config, batch_size,
+                                  checkpoint_path=path + '.upload-checkpoint', source=source)
     except Exception as e:
         print(f"Upload failed: {e}", file=sys.stderr)
         return False
 
 
-class FileHasher:
-    """High-performance multi-threaded file hasher"""
+class HashIndex:
+    """
+    Persistent on-disk index of file digests (SQLite, WAL mode)
 
-    # Directories to skip (OS-specific)
-    SKIP_DIRS = {
-        'linux': {'/proc', '/sys', '/dev', '/run', '/tmp'},
-        'darwin': {'/dev', '/private/tmp', '/private/var/tmp', '/Volumes'},
-        'windows': {'C:\\$Recycle.Bin', 'C:\\Windows\\Temp', 'C:\\Temp'},
-        'freebsd': {'/proc', '/dev', '/tmp'},
-        'openbsd': {'/proc', '/dev', '/tmp'},
-        'netbsd': {'/proc', '/dev', '/tmp'}
-    }
+    Entries are keyed by path and remember the (st_dev, st_ino, size,
+    mtime_ns, ctime_ns) signature the digests were computed for, so files
+    whose signature is unchanged can reuse their stored digests.
+    """
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS files (
+            path BLOB PRIMARY KEY,
+            st_dev INTEGER NOT NULL,
+            st_ino INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            ctime_ns INTEGER NOT NULL,
+            digests TEXT NOT NULL,
+            scan_id INTEGER NOT NULL
+        )""",
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+    ]
 
-    def __init__(self, root_paths: List[str], num_threads: int = 32, chunk_size: int = 65536, hash_algorithms: List[str] = None):
+    def __init__(self, db_path: str, batch_size: int = 1000, readonly: bool = False):
         """
-        Initialize the file hasher
+        Open (or create) the index
 
         Args:
-            root_paths: List of root directories to scan
-            num_threads: Number of worker threads
-            chunk_size: File read chunk size in bytes
-            hash_algorithms: List of hash algorithms to use (sha256, sha512, or both)
+            db_path: Path to the SQLite database file
+            batch_size: Number of pending writes per transaction
+            readonly: Only open for lookups (used by worker processes)
         """
-        self.root_paths = root_paths
-        self.num_threads = num_threads
-        self.chunk_size = chunk_size
-        self.hash_algorithms = hash_algorithms or ['sha512']
-        self.results = defaultdict(lambda: {'files': []})
-        self.lock = threading.Lock()
-        self.file_count = 0
-        self.error_count = 0
-        self.os_type = self._detect_os()
-        self.skip_dirs = self._get_skip_dirs()
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending = []
+        self._touched = []
+        self._conn = None
+        if readonly:
+            return
 
-    def _detect_os(self) -> str:
-        """Detect operating system"""
-        system = platform.system().lower()
-        if system == 'linux':
-            return 'linux'
-        elif system == 'darwin':
-            return 'darwin'
-        elif system == 'windows':
-            return 'windows'
-        elif 'bsd' in system:
-            return system
-        return 'unknown'
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        for statement in self.SCHEMA:
+            self._conn.execute(statement)
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'scan_id'").fetchone()
+        self.scan_id = int(row[0]) + 1 if row else 1
+        self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('scan_id', ?)", (str(self.scan_id),))
+        self._conn.commit()
 
-    def _get_skip_dirs(self) -> set:
-        """Get directories to skip based on OS"""
-        return self.SKIP_DIRS.get(self.os_type, set())
+    @staticmethod
+    def signature(st: os.stat_result) -> tuple:
+        """Stat fields that must match for stored digests to be reused"""
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
 
-    def _should_skip_dir(self, dir_path: str) -> bool:
-        """Check if directory should be skipped"""
-        for skip_dir in self.skip_dirs:
-            if dir_path.startswith(skip_dir):
-                return True
-        return False
+    def _reader(self) -> sqlite3.Connection:
+        """Per-thread read connection (WAL lets readers run alongside the writer)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path)
+            self._local.conn = conn
+        return conn
 
-    def _get_hostname(self) -> str:
-        """Get system hostname"""
-        try:
-            return socket.gethostname()
-        except Exception:
-            return "unknown"
+    def lookup(self, path: str, st: os.stat_result, algorithms: List[str]) -> Optional[Dict[str, str]]:
+        """
+        Get stored digests for an unchanged file
 
-    def _get_local_ip(self) -> str:
-        """Get local IP address"""
-        try:
-            # Create a socket to determine local IP
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.connect(("8.8.8.8", 80))
-            ip = s.getsockname()[0]
-            s.close()
-            return ip
-        except Exception:
-            return "127.0.0.1"
+        Args:
+            path: File path
+            st: Current lstat result for the file
+            algorithms: Algorithms that must all be present
 
-    def _get_public_ip(self) -> str:
-        """Get public IP address"""
-        try:
-            # Try multiple services for reliability
-            services = [
-                'https://api.ipify.org',
-                'https://icanhazip.com',
-                'https://ifconfig.me/ip'
-            ]
+        Returns:
+            Dict mapping algorithm name to hex digest, or None if the file is
+            new, changed, or was indexed with different algorithms
+        """
+        row = self._reader().execute(
+            'SELECT st_dev, st_ino, size, mtime_ns, ctime_ns, digests FROM files WHERE path = ?',
+            (os.fsencode(path),)
+        ).fetchone()
+        if row is None or tuple(row[:5]) != self.signature(st):
+            return None
+        digests = json.loads(row[5])
+        if not all(algo in digests for algo in algorithms):
+            return None
+        return {algo: digests[algo] for algo in algorithms}
 
-            for service in services:
-                try:
-                    req = urllib.request.Request(service, headers={'User-Agent': 'Mozilla/5.0'})
-                    with urllib.request.urlopen(req, timeout=5) as response:
-                        return response.read().decode('utf-8').strip()
-                except Exception:
-                    continue
+    def get(self, path: str) -> Optional[Tuple[tuple, Dict[str, str]]]:
+        """
+        Get the stored entry of a path, whether or not the file still matches it
 
-            return "unknown"
-        except Exception:
-            return "unknown"
+        Returns:
+            (signature, digests) or None if the path is not indexed
+        """
+        row = self._reader().execute(
+            'SELECT st_dev, st_ino, size, mtime_ns, ctime_ns, digests FROM files WHERE path = ?',
+            (os.fsencode(path),)
+        ).fetchone()
+        if row is None:
+            return None
+        return tuple(row[:5]), json.loads(row[5])
 
-    def _hash_file(self, file_path: str) -> Optional[Dict[str, str]]:
+    @staticmethod
+    def _prefix_range(path: str) -> Tuple[bytes, bytes]:
+        """(lower, upper) bounds of the paths under a directory"""
+        prefix = os.fsencode(os.path.join(path, ''))
+        # Every path under prefix sorts between prefix and prefix with
+        # its trailing separator bumped by one
+        return prefix, prefix[:-1] + bytes([prefix[-1] + 1])
+
+    def paths(self, path: str):
+        """Yield the indexed paths under a directory"""
+        lower, upper = self._prefix_range(path)
+        cursor = self._reader().execute('SELECT path FROM files WHERE path >= ? AND path < ?', (lower, upper))
+        for row in cursor:
+            yield os.fsdecode(row[0])
+
+    def remove(self, path: str) -> List[Tuple[str, Dict[str, str]]]:
         """
-        Compute hash(es) of a file using specified algorithms
+        Delete the entry of a path and all entries under it
 
         Args:
-            file_path: Path to file
+            path: Deleted file or directory
 
         Returns:
-            Dict mapping algorithm name to hex digest, or None on error
+            (path, digests) of the removed entries
         """
-        try:
-            # Initialize hash objects for all requested algorithms
-            hashers = {}
-            for algo in self.hash_algorithms:
-                if algo == 'sha256':
-                    hashers['sha256'] = hashlib.sha256()
-                elif algo == 'sha512':
-                    hashers['sha512'] = hashlib.sha512()
-                else:
-                    raise ValueError(f"Unsupported hash algorithm: {algo}")
+        self.flush()
+        lower, upper = self._prefix_range(path)
+        where = 'path = ? OR (path >= ? AND path < ?)'
+        params = (os.fsencode(path), lower, upper)
+        with self._lock, self._conn:
+            rows = self._conn.execute(f'SELECT path, digests FROM files WHERE {where}', params).fetchall()
+            self._conn.execute(f'DELETE FROM files WHERE {where}', params)
+        return [(os.fsdecode(row[0]), json.loads(row[1])) for row in rows]
 
-            # Read file once and update all hashers
-            with open(file_path, 'rb') as f:
-                while chunk := f.read(self.chunk_size):
-                    for hasher in hashers.values():
-                        hasher.update(chunk)
+    def record(self, path: str, signature: tuple, digests: Dict[str, str]):
+        """Queue a new or updated entry for the index"""
+        with self._lock:
+            self._pending.append((os.fsencode(path),) + signature + (json.dumps(digests), self.scan_id))
+            if len(self._pending) >= self.batch_size:
+                self._flush_locked()
 
-            # Return hex digests
-            return {algo: hasher.hexdigest() for algo, hasher in hashers.items()}
-        except (PermissionError, OSError, IOError) as e:
-            # Silently skip files we can't read
-            return None
+    def touch(self, path: str):
+        """Mark an unchanged entry as seen by this scan"""
+        with self._lock:
+            self._touched.append((self.scan_id, os.fsencode(path)))
+            if len(self._touched) >= self.batch_size:
+                self._flush_locked()
+
+    def _flush_locked(self):
+        """Write pending entries in one transaction (caller holds the lock)"""
+        with self._conn:
+            if self._pending:
+                self._conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)', self._pending)
+            if self._touched:
+                self._conn.executemany('UPDATE files SET scan_id = ? WHERE path = ?', self._touched)
+        self._pending = []
+        self._touched = []
 
-    def _process_file(self, file_path: Path, dir_name: str) -> Optional[Dict]:
+    def flush(self):
+        """Write all pending entries"""
+        with self._lock:
+            self._flush_locked()
+
+    def prune(self, root_paths: List[str]) -> int:
         """
-        Process a single file
+        Delete entries under root_paths that were not seen by this scan
 
         Args:
-            file_path: Path object for file
-            dir_name: Parent directory name
+            root_paths: Roots that were scanned completely
 
         Returns:
-            Dict with file info or None
+            Number of entries removed (deleted or no longer readable files)
         """
-        try:
-            # Skip symlinks to avoid loops
-            if file_path.is_symlink():
-                return None
+        self.flush()
+        removed = 0
+        with self._lock, self._conn:
+            for root in root_paths:
+                prefix, upper = self._prefix_range(root)
+                cursor = self._conn.execute(
+                    'DELETE FROM files WHERE scan_id < ? AND path >= ? AND path < ?',
+                    (self.scan_id, prefix, upper)
+                )
+                removed += cursor.rowcount
+        return removed
 
-            # Only process regular files
-            if not file_path.is_file():
-                return None
+    def close(self):
+        """Flush pending entries and close the writer connection"""
+        if self._conn is None:
+            return
+        self.flush()
+        self._conn.close()
 
-            file_hashes = self._hash_file(str(file_path))
-            if file_hashes is None:
-                with self.lock:
-                    self.error_count += 1
-                return None
 
-            with self.lock:
-                self.file_count += 1
-                if self.file_count % 1000 == 0:
-                    print(f"Processed {self.file_count} files...", file=sys.stderr)
+class HardlinkTable:
+    """
+    Digests of inodes with more than one link, so each inode is hashed once
 
-            # Build result with all hash algorithms
-            result = {'file_name': str(file_path)}
+    The first path seen for an inode claims it and hashes the file; later
+    links wait for that digest instead of reading the data again. Entries
+    are dropped once all st_nlink links have been seen, and at most
+    max_entries inodes are tracked at a time.
+    """
 
-            # Add hashes with appropriate keys
-            if len(self.hash_algorithms) == 1:
-                # Single algorithm - use 'file_hash' for backward compatibility
-                result['file_hash'] = file_hashes[self.hash_algorithms[0]]
-            else:
-                # Multiple algorithms - use separate keys
-                for algo, hash_value in file_hashes.items():
-                    result[f'file_hash_{algo}'] = hash_value
+    class Entry:
+        """One multiply-linked inode"""
 
-            return result
+        def __init__(self, path: str, remaining: int):
+            self.path = path
+            self.remaining = remaining
+            self.digests = None
+            self.done = threading.Event()
 
-        except Exception as e:
-            return None
+    def __init__(self, max_entries: int = 1000000):
+        """
+        Args:
+            max_entries: Maximum number of inodes tracked at once
+        """
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = {}
 
-    def _walk_directory(self, root_path: str):
+    def claim(self, path: str, st: os.stat_result) -> Tuple[bool, Optional['HardlinkTable.Entry']]:
         """
-        Walk directory tree and yield all files
+        Register one link of an inode
 
         Args:
-            root_path: Root directory to scan
+            path: Path of this link
+            st: lstat result of the link
+
+        Returns:
+            (True, entry) if the caller must hash the file and publish() the
+            result, (False, entry) if an earlier link owns it, or (True, None)
+            if the inode is not tracked
         """
-        try:
-            for dirpath, dirnames, filenames in os.walk(root_path, topdown=True):
-                # Skip directories we should avoid
-                if self._should_skip_dir(dirpath):
-                    dirnames.clear()  # Don't recurse into subdirectories
-                    continue
+        key = (st.st_dev, st.st_ino)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                if len(self._entries) >= self.max_entries:
+                    return True, None
+                entry = self.Entry(path, st.st_nlink - 1)
+                self._entries[key] = entry
+                return True, entry
+            entry.remaining -= 1
+            if entry.remaining <= 0:
+                del self._entries[key]
+            return False, entry
 
-                # Remove directories we should skip from the walk
-                dirnames[:] = [d for d in dirnames if not self._should_skip_dir(os.path.join(dirpath, d))]
+    @staticmethod
+    def publish(entry: Optional['HardlinkTable.Entry'], digests: Optional[Dict[str, str]]):
+        """Hand the owner's digests (None on error) to waiting links"""
+        if entry is not None:
+            entry.digests = digests
+            entry.done.set()
 
-                for filename in filenames:
-                    file_path = Path(dirpath) / filename
-                    yield file_path, dirpath
 
-        except (PermissionError, OSError) as e:
-            # Skip directories we can't access
-            pass
+class MountTable:
+    """
+    Mounted filesystems parsed from /proc/self/mountinfo (Linux)
+
+    Maps mount points to their filesystem type and device (major:minor),
+    and decides which filesystem types are skipped by policy.
+    """
+
+    MOUNTINFO = '/proc/self/mountinfo'
+
+    # Kernel and virtual filesystems that hold no regular file content worth hashing
+    PSEUDO_FS_TYPES = {
+        'proc', 'sysfs', 'devtmpfs', 'devpts', 'cgroup', 'cgroup2', 'securityfs', 'debugfs',
+        'tracefs', 'pstore', 'bpf', 'configfs', 'fusectl', 'mqueue', 'hugetlbfs', 'autofs',
+        'binfmt_misc', 'efivarfs', 'selinuxfs', 'rpc_pipefs', 'nsfs', 'nfsd', 'ramfs'
+    }
+
+    # Remote filesystems, skipped unless explicitly included
+    NETWORK_FS_TYPES = {
+        'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'ncpfs', 'afs', '9p', 'ceph', 'glusterfs',
+        'lustre', 'gpfs', 'fuse.sshfs', 'fuse.glusterfs', 'fuse.cephfs', 'fuse.s3fs', 'davfs'
+    }
+
+    class Mount:
+        """One mountinfo line"""
 
-    def scan(self) -> Dict:
+        def __init__(self, mount_point: str, device: str, fstype: str, source: str):
+            self.mount_point = mount_point
+            self.device = device
+            self.fstype = fstype
+            self.source = source
+
+    def __init__(self, mounts: List['MountTable.Mount']):
         """
-        Scan all files and generate hash mapping
+        Args:
+            mounts: Mounts in mountinfo order (later mounts hide earlier ones)
+        """
+        self.mounts = {}
+        for mount in mounts:
+            self.mounts[mount.mount_point] = mount
+        self._network = {mount.device for mount in self.mounts.values() if self.is_network_fstype(mount.fstype)}
+        self._rotational = {}
+
+    @classmethod
+    def is_network_fstype(cls, fstype: str) -> bool:
+        """Whether a filesystem type is a remote filesystem"""
+        return fstype in cls.NETWORK_FS_TYPES or fstype.startswith('nfs')
+
+    @staticmethod
+    def _unescape(field: str) -> str:
+        """Decode the octal escapes (\\040 etc.) used in mountinfo"""
+        if '\\' not in field:
+            return field
+        return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+    @classmethod
+    def load(cls, path: str = MOUNTINFO) -> Optional['MountTable']:
+        """
+        Parse mountinfo
+
+        Returns:
+            MountTable, or None where mountinfo is not available
+        """
+        try:
+            with open(path, 'r', encoding='utf-8', errors='surrogateescape') as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return None
+
+        mounts = []
+        for line in lines:
+            # id parent major:minor root mount_point options [optional...] - fstype source super_options
+            fields = line.split(' ')
+            try:
+                sep = fields.index('-', 6)
+                mounts.append(cls.Mount(cls._unescape(fields[4]), fields[2], fields[sep + 1],
+                                        cls._unescape(fields[sep + 2])))
+            except (ValueError, IndexError):
+                continue
+        return cls(mounts)
+
+    def get(self, path: str) -> Optional['MountTable.Mount']:
+        """Mount whose mount point is exactly path"""
+        return self.mounts.get(path)
+
+    def find(self, path: str) -> Optional['MountTable.Mount']:
+        """Mount containing path (longest mount point prefix)"""
+        path = os.path.abspath(path)
+        while True:
+            mount = self.mounts.get(path)
+            if mount is not None:
+                return mount
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+    def is_network(self, device: str) -> bool:
+        """Whether a device (major:minor) belongs to a mounted network filesystem"""
+        return device in self._network
+
+    def is_rotational(self, device: str) -> bool:
+        """Whether a block device (major:minor) is a spinning disk, per sysfs"""
+        if device not in self._rotational:
+            rotational = False
+            sysfs = os.path.join('/sys/dev/block', device)
+            # Partitions have no queue/ of their own; use the parent disk's
+            for candidate in (os.path.join(sysfs, 'queue', 'rotational'),
+                              os.path.join(os.path.realpath(sysfs), '..', 'queue', 'rotational')):
+                try:
+                    with open(candidate, 'r') as f:
+                        rotational = f.read().strip() == '1'
+                    break
+                except OSError:
+                    continue
+            self._rotational[device] = rotational
+        return self._rotational[device]
+
+
+class Inotify:
+    """
+    Minimal inotify(7) binding through ctypes (Linux only)
+
+    One non-blocking instance; watches are added and removed per directory
+    and read() returns the parsed events.
+    """
+
+    MODIFY = 0x2
+    ATTRIB = 0x4
+    CLOSE_WRITE = 0x8
+    MOVED_FROM = 0x40
+    MOVED_TO = 0x80
+    CREATE = 0x100
+    DELETE = 0x200
+    DELETE_SELF = 0x400
+    MOVE_SELF = 0x800
+    Q_OVERFLOW = 0x4000
+    IGNORED = 0x8000
+    ONLYDIR = 0x01000000
+    DONT_FOLLOW = 0x02000000
+    EXCL_UNLINK = 0x04000000
+    ISDIR = 0x40000000
+    # struct inotify_event: wd, mask, cookie, len, then len bytes of NUL-padded name
+    EVENT = struct.Struct('iIII')
+    READ_SIZE = 256 * 1024
+
+    def __init__(self):
+        import ctypes
+        self._ctypes = ctypes
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_init1: {os.strerror(err)}")
+
+    @staticmethod
+    def available() -> bool:
+        """Whether inotify can be used on this platform"""
+        return sys.platform.startswith('linux')
+
+    def add_watch(self, path: str, mask: int) -> int:
+        """
+        Watch a path
+
+        Returns:
+            Watch descriptor
+
+        Raises:
+            OSError: ENOSPC once fs.inotify.max_user_watches is reached,
+                ENOENT/EACCES/ENOTDIR for paths that cannot be watched
+        """
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = self._ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd: int):
+        """Remove a watch (errors for watches the kernel already dropped are ignored)"""
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout: float) -> List[Tuple[int, int, int, str]]:
+        """
+        Wait up to timeout seconds for events
+
+        Returns:
+            (wd, mask, cookie, name) per event; name is empty for events
+            on the watched directory itself
+        """
+        ready, _, _ = select.select([self.fd], [], [], max(0.0, timeout))
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, self.READ_SIZE)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        """Close the instance; all its watches go with it"""
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class DeviceScheduler:
+    """
+    Per-device work queues served by one shared pool of worker threads
+
+    Each device has its own bounded queue and a concurrency budget; workers
+    take items round-robin from devices that are below their budget, so a
+    slow device never occupies more than its budget of workers while
+    faster devices keep the rest busy.
+    """
+
+    def __init__(self, budget: Callable[[object], int], max_queued: int):
+        """
+        Args:
+            budget: Returns the maximum number of concurrent workers for a device
+            max_queued: Capacity of each device queue
+        """
+        self.budget = budget
+        self.max_queued = max_queued
+        self._lock = threading.Lock()
+        self._work = threading.Condition(self._lock)
+        self._space = threading.Condition(self._lock)
+        self._queues = {}
+        self._active = {}
+        self._budgets = {}
+        self._order = deque()
+        self._closed = False
+
+    def congested(self, device) -> bool:
+        """Whether a device's queue is full (a put would block)"""
+        q = self._queues.get(device)
+        return q is not None and len(q) >= self.max_queued
+
+    def put(self, item, device):
+        """Queue an item for a device, blocking while its queue is full"""
+        with self._lock:
+            q = self._queues.get(device)
+            if q is None:
+                q = self._queues[device] = deque()
+                self._active[device] = 0
+                self._budgets[device] = max(1, self.budget(device))
+                self._order.append(device)
+            while len(q) >= self.max_queued:
+                self._space.wait()
+            q.append(item)
+            self._work.notify()
+
+    def get(self) -> Optional[tuple]:
+        """
+        Take the next item from a device that is below its budget
+
+        Returns:
+            (item, device), or None once closed and drained
+        """
+        with self._lock:
+            while True:
+                for _ in range(len(self._order)):
+                    device = self._order[0]
+                    self._order.rotate(-1)
+                    q = self._queues[device]
+                    if q and self._active[device] < self._budgets[device]:
+                        self._active[device] += 1
+                        item = q.popleft()
+                        self._space.notify_all()
+                        return item, device
+                if self._closed and not any(self._queues.values()):
+                    # Pass the shutdown on to the other idle workers
+                    self._work.notify_all()
+                    return None
+                self._work.wait()
+
+    def done(self, device):
+        """Release a device's budget slot after an item has been processed"""
+        with self._lock:
+            self._active[device] -= 1
+            self._work.notify()
+
+    def close(self):
+        """No more items will be queued; idle workers exit once all queues drain"""
+        with self._lock:
+            self._closed = True
+            self._work.notify_all()
+
+    def depth(self) -> int:
+        """Total number of queued items"""
+        with self._lock:
+            return sum(len(q) for q in self._queues.values())
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter
+
+    Callers take tokens for the work they are about to do and sleep off any
+    deficit, so the long-run rate stays at rate tokens per second while
+    bursts of up to burst tokens pass without waiting.
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        """
+        Args:
+            rate: Tokens added per second
+            burst: Bucket capacity (default: one second's worth)
+        """
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount: float = 1):
+        """Take amount tokens, sleeping until the bucket has covered them"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= amount
+            deficit = -self._tokens
+        if deficit > 0:
+            time.sleep(deficit / self.rate)
+
+
+class IoThrottle:
+    """
+    Read limits for running on busy production hosts
+
+    Combines a bytes/s and a files/s token bucket with an optional adaptive
+    backoff: a monitor thread samples the system iowait share from
+    /proc/stat and, while it is above the threshold, makes every file open
+    wait an extra delay that doubles each interval (and halves again once
+    iowait has dropped below half the threshold).
+    """
+
+    PROC_STAT = '/proc/stat'
+    MAX_BACKOFF = 1.0
+
+    def __init__(self, bytes_per_sec: float = 0, files_per_sec: float = 0, adaptive: bool = False,
+                 iowait_threshold: float = 20.0, interval: float = 1.0):
+        """
+        Args:
+            bytes_per_sec: Read rate limit (0: unlimited)
+            files_per_sec: File open rate limit (0: unlimited)
+            adaptive: Back off while system iowait is high (Linux)
+            iowait_threshold: iowait percentage that triggers the backoff
+            interval: Seconds between iowait samples
+        """
+        self.bytes = TokenBucket(bytes_per_sec) if bytes_per_sec else None
+        self.files = TokenBucket(files_per_sec) if files_per_sec else None
+        self.iowait_threshold = iowait_threshold
+        self.interval = interval
+        self.iowait = None
+        self.backoff = 0.0
+        self._stop = threading.Event()
+        self._monitor = None
+        if adaptive and os.path.exists(self.PROC_STAT):
+            self._monitor = threading.Thread(target=self._watch_iowait, name='iowait-monitor', daemon=True)
+            self._monitor.start()
+
+    @classmethod
+    def _cpu_times(cls) -> Optional[Tuple[int, int]]:
+        """(iowait, total) jiffies from the aggregate cpu line of /proc/stat"""
+        try:
+            with open(cls.PROC_STAT, 'r') as f:
+                fields = f.readline().split()
+        except OSError:
+            return None
+        if len(fields) < 6 or fields[0] != 'cpu':
+            return None
+        times = [int(v) for v in fields[1:]]
+        return times[4], sum(times)
+
+    def _watch_iowait(self):
+        """Monitor thread: adjust the backoff from the iowait share of each interval"""
+        last = self._cpu_times()
+        while not self._stop.wait(self.interval):
+            current = self._cpu_times()
+            if last is None or current is None or current[1] == last[1]:
+                last = current
+                continue
+            self.iowait = 100.0 * (current[0] - last[0]) / (current[1] - last[1])
+            last = current
+            if self.iowait > self.iowait_threshold:
+                self.backoff = min(self.MAX_BACKOFF, max(0.001, self.backoff * 2))
+            elif self.iowait < self.iowait_threshold / 2:
+                self.backoff = self.backoff / 2 if self.backoff >= 0.002 else 0.0
+
+    def before_file(self):
+        """Wait for permission to open the next file"""
+        if self.files is not None:
+            self.files.consume(1)
+        backoff = self.backoff
+        if backoff:
+            time.sleep(backoff)
+
+    def before_read(self, size: int):
+        """Wait for permission to read size bytes"""
+        if self.bytes is not None:
+            self.bytes.consume(size)
+
+    def after_read(self, size: int):
+        """Charge size bytes just read whose amount was not known up front"""
+        if self.bytes is not None and size:
+            self.bytes.consume(size)
+
+    def state(self) -> str:
+        """Short description of the limits and backoff for progress output"""
+        parts = []
+        if self.bytes is not None:
+            parts.append(f"{self.bytes.rate / (1024 * 1024):.1f} MiB/s")
+        if self.files is not None:
+            parts.append(f"{self.files.rate:.0f} files/s")
+        if self._monitor is not None:
+            iowait = f"{self.iowait:.0f}%" if self.iowait is not None else '-'
+            parts.append(f"iowait {iowait}, backoff {self.backoff * 1000:.0f} ms/file")
+        return ', '.join(parts)
+
+    def share(self, parts: int) -> Dict:
+        """Constructor arguments for one of parts throttles that together keep these limits"""
+        return {
+            'bytes_per_sec': self.bytes.rate / parts if self.bytes is not None else 0,
+            'files_per_sec': self.files.rate / parts if self.files is not None else 0,
+            'adaptive': self._monitor is not None,
+            'iowait_threshold': self.iowait_threshold,
+            'interval': self.interval
+        }
+
+    def close(self):
+        """Stop the iowait monitor"""
+        self._stop.set()
+
+
+class ScanMetrics:
+    """
+    Counters, per-stage latency histograms and the slowest files of a scan
+
+    Stages are stat, open, read and hash (per file) and serialize (per
+    result written). With mmap, sparse, tree and multi-algorithm reads the
+    read time is included in hash.
+    """
+
+    STAGES = ('stat', 'open', 'read', 'hash', 'serialize')
+    # Histogram bucket upper bounds in seconds (Prometheus style, +Inf implied)
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+               0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    class Shard:
+        """Metrics of one thread; only that thread updates it, so no lock is taken"""
+
+        def __init__(self, num_buckets: int):
+            self.bytes = 0
+            self.errors = defaultdict(int)
+            self.histograms = {stage: [0] * num_buckets for stage in ScanMetrics.STAGES}
+            self.sums = {stage: 0.0 for stage in ScanMetrics.STAGES}
+            self.slowest = []
+
+    def __init__(self, slowest: int = 10):
+        """
+        Args:
+            slowest: Number of slowest files to keep
+        """
+        self.start = time.time()
+        self.slowest_max = slowest
+        self._shards = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _shard(self) -> 'ScanMetrics.Shard':
+        """This thread's shard (registered on first use)"""
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self.Shard(len(self.BUCKETS) + 1)
+            with self._lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+        return shard
+
+    def observe(self, stage: str, seconds: float):
+        """Record the duration of one stage"""
+        shard = self._shard()
+        shard.histograms[stage][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        shard.sums[stage] += seconds
+
+    def add_bytes(self, count: int):
+        """Count bytes read and hashed"""
+        self._shard().bytes += count
+
+    def bytes_read(self) -> int:
+        """Bytes read and hashed so far, over all shards"""
+        with self._lock:
+            return sum(shard.bytes for shard in self._shards)
+
+    def file_done(self, file_path: str, seconds: float):
+        """Keep a processed file if it is among the slowest"""
+        slowest = self._shard().slowest
+        if len(slowest) < self.slowest_max:
+            heapq.heappush(slowest, (seconds, file_path))
+        elif seconds > slowest[0][0]:
+            heapq.heapreplace(slowest, (seconds, file_path))
+
+    def error(self, exc: Optional[BaseException] = None):
+        """Count an error by errno name ('unknown' without an OSError)"""
+        code = getattr(exc, 'errno', None)
+        name = errno.errorcode.get(code, str(code)) if code is not None else 'unknown'
+        self._shard().errors[name] += 1
+
+    def _quantile(self, counts: List[int], q: float) -> Optional[float]:
+        """Upper bound of the bucket holding quantile q"""
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            seen += count
+            if seen >= rank:
+                return self.BUCKETS[index] if index < len(self.BUCKETS) else float('inf')
+        return None
+
+    def snapshot(self) -> Dict:
+        """
+        Byte count, errors, histograms and slowest files merged over all shards
+
+        Shards are read while their threads keep updating them, so a snapshot
+        taken during a scan may be a few observations behind.
+        """
+        with self._lock:
+            shards = list(self._shards)
+        histograms = {stage: [0] * (len(self.BUCKETS) + 1) for stage in self.STAGES}
+        sums = {stage: 0.0 for stage in self.STAGES}
+        errors = defaultdict(int)
+        slowest = []
+        total_bytes = 0
+        for shard in shards:
+            total_bytes += shard.bytes
+            for name, count in list(shard.errors.items()):
+                errors[name] += count
+            for stage in self.STAGES:
+                sums[stage] += shard.sums[stage]
+                histograms[stage] = [a + b for a, b in zip(histograms[stage], shard.histograms[stage])]
+            slowest.extend(list(shard.slowest))
+        snap = {
+            'elapsed': time.time() - self.start,
+            'bytes': total_bytes,
+            'errors_by_errno': dict(errors),
+            'slowest': [{'file_name': path, 'seconds': round(seconds, 6)}
+                        for seconds, path in heapq.nlargest(self.slowest_max, slowest)]
+        }
+        snap['stages'] = {
+            stage: {
+                'count': sum(counts),
+                'sum': round(sums[stage], 6),
+                'p50': self._quantile(counts, 0.5),
+                'p99': self._quantile(counts, 0.99),
+                'buckets': counts
+            }
+            for stage, counts in histograms.items()
+        }
+        return snap
+
+    @staticmethod
+    def _label(value) -> str:
+        """Escape a Prometheus label value"""
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def prometheus(self, snap: Dict) -> str:
+        """Render a snapshot (with rates, queues and state) in the Prometheus text format"""
+        lines = [
+            '# TYPE file_hasher_files_total counter',
+            f"file_hasher_files_total {snap['files']}",
+            '# TYPE file_hasher_bytes_total counter',
+            f"file_hasher_bytes_total {snap['bytes']}",
+            '# TYPE file_hasher_files_per_second gauge',
+            f"file_hasher_files_per_second {snap['files_per_sec']:.3f}",
+            '# TYPE file_hasher_bytes_per_second gauge',
+            f"file_hasher_bytes_per_second {snap['bytes_per_sec']:.3f}",
+            '# TYPE file_hasher_scan_start_timestamp_seconds gauge',
+            f"file_hasher_scan_start_timestamp_seconds {self.start:.3f}",
+            '# TYPE file_hasher_scan_complete gauge',
+            f"file_hasher_scan_complete {1 if snap['final'] else 0}",
+            '# TYPE file_hasher_errors_total counter',
+        ]
+        for name, count in sorted(snap['errors_by_errno'].items()):
+            lines.append(f'file_hasher_errors_total{{errno="{self._label(name)}"}} {count}')
+        lines.append('# TYPE file_hasher_queue_depth gauge')
+        for name, depth in snap['queues'].items():
+            lines.append(f'file_hasher_queue_depth{{queue="{name}"}} {depth}')
+        lines.append('# TYPE file_hasher_stage_seconds histogram')
+        for stage, data in snap['stages'].items():
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + (float('inf'),), data['buckets']):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'file_hasher_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'file_hasher_stage_seconds_sum{{stage="{stage}"}} {data["sum"]}')
+            lines.append(f'file_hasher_stage_seconds_count{{stage="{stage}"}} {data["count"]}')
+        lines.append('# TYPE file_hasher_slowest_file_seconds gauge')
+        for entry in snap['slowest']:
+            lines.append(f'file_hasher_slowest_file_seconds{{file="{self._label(entry["file_name"])}"}} '
+                         f'{entry["seconds"]}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsReporter:
+    """
+    Periodic progress output for a running scan
+
+    Every interval seconds a progress line goes to stderr, a JSON line with
+    the full metrics is appended to json_path ('-' for stderr) and the
+    Prometheus textfile at prom_path is replaced atomically.
+    """
+
+    def __init__(self, hasher: 'FileHasher', interval: float = 10.0, json_path: Optional[str] = None,
+                 prom_path: Optional[str] = None):
+        """
+        Args:
+            hasher: Scan to report on
+            interval: Seconds between reports
+            json_path: JSON lines output ('-' for stderr)
+            prom_path: Prometheus textfile-collector file (*.prom)
+        """
+        self.hasher = hasher
+        self.interval = interval
+        self.json_path = json_path
+        self.prom_path = prom_path
+        self._json = None
+        self._last = (time.monotonic(), 0, 0)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start reporting in a background thread"""
+        if self.json_path == '-':
+            self._json = sys.stderr
+        elif self.json_path:
+            self._json = open(self.json_path, 'a', encoding='utf-8')
+        self._thread = threading.Thread(target=self._run, name='metrics', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.report()
+
+    def report(self, final: bool = False):
+        """Emit one report"""
+        snap = self.hasher.metrics_snapshot()
+        now = time.monotonic()
+        last_time, last_files, last_bytes = self._last
+        elapsed = max(now - last_time, 1e-9)
+        if final:
+            # Whole-scan averages for the last report
+            elapsed = max(snap['elapsed'], 1e-9)
+            last_files = last_bytes = 0
+        snap['files_per_sec'] = (snap['files'] - last_files) / elapsed
+        snap['bytes_per_sec'] = (snap['bytes'] - last_bytes) / elapsed
+        snap['final'] = final
+        self._last = (now, snap['files'], snap['bytes'])
+
+        line = (f"Processed {snap['files']} files ({snap['files_per_sec']:.0f} files/s, "
+                f"{snap['bytes_per_sec'] / (1024 * 1024):.1f} MiB/s, "
+                f"queued {snap['queues']['hash']}, errors {snap['errors']})")
+        if self.hasher.throttle is not None:
+            line += f" (throttle: {self.hasher.throttle.state()})"
+        if not final:
+            print(line, file=sys.stderr)
+
+        if self._json is not None:
+            self._json.write(json.dumps(dict({'type': 'metrics', 'time': datetime.utcnow().isoformat() + 'Z'},
+                                             **snap)) + '\n')
+            self._json.flush()
+        if self.prom_path:
+            tmp_path = f"{self.prom_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(self.hasher.metrics.prometheus(snap))
+            os.replace(tmp_path, self.prom_path)
+
+    def stop(self):
+        """Stop the thread and emit the final report"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.report(final=True)
+        if self._json is not None and self._json is not sys.stderr:
+            self._json.close()
+
+
+class ResultWriter:
+    """
+    Streams scan results to a file as they are produced
+
+    Subclasses implement begin/write/end for a specific format. Only the
+    aggregator thread calls write(), so writers need no locking.
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path: Output file path
+        """
+        self.path = path
+        self.file = open(path, 'w', encoding='utf-8')
+
+    def begin(self, header: Dict):
+        """Write the scan header (system info, algorithms, scan date)"""
+        raise NotImplementedError
+
+    def write(self, dir_name: str, result: Dict):
+        """Write one file result"""
+        raise NotImplementedError
+
+    def end(self, totals: Dict):
+        """Write the trailer (total_files, total_errors) and close the file"""
+        raise NotImplementedError
+
+    # Appended by seal() to make a truncated file parse again
+    SEAL = ''
+
+    def sync(self) -> Dict:
+        """
+        Write out everything accepted so far and flush it to disk
+
+        Returns:
+            Writer state for a scan checkpoint; 'offset' is the file size
+            at which the output is a complete prefix of records
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return {'offset': self.file.tell()}
+
+    @classmethod
+    def seal(cls, path: str, state: Dict):
+        """
+        Cut an output file left by a killed scan back to a sync() point
+
+        The records up to that point stay readable by ManifestReader; the
+        totals are missing.
+        """
+        with open(path, 'r+b') as f:
+            f.truncate(state['offset'])
+            f.seek(0, os.SEEK_END)
+            f.write(cls.SEAL.encode('utf-8'))
+
+    def close(self):
+        """Close the output file"""
+        if not self.file.closed:
+            self.file.close()
+
+
+class JsonResultWriter(ResultWriter):
+    """
+    Incrementally written JSON in the regular output schema
+
+    Files are buffered per directory and emitted as a directories[] entry
+    once batch_size files have accumulated for that directory, or when more
+    than max_buffered files are buffered overall. A large directory can
+    therefore appear in several directories[] entries. The totals are
+    written after directories[] since they are only known at the end.
+    """
+
+    def __init__(self, path: str, compact: bool = False, batch_size: int = 1000, max_buffered: int = 10000):
+        """
+        Args:
+            path: Output file path
+            compact: Write without indentation
+            batch_size: Files per directories[] entry
+            max_buffered: Maximum number of files held in memory
+        """
+        super().__init__(path)
+        self.compact = compact
+        self.batch_size = batch_size
+        self.max_buffered = max_buffered
+        self.pending = {}
+        self.buffered = 0
+        self.first_dir = True
+
+    def _dumps(self, obj, level: int = 1) -> str:
+        """Encode obj nested level deep"""
+        if self.compact:
+            return json.dumps(obj, separators=(',', ':'))
+        return textwrap.indent(json.dumps(obj, indent=2), '  ' * level).lstrip()
+
+    def _fragment(self, key: str, value, level: int = 1) -> str:
+        """Encode a "key": value member"""
+        if self.compact:
+            return f'{json.dumps(key)}:{self._dumps(value, level)}'
+        return f'{"  " * level}{json.dumps(key)}: {self._dumps(value, level)}'
+
+    def begin(self, header: Dict):
+        """Write the header members and open directories[]"""
+        sep = ',' if self.compact else ',\n'
+        self.file.write('{' if self.compact else '{\n')
+        for key, value in header.items():
+            self.file.write(self._fragment(key, value) + sep)
+        self.file.write('"directories":[' if self.compact else '  "directories": [')
+
+    def _emit(self, dir_name: str, files: List[Dict]):
+        """Write one directories[] entry"""
+        entry = self._dumps({'dir_name': dir_name, 'files': files}, 2)
+        if self.compact:
+            self.file.write(('' if self.first_dir else ',') + entry)
+        else:
+            self.file.write(('\n    ' if self.first_dir else ',\n    ') + entry)
+        self.first_dir = False
+
+    def _flush(self):
+        """Emit every buffered directory"""
+        for dir_name, files in self.pending.items():
+            self._emit(dir_name, files)
+        self.pending = {}
+        self.buffered = 0
+
+    def write(self, dir_name: str, result: Dict):
+        """Buffer a file result, emitting full directory batches"""
+        files = self.pending.setdefault(dir_name, [])
+        files.append(result)
+        self.buffered += 1
+        if len(files) >= self.batch_size:
+            self._emit(dir_name, files)
+            del self.pending[dir_name]
+            self.buffered -= len(files)
+        elif self.buffered >= self.max_buffered:
+            self._flush()
+
+    SEAL = '\n  ]\n}\n'
+
+    def sync(self) -> Dict:
+        """Emit every buffered directory, then flush"""
+        self._flush()
+        return super().sync()
+
+    def end(self, totals: Dict):
+        """Close directories[], write the totals and close the file"""
+        self._flush()
+        if self.compact:
+            self.file.write(']')
+            for key, value in totals.items():
+                self.file.write(',' + self._fragment(key, value))
+            self.file.write('}')
+        else:
+            self.file.write('\n  ]' if not self.first_dir else ']')
+            for key, value in totals.items():
+                self.file.write(',\n' + self._fragment(key, value))
+            self.file.write('\n}\n')
+        self.close()
+
+
+class NdjsonResultWriter(ResultWriter):
+    """
+    Newline-delimited JSON: one record per line
+
+    The first record has type "scan" and carries the header, each file is a
+    "file" record with its dir_name, and the last record has type "summary"
+    with the totals.
+    """
+
+    def _record(self, record: Dict):
+        """Write one record"""
+        self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+    def begin(self, header: Dict):
+        """Write the scan record"""
+        self._record(dict({'type': 'scan'}, **header))
+
+    def write(self, dir_name: str, result: Dict):
+        """Write a file record"""
+        self._record(dict({'type': 'file', 'dir_name': dir_name}, **result))
+
+    def end(self, totals: Dict):
+        """Write the summary record and close the file"""
+        self._record(dict({'type': 'summary'}, **totals))
+        self.close()
+
+
+class BinaryManifestWriter(ResultWriter):
+    """
+    Writes the compact binary manifest format read by BinaryManifest
+
+    Records have to be sorted before they can be written, so they are kept
+    in a ResultStore until end().
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path: Output file path
+        """
+        self.path = path
+        self.file = open(path, 'wb')
+        self.header = {}
+        self.algorithms = []
+        self.store = None
+
+    def begin(self, header: Dict):
+        """Remember the header; it is written with the totals in end()"""
+        if header.get('scan_mode') == 'quick':
+            raise ValueError("Quick fingerprints cannot be stored in a binary manifest; use json or ndjson")
+        self.header = dict(header)
+        self.algorithms = list(header['hash_algorithms'])
+        self.store = ResultStore(self.algorithms, keep_extras=False)
+
+    def write(self, dir_name: str, result: Dict):
+        """Add one file result"""
+        self.store.add(dir_name, result)
+
+    def sync(self) -> Dict:
+        """Binary manifests only exist once end() has sorted them"""
+        raise ValueError("Binary manifests are written at the end of the scan and cannot be checkpointed; "
+                         "use json or ndjson")
+
+    def end(self, totals: Dict):
+        """Sort and write all sections, then close the file"""
+        store = self.store
+        meta = json.dumps(dict(self.header, **totals)).encode('utf-8')
+        encoded = [os.fsencode(dir_name) for dir_name in store.dir_names]
+        dir_order = sorted(range(len(encoded)), key=encoded.__getitem__)
+
+        meta_off = BinaryManifest.HEADER.size
+        dirs_off = meta_off + 4 + len(meta)
+        strings_off = dirs_off + len(encoded) * BinaryManifest.DIR_ENTRY.size
+        dir_names_len = sum(len(d) for d in encoded)
+        records_off = strings_off + dir_names_len + store.name_bytes()
+
+        f = self.file
+        f.write(BinaryManifest.HEADER.pack(BinaryManifest.MAGIC, BinaryManifest.VERSION, store.digest_width,
+                                           len(encoded), len(store), meta_off, dirs_off, strings_off, records_off))
+        f.write(struct.pack('<I', len(meta)))
+        f.write(meta)
+
+        # Directory table, then the string blob: directory names followed by basenames
+        offset = 0
+        for dir_id in dir_order:
+            f.write(BinaryManifest.DIR_ENTRY.pack(offset, len(encoded[dir_id])))
+            offset += len(encoded[dir_id])
+        for dir_id in dir_order:
+            f.write(encoded[dir_id])
+
+        # Each directory is sorted on its own; its basenames go to the string
+        # blob and its fixed-width records to the records section
+        names_pos = strings_off + dir_names_len
+        records_pos = records_off
+        for new_id, dir_id in enumerate(dir_order):
+            records = sorted(store.raw_records(dir_id))
+            f.seek(names_pos)
+            f.write(b''.join(name for name, _, _ in records))
+            names_pos = f.tell()
+            packed = []
+            for name, flags, raw in records:
+                packed.append(BinaryManifest.RECORD.pack(new_id, len(name), flags, offset))
+                packed.append(raw)
+                offset += len(name)
+            f.seek(records_pos)
+            f.write(b''.join(packed))
+            records_pos = f.tell()
+
+        self.store = None
+        self.close()
+
+
+class BinaryManifest:
+    """
+    Read-only, memory-mapped view of a binary manifest
+
+    Layout (little-endian):
+        header      magic 'VBMF', version, digest width, directory count,
+                    record count and the offsets of the sections below
+        metadata    u32 length + JSON (header fields, hash_algorithms, totals)
+        dir table   (u64 string offset, u32 length) per directory, sorted
+        strings     directory names, then file basenames
+        records     (u32 dir id, u16 name length, u16 flags, u64 name offset)
+                    followed by the raw digests in hash_algorithms order,
+                    sorted by (directory, name)
+
+    Lookups binary-search the directory table and records in place, so
+    nothing is parsed up front.
+    """
+
+    MAGIC = b'VBMF'
+    VERSION = 1
+    HEADER = struct.Struct('<4sHHIQQQQQ')
+    DIR_ENTRY = struct.Struct('<QI')
+    RECORD = struct.Struct('<IHHQ')
+    FLAG_FULL_PATH = 0x1
+    FLAG_BACKSLASH = 0x2
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path: Manifest file path
+        """
+        self.path = path
+        self.file = open(path, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.digest_width, self.num_dirs, self.num_records,
+         meta_off, self.dirs_off, self.strings_off, self.records_off) = self.HEADER.unpack_from(self.mm, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError(f"{path} is not a version {self.VERSION} binary manifest")
+        meta_len, = struct.unpack_from('<I', self.mm, meta_off)
+        self.header = json.loads(self.mm[meta_off + 4:meta_off + 4 + meta_len].decode('utf-8'))
+        self.algorithms = self.header['hash_algorithms']
+        self.digest_sizes = [digest_size(algo) for algo in self.algorithms]
+        self.record_size = self.RECORD.size + self.digest_width
+
+    @classmethod
+    def split_name(cls, file_path: str, dir_name: str) -> Tuple[str, int]:
+        """
+        Split a file path into the name stored in a record and its flags
+
+        Returns:
+            (name relative to dir_name, flags); the full path with
+            FLAG_FULL_PATH if the file is not directly under dir_name
+            (e.g. --files results grouped under 'specified_files')
+        """
+        if file_path.startswith(dir_name):
+            rest = file_path[len(dir_name):]
+            if rest and dir_name.endswith(('/', '\\')):
+                return rest, 0
+            if rest[:1] == '/':
+                return rest[1:], 0
+            if rest[:1] == '\\':
+                return rest[1:], cls.FLAG_BACKSLASH
+        return file_path, cls.FLAG_FULL_PATH
+
+    @classmethod
+    def join_name(cls, dir_name: str, name: str, flags: int) -> str:
+        """Inverse of split_name"""
+        if flags & cls.FLAG_FULL_PATH:
+            return name
+        if dir_name.endswith(('/', '\\')):
+            return dir_name + name
+        return dir_name + ('\\' if flags & cls.FLAG_BACKSLASH else '/') + name
+
+    @classmethod
+    def is_manifest(cls, path: str) -> bool:
+        """Check whether a file starts with the manifest magic"""
+        with open(path, 'rb') as f:
+            return f.read(len(cls.MAGIC)) == cls.MAGIC
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self) -> int:
+        return self.num_records
+
+    def close(self):
+        """Unmap and close the file"""
+        self.mm.close()
+        self.file.close()
+
+    def _dir(self, dir_id: int) -> bytes:
+        """Encoded directory name for a directory id"""
+        offset, length = self.DIR_ENTRY.unpack_from(self.mm, self.dirs_off + dir_id * self.DIR_ENTRY.size)
+        start = self.strings_off + offset
+        return self.mm[start:start + length]
+
+    def _record(self, index: int) -> tuple:
+        """(dir_id, encoded name, flags, raw digests) of a record"""
+        pos = self.records_off + index * self.record_size
+        dir_id, name_len, flags, name_off = self.RECORD.unpack_from(self.mm, pos)
+        start = self.strings_off + name_off
+        digest_pos = pos + self.RECORD.size
+        return dir_id, self.mm[start:start + name_len], flags, self.mm[digest_pos:digest_pos + self.digest_width]
+
+    def _digests(self, raw: bytes) -> Dict[str, str]:
+        """Split raw record digests into hex digests per algorithm"""
+        digests = {}
+        pos = 0
+        for algo, size in zip(self.algorithms, self.digest_sizes):
+            digests[algo] = raw[pos:pos + size].hex()
+            pos += size
+        return digests
+
+    def _find_dir(self, dir_name: bytes) -> Optional[int]:
+        """Binary search the directory table"""
+        lo, hi = 0, self.num_dirs
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._dir(mid) < dir_name:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.num_dirs and self._dir(lo) == dir_name:
+            return lo
+        return None
+
+    def lookup(self, file_path: str, dir_name: Optional[str] = None) -> Optional[Dict[str, str]]:
+        """
+        Find the digests of a file
+
+        Args:
+            file_path: Full file path as it appears in file_name
+            dir_name: Directory the file is grouped under (default: its parent)
+
+        Returns:
+            Dict mapping algorithm name to hex digest, or None if not present
+        """
+        if dir_name is None:
+            dir_name = os.path.dirname(file_path)
+        name, _ = self.split_name(file_path, dir_name)
+        dir_id = self._find_dir(os.fsencode(dir_name))
+        if dir_id is None:
+            return None
+
+        key = (dir_id, os.fsencode(name))
+        lo, hi = 0, self.num_records
+        while lo < hi:
+            mid = (lo + hi) // 2
+            record = self._record(mid)
+            if (record[0], record[1]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.num_records:
+            record = self._record(lo)
+            if (record[0], record[1]) == key:
+                return self._digests(record[3])
+        return None
+
+    def __iter__(self):
+        """Yield (dir_name, result) pairs in (directory, name) order"""
+        dir_id = None
+        dir_name = None
+        for index in range(self.num_records):
+            record_dir, name, flags, raw = self._record(index)
+            if record_dir != dir_id:
+                dir_id = record_dir
+                dir_name = os.fsdecode(self._dir(dir_id))
+            file_path = self.join_name(dir_name, os.fsdecode(name), flags)
+            yield dir_name, make_result(file_path, self.algorithms, self._digests(raw))
+
+    def to_results(self) -> Dict:
+        """Convert to a results dictionary in the regular output schema"""
+        results = dict(self.header)
+        directories = []
+        for dir_name, result in self:
+            if not directories or directories[-1]['dir_name'] != dir_name:
+                directories.append({'dir_name': dir_name, 'files': []})
+            directories[-1]['files'].append(result)
+        results['directories'] = directories
+        return results
+
+
+class ResultStore:
+    """
+    Compact in-memory store of file results, grouped by directory
+
+    Directory names are interned once and each directory packs its files
+    into one bytearray: a 2-byte header (name length and flags), the
+    basename and the raw digests, about 90 bytes per file for sha512.
+    Fields other than file_name and the digests (hardlink_of, quick
+    fingerprints) are kept in a side table for the records that have
+    them. Result dicts in the output schema are only built when the store
+    is read.
+    """
+
+    RECORD_HEADER = struct.Struct('<H')
+    # Low header bits: BinaryManifest name flags, then the extras bit; the
+    # name length takes the rest
+    NAME_FLAGS = 0x3
+    FLAG_EXTRAS = 0x4
+    LENGTH_SHIFT = 3
+    MAX_NAME = 0xFFFF >> LENGTH_SHIFT
+
+    def __init__(self, algorithms: List[str], keep_extras: bool = True):
+        """
+        Args:
+            algorithms: Hash algorithms of the results
+            keep_extras: Keep fields other than file_name and the digests
+        """
+        self.algorithms = list(algorithms)
+        self.digest_sizes = [digest_size(algo) for algo in self.algorithms]
+        self.digest_width = sum(self.digest_sizes)
+        self.keep_extras = keep_extras
+        self._dir_ids = {}
+        self.dir_names = []
+        self._records = []
+        self._names_len = 0
+        self._count = 0
+        self._extras = {}
+
+    def __len__(self) -> int:
+        return self._count
+
+    def add(self, dir_name: str, result: Dict):
+        """Add one file result under dir_name"""
+        dir_id = self._dir_ids.get(dir_name)
+        if dir_id is None:
+            dir_id = self._dir_ids[dir_name] = len(self.dir_names)
+            self.dir_names.append(dir_name)
+            self._records.append(bytearray())
+        records = self._records[dir_id]
+
+        name, flags = BinaryManifest.split_name(result['file_name'], dir_name)
+        name = os.fsencode(name)
+        if len(name) > self.MAX_NAME:
+            raise ValueError(f"Path too long to store: {result['file_name']}")
+
+        if is_quick(result):
+            raw = b''
+            digest_keys = ()
+        else:
+            digests = result_digests(result, self.algorithms)
+            raw = b''.join(bytes.fromhex(digests[algo]) for algo in self.algorithms)
+            digest_keys = ('file_hash',) if len(self.algorithms) == 1 else \
+                tuple(f'file_hash_{algo}' for algo in self.algorithms)
+        if len(result) > 1 + len(digest_keys) and (self.keep_extras or not raw):
+            flags |= self.FLAG_EXTRAS
+            self._extras[(dir_id, len(records))] = {k: v for k, v in result.items()
+                                                    if k != 'file_name' and k not in digest_keys}
+
+        records += self.RECORD_HEADER.pack(len(name) << self.LENGTH_SHIFT | flags)
+        records += name
+        records += raw
+        self._names_len += len(name)
+        self._count += 1
+
+    def _unpack(self, dir_id: int):
+        """Yield (name, flags, raw digests, extras) for the files of one directory"""
+        records = self._records[dir_id]
+        width = self.digest_width
+        offset = 0
+        while offset < len(records):
+            header, = self.RECORD_HEADER.unpack_from(records, offset)
+            extras = self._extras.get((dir_id, offset)) if header & self.FLAG_EXTRAS else None
+            offset += self.RECORD_HEADER.size
+            end = offset + (header >> self.LENGTH_SHIFT)
+            name = bytes(records[offset:end])
+            offset = end
+            if extras is not None and is_quick(extras):
+                raw = None
+            else:
+                raw = bytes(records[offset:offset + width])
+                offset += width
+            yield name, header & self.NAME_FLAGS, raw, extras
+
+    def raw_records(self, dir_id: int):
+        """Yield (encoded name, name flags, raw digests) for the files of one directory"""
+        for name, flags, raw, _ in self._unpack(dir_id):
+            yield name, flags, raw
+
+    def name_bytes(self) -> int:
+        """Total size of the encoded basenames"""
+        return self._names_len
+
+    def files(self, dir_id: int):
+        """Yield the result dicts of one directory, built from the packed records"""
+        dir_name = self.dir_names[dir_id]
+        for name, flags, raw, extras in self._unpack(dir_id):
+            file_path = BinaryManifest.join_name(dir_name, os.fsdecode(name), flags)
+            if raw is None:
+                result = {'file_name': file_path}
+            else:
+                digests = {}
+                offset = 0
+                for algo, size in zip(self.algorithms, self.digest_sizes):
+                    digests[algo] = raw[offset:offset + size].hex()
+                    offset += size
+                result = make_result(file_path, self.algorithms, digests)
+            if extras:
+                result.update(extras)
+            yield result
+
+    def directories(self):
+        """Yield {'dir_name', 'files'} entries in the order directories were first seen"""
+        for dir_id, dir_name in enumerate(self.dir_names):
+            yield {'dir_name': dir_name, 'files': list(self.files(dir_id))}
+
+    def __iter__(self):
+        """Yield (dir_name, result) pairs grouped by directory"""
+        for dir_id, dir_name in enumerate(self.dir_names):
+            for result in self.files(dir_id):
+                yield dir_name, result
+
+
+class ManifestReader:
+    """
+    Streams (dir_name, result) pairs from an output file of any format
+
+    header holds the header fields; totals (total_files, total_errors) is
+    complete once iteration has finished, since NDJSON and JSON carry them
+    last. Plain JSON is parsed incrementally, one directories[] entry at a
+    time, so memory is bounded by the largest entry rather than the file.
+    """
+
+    TOTAL_KEYS = ('total_files', 'total_errors', 'quick_files', 'files_added', 'files_modified', 'files_removed',
+                  'files_matched', 'files_known_good', 'coverage', 'partial', 'stopped_by', 'resume_token')
+
+    NDJSON_PREFIX = '{"type":"scan"'
+
+    # Characters read at a time when streaming plain JSON
+    JSON_CHUNK = 1024 * 1024
+
+    _decoder = json.JSONDecoder()
+    _whitespace = re.compile(r'[ \t\r\n]*')
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path: Output file written by a ResultWriter
+        """
+        self.path = path
+        self.totals = {}
+        self._file = None
+        self._manifest = None
+        self._buffer = ''
+        self._pos = 0
+        self._in_directories = False
+
+        if BinaryManifest.is_manifest(path):
+            self.format = 'binary'
+            self._manifest = BinaryManifest(path)
+            self.header = dict(self._manifest.header)
+        else:
+            self._file = open(path, 'r', encoding='utf-8')
+            # Compact JSON is a single line, so only look at its start
+            prefix = self._file.read(len(self.NDJSON_PREFIX))
+            self._file.seek(0)
+            if prefix == self.NDJSON_PREFIX:
+                self.format = 'ndjson'
+                self.header = json.loads(self._file.readline())
+                del self.header['type']
+            else:
+                self.format = 'json'
+                self.header = {}
+                self._expect('{')
+                self._in_directories = self._read_members(self.header)
+
+        for key in self.TOTAL_KEYS:
+            if key in self.header:
+                self.totals[key] = self.header.pop(key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        """Yield (dir_name, result) pairs"""
+        if self._manifest is not None:
+            yield from self._manifest
+        elif self.format == 'json':
+            if not self._in_directories:
+                return
+            self._in_directories = False
+            while True:
+                char = self._peek()
+                if char == ']':
+                    self._pos += 1
+                    break
+                if char == ',':
+                    self._pos += 1
+                    continue
+                directory = self._value()
+                for result in directory['files']:
+                    yield directory['dir_name'], result
+            trailing = {}
+            self._read_members(trailing)
+            for key, value in trailing.items():
+                (self.totals if key in self.TOTAL_KEYS else self.header)[key] = value
+        else:
+            for line in self._file:
+                record = json.loads(line)
+                record_type = record.pop('type')
+                if record_type == 'file':
+                    yield record.pop('dir_name'), record
+                elif record_type == 'summary':
+                    self.totals.update(record)
+
+    def _fill(self, size: int = 0) -> bool:
+        """Append at least size more characters of a JSON file to the buffer; False at the end"""
+        if self._pos:
+            self._buffer = self._buffer[self._pos:]
+            self._pos = 0
+        chunk = self._file.read(max(size, self.JSON_CHUNK))
+        self._buffer += chunk
+        return bool(chunk)
+
+    def _peek(self) -> str:
+        """Next non-whitespace character of a JSON file ('' at the end)"""
+        while True:
+            self._pos = self._whitespace.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer) or not self._fill():
+                return self._buffer[self._pos:self._pos + 1]
+
+    def _expect(self, char: str):
+        """Consume char from a JSON file"""
+        if self._peek() != char:
+            raise ValueError(f"{self.path}: expected {char!r} at the top level of the JSON output")
+        self._pos += 1
+
+    def _value(self):
+        """Decode the next value of a JSON file, reading more of it as needed"""
+        if not self._peek():
+            raise ValueError(f"{self.path}: unexpected end of file in the JSON output")
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+                # A value ending with the buffer (a number) may continue in the next chunk
+                if end < len(self._buffer):
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                pass
+            # Read at least as much again as is buffered, so retries stay linear
+            if not self._fill(len(self._buffer) - self._pos):
+                # Nothing more to read: decode what there is, or raise
+                value, self._pos = self._decoder.raw_decode(self._buffer, self._pos)
+                return value
+
+    def _read_members(self, target: Dict) -> bool:
+        """
+        Read "key": value members of the top-level JSON object into target
+
+        Returns:
+            True once directories[] has been opened, False at the end of the object
+        """
+        while True:
+            char = self._peek()
+            if char == '}':
+                self._pos += 1
+                return False
+            if char == ',':
+                self._pos += 1
+                continue
+            if char != '"':
+                raise ValueError(f"{self.path}: unexpected {repr(char) if char else 'end of file'} in the JSON output")
+            key = self._value()
+            self._expect(':')
+            if key == 'directories':
+                self._expect('[')
+                return True
+            target[key] = self._value()
+
+    def close(self):
+        """Close the underlying file"""
+        if self._manifest is not None:
+            self._manifest.close()
+        if self._file is not None:
+            self._file.close()
+
+
+def convert_manifest(src: str, dst: str, output_format: str, compact: bool = False) -> int:
+    """
+    Convert an output file between the JSON, NDJSON and binary formats
+
+    Args:
+        src: Input file (any format)
+        dst: Output file
+        output_format: 'json', 'ndjson' or 'binary'
+        compact: Write JSON without indentation
+
+    Returns:
+        Number of file records converted
+    """
+    count = 0
+    with ManifestReader(src) as reader:
+        writer = open_writer(dst, output_format, compact)
+        writer.begin(reader.header)
+        for dir_name, result in reader:
+            writer.write(dir_name, result)
+            count += 1
+        writer.end(reader.totals)
+    return count
+
+
+def complete_manifest(src: str, dst: str, output_format: str, hasher: 'FileHasher', compact: bool = False,
+                      paths: Optional[List[str]] = None) -> Dict:
+    """
+    Upgrade the quick fingerprints of a --mode quick output file to full digests
+
+    Entries are copied in order; quick entries are rehashed with the
+    hasher's algorithms (which should match the manifest's) on a pool of
+    hasher.num_threads threads. Entries that cannot be read are kept as
+    quick fingerprints.
+
+    Args:
+        src: Output file of a quick scan (JSON or NDJSON)
+        dst: Output file
+        output_format: 'json' or 'ndjson'
+        hasher: FileHasher used for _hash_file
+        compact: Write JSON without indentation
+        paths: Only upgrade these files (default: all quick entries)
+
+    Returns:
+        Totals of the new file
+    """
+    wanted = set(os.path.abspath(p) for p in paths) if paths else None
+    window = max(1, hasher.num_threads) * 16
+
+    with ManifestReader(src) as reader, ThreadPoolExecutor(max_workers=hasher.num_threads) as pool:
+        header = dict(reader.header)
+        if wanted is None:
+            header.pop('scan_mode', None)
+            header.pop('quick_sample_size', None)
+        header['completed_date'] = datetime.utcnow().isoformat() + 'Z'
+        writer = open_writer(dst, output_format, compact)
+        writer.begin(header)
+        counts = {'total_files': 0, 'quick_files': 0, 'upgraded': 0}
+
+        def flush(pending):
+            # pending holds (dir_name, result, future or None) in input order
+            for dir_name, result, future in pending:
+                digests = future.result() if future is not None else None
+                if digests is not None:
+                    result = make_result(result['file_name'], hasher.hash_algorithms, digests)
+                    counts['upgraded'] += 1
+                elif is_quick(result):
+                    counts['quick_files'] += 1
+                writer.write(dir_name, result)
+                counts['total_files'] += 1
+
+        pending = []
+        for dir_name, result in reader:
+            future = None
+            if is_quick(result) and (wanted is None or os.path.abspath(result['file_name']) in wanted):
+                future = pool.submit(hasher._hash_file, result['file_name'])
+            pending.append((dir_name, result, future))
+            if len(pending) >= window:
+                flush(pending)
+                pending = []
+        flush(pending)
+
+        totals = dict(reader.totals, total_files=counts['total_files'], quick_files=counts['quick_files'])
+        writer.end(totals)
+    return dict(totals, upgraded=counts['upgraded'])
+
+
+def _iter_run(path: str):
+    """Yield (dir_name, result) pairs from a sorted run file"""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            dir_name, result = json.loads(line)
+            yield dir_name, result
+
+
+def sort_manifest(src: str, dst: str, run_size: int = 500000) -> Dict:
+    """
+    Write a copy of an output file sorted by file_name (external merge sort)
+
+    Records are sorted in runs of run_size, spilled to temporary files next
+    to dst and merged, so memory is bounded by run_size records.
+
+    Args:
+        src: Output file (any format)
+        dst: Sorted NDJSON output
+        run_size: Records per in-memory sort run
+
+    Returns:
+        Totals (total_files, total_errors) of the source
+    """
+    runs = []
+    run_dir = os.path.dirname(os.path.abspath(dst))
+
+    def spill(buffer):
+        buffer.sort(key=lambda item: item[1]['file_name'])
+        fd, run_path = tempfile.mkstemp(prefix='.sort-run-', dir=run_dir)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            for item in buffer:
+                f.write(json.dumps(item, separators=(',', ':')) + '\n')
+        runs.append(run_path)
+
+    try:
+        with ManifestReader(src) as reader:
+            buffer = []
+            for dir_name, result in reader:
+                buffer.append((dir_name, result))
+                if len(buffer) >= run_size:
+                    spill(buffer)
+                    buffer = []
+            if buffer:
+                spill(buffer)
+            header = reader.header
+            totals = reader.totals
+
+        writer = NdjsonResultWriter(dst)
+        writer.begin(header)
+        for dir_name, result in heapq.merge(*[_iter_run(run) for run in runs],
+                                            key=lambda item: item[1]['file_name']):
+            writer.write(dir_name, result)
+        writer.end(totals)
+    finally:
+        for run in runs:
+            os.remove(run)
+    return totals
+
+
+def diff_manifests(old_path: str, new_path: str):
+    """
+    Streaming merge of two manifests sorted by file_name
+
+    Args:
+        old_path: Previous sorted manifest
+        new_path: Current sorted manifest
+
+    Yields:
+        (change, dir_name, result) with change 'added', 'modified' or
+        'removed'; removed entries carry the previous result
+    """
+    with ManifestReader(old_path) as old_reader, ManifestReader(new_path) as new_reader:
+        algorithms = new_reader.header['hash_algorithms']
+        old_iter = iter(old_reader)
+        new_iter = iter(new_reader)
+        old = next(old_iter, None)
+        new = next(new_iter, None)
+        while old is not None or new is not None:
+            if new is None or (old is not None and old[1]['file_name'] < new[1]['file_name']):
+                yield 'removed', old[0], old[1]
+                old = next(old_iter, None)
+            elif old is None or new[1]['file_name'] < old[1]['file_name']:
+                yield 'added', new[0], new[1]
+                new = next(new_iter, None)
+            else:
+                if not same_content(old[1], new[1], algorithms):
+                    yield 'modified', new[0], new[1]
+                old = next(old_iter, None)
+                new = next(new_iter, None)
+
+
+class DeltaState:
+    """
+    Keeps the previous scan's sorted manifest and turns scans into deltas
+
+    The state directory holds previous.ndjson (the last reported scan, sorted
+    by file_name) and state.json (scans since the last full snapshot). A
+    new snapshot becomes the baseline via commit() once it has been
+    reported, so a failed upload is covered again by the next delta.
+    """
+
+    def __init__(self, state_dir: str, full_every: int = 7):
+        """
+        Args:
+            state_dir: Directory for the baseline manifest and state file
+            full_every: Report a full snapshot every N scans
+        """
+        self.state_dir = state_dir
+        self.full_every = full_every
+        self.previous_path = os.path.join(state_dir, 'previous.ndjson')
+        self.pending_path = os.path.join(state_dir, 'pending.ndjson')
+        self.state_path = os.path.join(state_dir, 'state.json')
+        os.makedirs(state_dir, exist_ok=True)
+        self.state = {'since_full': 0}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, 'r') as f:
+                self.state = json.load(f)
+        self.pending_state = None
+
+    def prepare(self, output_path: str, delta_path: str, output_format: str = 'ndjson',
+                compact: bool = False) -> Tuple[str, bool]:
+        """
+        Compare a finished scan against the baseline
+
+        Args:
+            output_path: Output file of the scan
+            delta_path: Where to write the delta document
+            output_format: 'json' or 'ndjson' for the delta document
+            compact: Write JSON without indentation
+
+        Returns:
+            (path of the document to report, True if it is a delta)
+        """
+        totals = sort_manifest(output_path, self.pending_path)
+
+        with ManifestReader(self.pending_path) as current:
+            header = current.header
+        previous_header = None
+        if os.path.exists(self.previous_path):
+            with ManifestReader(self.previous_path) as previous:
+                previous_header = previous.header
+
+        full = (previous_header is None
+                or previous_header.get('hash_algorithms') != header.get('hash_algorithms')
+                or self.state.get('since_full', 0) + 1 >= self.full_every)
+        if full:
+            self.pending_state = {'since_full': 0}
+            print("Reporting full snapshot", file=sys.stderr)
+            return output_path, False
+
+        counts = {'added': 0, 'modified': 0, 'removed': 0}
+        writer = open_writer(delta_path, output_format, compact)
+        writer.begin(dict(header, delta=True, base_scan_date=previous_header.get('scan_date')))
+        for change, dir_name, result in diff_manifests(self.previous_path, self.pending_path):
+            writer.write(dir_name, dict(result, change=change))
+            counts[change] += 1
+        totals = dict(totals)
+        totals.update({f'files_{change}': count for change, count in counts.items()})
+        writer.end(totals)
+
+        self.pending_state = {'since_full': self.state.get('since_full', 0) + 1}
+        print(f"Delta: {counts['added']} added, {counts['modified']} modified, "
+              f"{counts['removed']} removed -> {delta_path}", file=sys.stderr)
+        return delta_path, True
+
+    def commit(self):
+        """Make the prepared snapshot the baseline for the next scan"""
+        if self.pending_state is None:
+            return
+        os.replace(self.pending_path, self.previous_path)
+        with open(self.state_path, 'w') as f:
+            json.dump(self.pending_state, f)
+        self.pending_state = None
+
+
+class HashSet:
+    """
+    Read-only, memory-mapped set of known digests (--match-db)
+
+    Layout (little-endian):
+        header      magic 'VBHS', version, digest size, digest count, Bloom
+                    filter size in bits and hash count, section offsets
+        metadata    u32 length + JSON (hash_algorithm, kind, name, sources)
+        fanout      65536 u64: number of digests whose first two bytes are
+                    <= the index
+        bloom       Bloom filter bits; the k probe positions come from the
+                    digest itself (h1 + i * h2 over its first 16 bytes)
+        table       sorted, unique raw digests
+
+    A lookup tests the Bloom filter (k bits in a filter of about 10 bits
+    per digest), so most misses never touch the table; the rest
+    binary-search the fanout range of the table in place. Build one with
+    'file_hasher.py build-match-db'.
+    """
+
+    MAGIC = b'VBHS'
+    VERSION = 1
+    HEADER = struct.Struct('<4sHHQQIQQQQ')
+    FANOUT_SIZE = 65536
+    KINDS = ('bad', 'good')
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path: Hash set file built by build_hash_set
+        """
+        self.path = path
+        self.file = open(path, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.digest_size, self.count, self.bloom_bits, self.bloom_hashes,
+         meta_off, self.fanout_off, self.bloom_off, self.table_off) = self.HEADER.unpack_from(self.mm, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError(f"{path} is not a version {self.VERSION} hash set")
+        meta_len, = struct.unpack_from('<I', self.mm, meta_off)
+        self.meta = json.loads(self.mm[meta_off + 4:meta_off + 4 + meta_len].decode('utf-8'))
+        self.algorithm = self.meta['hash_algorithm']
+        self.kind = self.meta['kind']
+        self.name = self.meta.get('name') or os.path.basename(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self) -> int:
+        return self.count
+
+    @staticmethod
+    def probes(digest: bytes, bits: int, hashes: int):
+        """Bloom filter bit positions of a digest"""
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:16], 'little') | 1
+        return [(h1 + i * h2) % bits for i in range(hashes)]
+
+    def may_contain(self, digest: bytes) -> bool:
+        """Bloom filter test: False means the digest is certainly not in the set"""
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:16], 'little') | 1
+        bits = self.bloom_bits
+        mm = self.mm
+        base = self.bloom_off
+        # Inlined probes(): about half the bits are set, so a miss usually
+        # stops after one or two probes
+        for i in range(self.bloom_hashes):
+            pos = (h1 + i * h2) % bits
+            if not mm[base + (pos >> 3)] >> (pos & 7) & 1:
+                return False
+        return True
+
+    def _search(self, digest: bytes) -> bool:
+        """Binary search the table slice of the digest's fanout bucket"""
+        bucket = int.from_bytes(digest[:2], 'big')
+        lo = struct.unpack_from('<Q', self.mm, self.fanout_off + 8 * (bucket - 1))[0] if bucket else 0
+        hi = struct.unpack_from('<Q', self.mm, self.fanout_off + 8 * bucket)[0]
+        size = self.digest_size
+        base = self.table_off
+        mm = self.mm
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = base + mid * size
+            current = mm[offset:offset + size]
+            if current < digest:
+                lo = mid + 1
+            elif current > digest:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def __contains__(self, digest: bytes) -> bool:
+        if len(digest) != self.digest_size:
+            return False
+        return self.may_contain(digest) and self._search(digest)
+
+    def contains_hex(self, hex_digest: str) -> bool:
+        """Look up a hex digest"""
+        try:
+            return bytes.fromhex(hex_digest) in self
+        except ValueError:
+            return False
+
+    def close(self):
+        """Unmap and close the file"""
+        self.mm.close()
+        self.file.close()
+
+
+def _iter_digest_run(path: str, size: int, block: int = 1024 * 1024):
+    """Yield the digests of a sorted run file"""
+    block -= block % size
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(block)
+            if not data:
+                return
+            for offset in range(0, len(data), size):
+                yield data[offset:offset + size]
+
+
+def build_hash_set(inputs: List[str], dst: str, algorithm: Optional[str] = None, kind: str = 'bad',
+                   name: Optional[str] = None, bits_per_entry: int = 10, run_size: int = 4000000) -> Dict:
+    """
+    Build a HashSet file from digest lists (external merge sort)
+
+    Each input line contributes the first hex string of the digest length,
+    so plain hash lists, sha256sum output and CSV exports (e.g. NSRL) all
+    work. Digests are sorted in runs of run_size, spilled to temporary files
+    next to dst and merged, so memory is bounded by run_size digests plus
+    the Bloom filter.
+
+    Args:
+        inputs: Text files ('-' for stdin)
+        dst: Output file
+        algorithm: Digest algorithm (default: inferred from the first digest)
+        kind: 'bad' (report matches) or 'good' (known-good files)
+        name: Name reported with matches (default: the file name of dst)
+        bits_per_entry: Bloom filter bits per digest
+        run_size: Digests per in-memory sort run
+
+    Returns:
+        Build statistics (hash_algorithm, digests, duplicates, bloom_bits,
+        bloom_hashes, false_positive_rate)
+    """
+    lengths = {digest_size(algo) * 2: algo for algo in ('md5', 'sha1', 'sha256', 'sha512')}
+    size = digest_size(algorithm) if algorithm else None
+    pattern = None
+    runs = []
+    run_dir = os.path.dirname(os.path.abspath(dst))
+    parsed = 0
+
+    def spill(buffer):
+        buffer.sort()
+        fd, run_path = tempfile.mkstemp(prefix='.hashset-run-', dir=run_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b''.join(buffer))
+        runs.append(run_path)
+
+    tmp_path = dst + '.tmp'
+    try:
+        buffer = []
+        for path in inputs:
+            f = sys.stdin.buffer if path == '-' else open(path, 'rb')
+            try:
+                for line in f:
+                    if pattern is None:
+                        if size is None:
+                            found = re.search(rb'(?<![0-9a-fA-F])(?:[0-9a-fA-F]{2}){16,64}(?![0-9a-fA-F])', line)
+                            if found is None or len(found.group()) not in lengths:
+                                continue
+                            algorithm = lengths[len(found.group())]
+                            size = digest_size(algorithm)
+                        pattern = re.compile(rb'(?<![0-9a-fA-F])[0-9a-fA-F]{%d}(?![0-9a-fA-F])' % (2 * size))
+                    stripped = line.strip()
+                    if len(stripped) != 2 * size:
+                        found = pattern.search(line)
+                        if found is None:
+                            continue
+                        stripped = found.group()
+                    try:
+                        buffer.append(bytes.fromhex(stripped.decode('ascii')))
+                    except (UnicodeDecodeError, ValueError):
+                        continue
+                    parsed += 1
+                    if len(buffer) >= run_size:
+                        spill(buffer)
+                        buffer = []
+            finally:
+                if f is not sys.stdin.buffer:
+                    f.close()
+        if size is None:
+            raise ValueError("No digests found in the input")
+        if buffer:
+            spill(buffer)
+            buffer = []
+
+        bloom_bits = max(64, parsed * bits_per_entry + 7) // 8 * 8
+        bloom_hashes = max(1, round(bits_per_entry * 0.693))
+        bloom = bytearray(bloom_bits // 8)
+        fanout = [0] * HashSet.FANOUT_SIZE
+        meta = json.dumps({
+            'hash_algorithm': algorithm,
+            'kind': kind,
+            'name': name or os.path.splitext(os.path.basename(dst))[0],
+            'sources': [os.path.basename(path) for path in inputs],
+            'built_date': datetime.utcnow().isoformat() + 'Z'
+        }).encode('utf-8')
+        meta_off = HashSet.HEADER.size
+        fanout_off = meta_off + 4 + len(meta)
+        bloom_off = fanout_off + 8 * HashSet.FANOUT_SIZE
+        table_off = bloom_off + len(bloom)
+
+        count = 0
+        previous = None
+        hash_range = range(bloom_hashes)
+        with open(tmp_path, 'wb') as out:
+            out.seek(table_off)
+            pending = []
+            for digest in heapq.merge(*[_iter_digest_run(run, size) for run in runs]):
+                if digest == previous:
+                    continue
+                previous = digest
+                pending.append(digest)
+                fanout[(digest[0] << 8) | digest[1]] += 1
+                # HashSet.probes(), inlined
+                h1 = int.from_bytes(digest[:8], 'little')
+                h2 = int.from_bytes(digest[8:16], 'little') | 1
+                for _ in hash_range:
+                    pos = h1 % bloom_bits
+                    bloom[pos >> 3] |= 1 << (pos & 7)
+                    h1 += h2
+                count += 1
+                if len(pending) >= 65536:
+                    out.write(b''.join(pending))
+                    pending = []
+            out.write(b''.join(pending))
+
+            for bucket in range(1, HashSet.FANOUT_SIZE):
+                fanout[bucket] += fanout[bucket - 1]
+            out.seek(0)
+            out.write(HashSet.HEADER.pack(HashSet.MAGIC, HashSet.VERSION, size, count, bloom_bits, bloom_hashes,
+                                          meta_off, fanout_off, bloom_off, table_off))
+            out.write(struct.pack('<I', len(meta)))
+            out.write(meta)
+            out.write(struct.pack(f'<{HashSet.FANOUT_SIZE}Q', *fanout))
+            out.write(bloom)
+        os.replace(tmp_path, dst)
+    finally:
+        for run in runs:
+            os.remove(run)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    false_positive_rate = (1 - math.exp(-bloom_hashes * count / bloom_bits)) ** bloom_hashes if count else 0.0
+    return {'hash_algorithm': algorithm, 'digests': count, 'duplicates': parsed - count,
+            'bloom_bits': bloom_bits, 'bloom_hashes': bloom_hashes, 'false_positive_rate': false_positive_rate}
+
+
+class HashMatcher:
+    """
+    Checks scan results against HashSets as they are produced
+
+    Matches in 'bad' sets are printed and appended to an NDJSON file right
+    away, one line per match. Files found in a 'good' set are counted and,
+    with drop_known_good, left out of the output and the upload. Called
+    from the aggregator thread.
+    """
+
+    def __init__(self, hash_sets: List[HashSet], algorithms: List[str], output_path: Optional[str] = None,
+                 drop_known_good: bool = False):
+        """
+        Args:
+            hash_sets: Opened hash sets
+            algorithms: Hash algorithms of the scan; each set's algorithm must be one of them
+            output_path: NDJSON file for matches in 'bad' sets
+            drop_known_good: Leave files found in 'good' sets out of the output
+        """
+        missing = sorted(set(hash_set.algorithm for hash_set in hash_sets) - set(algorithms))
+        if missing:
+            raise ValueError(f"The scan does not compute {', '.join(missing)} digests used by the match database")
+        self.hash_sets = hash_sets
+        self.algorithms = list(algorithms)
+        self.output_path = output_path
+        self.drop_known_good = drop_known_good
+        self.output = open(output_path, 'w', encoding='utf-8') if output_path else None
+        self.matched = 0
+        self.known_good = 0
+
+    def check(self, dir_name: str, result: Dict) -> bool:
+        """
+        Look up one file's digests
+
+        Returns:
+            False if the file is known-good and should be dropped
+        """
+        if is_quick(result):
+            return True
+        digests = result_digests(result, self.algorithms)
+        good = False
+        for hash_set in self.hash_sets:
+            hex_digest = digests[hash_set.algorithm]
+            if not hash_set.contains_hex(hex_digest):
+                continue
+            if hash_set.kind == 'good':
+                good = True
+                continue
+            self.matched += 1
+            print(f"MATCH [{hash_set.name}] {result['file_name']} {hash_set.algorithm}:{hex_digest}", file=sys.stderr)
+            if self.output is not None:
+                self.output.write(json.dumps({
+                    'type': 'match', 'match_db': hash_set.name, 'dir_name': dir_name,
+                    'file_name': result['file_name'], 'hash_algorithm': hash_set.algorithm,
+                    'file_hash': hex_digest, 'match_date': datetime.utcnow().isoformat() + 'Z'
+                }) + '\n')
+                self.output.flush()
+        if good:
+            self.known_good += 1
+            return not self.drop_known_good
+        return True
+
+    def totals(self) -> Dict:
+        """Counts for the output totals"""
+        return {'files_matched': self.matched, 'files_known_good': self.known_good}
+
+    def close(self):
+        """Close the match file and the hash sets"""
+        if self.output is not None:
+            self.output.close()
+            self.output = None
+        for hash_set in self.hash_sets:
+            hash_set.close()
+
+
+def parse_shard(text: str) -> Tuple[int, int]:
+    """Parse a shard spec 'I/N' (0 <= I < N)"""
+    index, _, count = text.partition('/')
+    index, count = int(index), int(count)
+    if not 0 <= index < count:
+        raise ValueError(f"Shard index must be in 0..{count - 1}: {text}")
+    return index, count
+
+
+def parse_size(text: str) -> int:
+    """Parse a byte count with an optional K, M, G or T (binary) suffix"""
+    units = 'KMGT'
+    suffix = text[-1:].upper()
+    if suffix in units:
+        return int(float(text[:-1]) * 1024 ** (units.index(suffix) + 1))
+    return int(text)
+
+
+def read_paths(stream, block_size: int = 1024 * 1024):
+    """
+    Yield the paths of a NUL- or newline-delimited list (find -print0 / find -print)
+
+    The list is NUL-delimited if its first block contains a NUL. Paths are
+    decoded like os.listdir() names, so undecodable bytes survive the round
+    trip. Blocks are handed on as soon as they arrive, so hashing starts
+    while the producer (e.g. find) is still running.
+
+    Args:
+        stream: Binary file object (sys.stdin.buffer or an open list file)
+        block_size: Maximum bytes read at a time
+    """
+    read = getattr(stream, 'read1', stream.read)
+    sep = None
+    rest = b''
+    while True:
+        block = read(block_size)
+        if not block:
+            break
+        if sep is None:
+            sep = b'\0' if b'\0' in block else b'\n'
+        parts = (rest + block).split(sep)
+        rest = parts.pop()
+        for part in parts:
+            if part:
+                yield os.fsdecode(part)
+    if rest:
+        yield os.fsdecode(rest)
+
+
+def shard_of(path: str, count: int) -> int:
+    """Shard of a path, the same on every host and Python process"""
+    return int.from_bytes(hashlib.blake2b(os.fsencode(path), digest_size=8).digest(), 'big') % count
+
+
+def _merged_header(headers: List[Dict]) -> Dict:
+    """Header of a merged report, checked for consistency across the shard headers"""
+    algorithms = headers[0].get('hash_algorithms')
+    for header in headers:
+        if header.get('delta'):
+            raise ValueError("Delta documents cannot be merged; merge the full shard manifests")
+        if header.get('hash_algorithms') != algorithms:
+            raise ValueError(f"Inputs were hashed with different algorithms: "
+                             f"{algorithms} and {header.get('hash_algorithms')}")
+
+    merged = {k: v for k, v in headers[0].items() if k not in ('shard', 'shard_by')}
+    merged['scan_date'] = min(header.get('scan_date', '') for header in headers) or merged.get('scan_date')
+    systems = sorted(set(header.get('system_name') for header in headers if header.get('system_name')))
+    if len(systems) > 1:
+        merged['merged_systems'] = systems
+    if any(header.get('scan_mode') == 'quick' for header in headers):
+        merged['scan_mode'] = 'quick'
+
+    shards = [parse_shard(header['shard']) for header in headers if header.get('shard')]
+    if shards:
+        counts = set(count for _, count in shards)
+        if len(counts) > 1:
+            raise ValueError(f"Inputs come from different shard counts: {sorted(counts)}")
+        count = counts.pop()
+        merged['shard_count'] = count
+        merged['shard_by'] = headers[0].get('shard_by')
+        missing = sorted(set(range(count)) - set(index for index, _ in shards))
+        if missing:
+            merged['shards_missing'] = missing
+            print(f"Warning: shards {', '.join(map(str, missing))} of {count} are missing", file=sys.stderr)
+    merged['merged_date'] = datetime.utcnow().isoformat() + 'Z'
+    return merged
+
+
+def merge_manifests(inputs: List[str], dst: str, output_format: str = 'json', compact: bool = False) -> Dict:
+    """
+    Combine the manifests of a sharded scan into one report
+
+    Each input is sorted by file_name first (sort_manifest, spilling runs
+    next to dst), then the sorted copies are combined with a streaming
+    k-way merge, so memory does not grow with the number of files. A file
+    present in more than one input (overlapping roots) is written once.
+    total_files and quick_files are counted from the merged records;
+    total_errors and the match counts are summed over the inputs.
+
+    Args:
+        inputs: Shard output files (any format)
+        dst: Merged output file
+        output_format: 'json', 'ndjson' or 'binary'
+        compact: Write JSON without indentation
+
+    Returns:
+        Totals of the merged report, plus the number of duplicates dropped
+    """
+    run_dir = os.path.dirname(os.path.abspath(dst))
+    sorted_paths = []
+    readers = []
+    summed = {'total_errors': 0}
+    try:
+        headers = []
+        for path in inputs:
+            fd, sorted_path = tempfile.mkstemp(prefix='.merge-', suffix='.ndjson', dir=run_dir)
+            os.close(fd)
+            sorted_paths.append(sorted_path)
+            totals = sort_manifest(path, sorted_path)
+            for key in ('total_errors', 'files_matched', 'files_known_good'):
+                if key in totals:
+                    summed[key] = summed.get(key, 0) + totals[key]
+            readers.append(ManifestReader(sorted_path))
+            headers.append(readers[-1].header)
+        header = _merged_header(headers)
+
+        writer = open_writer(dst, output_format, compact)
+        writer.begin(header)
+        files = quick = duplicates = 0
+        previous = None
+        for dir_name, result in heapq.merge(*readers, key=lambda item: item[1]['file_name']):
+            if result['file_name'] == previous:
+                duplicates += 1
+                continue
+            previous = result['file_name']
+            writer.write(dir_name, result)
+            files += 1
+            if is_quick(result):
+                quick += 1
+        totals = dict(total_files=files, **summed)
+        if header.get('scan_mode') == 'quick':
+            totals['quick_files'] = quick
+        writer.end(totals)
+    finally:
+        for reader in readers:
+            reader.close()
+        for sorted_path in sorted_paths:
+            os.remove(sorted_path)
+    return dict(totals, duplicates=duplicates)
+
+
+def open_writer(path: str, output_format: str = 'json', compact: bool = False) -> ResultWriter:
+    """
+    Create a result writer
+
+    Args:
+        path: Output file path
+        output_format: 'json', 'ndjson' or 'binary'
+        compact: Write JSON without indentation
+
+    Returns:
+        ResultWriter for the format
+    """
+    if output_format == 'binary':
+        return BinaryManifestWriter(path)
+    if output_format == 'ndjson':
+        return NdjsonResultWriter(path)
+    if output_format == 'json':
+        return JsonResultWriter(path, compact=compact)
+    raise ValueError(f"Unsupported output format: {output_format}")
+
+
+class _DirProgress:
+    """Completion state of one directory during a checkpointed scan"""
+
+    __slots__ = ('parent', 'pending', 'listed', 'children', 'files', 'errors')
+
+    def __init__(self, parent: Optional[str] = None):
+        self.parent = parent
+        self.pending = 0
+        self.listed = False
+        self.children = ()
+        self.files = 0
+        self.errors = 0
+
+
+class ScanCheckpoint:
+    """
+    Tracks which subtrees of a scan are finished and saves them periodically
+
+    A directory is finished once it has been listed, every file emitted from
+    it has reached the aggregator and all of its subdirectories are
+    finished. completed maps the top of each finished subtree to its
+    [files, errors] counts; the subtrees of a finished directory are folded
+    into it, so the map stays small.
+
+    The checkpoint file pairs completed with the writer position from
+    ResultWriter.sync(). Every record of a completed subtree lies before
+    that position, so a resumed scan copies those records from the previous
+    output and walks only what is left. Unfinished directories are scanned
+    again from scratch.
+    """
+
+    VERSION = 1
+
+    # Seconds between saves when a resumed scan does not set --checkpoint-interval
+    DEFAULT_INTERVAL = 60.0
+
+    def __init__(self, path: str, scan: Dict, interval: float = DEFAULT_INTERVAL):
+        """
+        Args:
+            path: Checkpoint file, normally <output>.checkpoint
+            scan: Scan parameters a resumed scan has to match (roots, algorithms, format, ...)
+            interval: Seconds between saves
+        """
+        self.path = path
+        self.scan = scan
+        self.interval = interval
+        self.token = uuid.uuid4().hex
+        self.completed = {}
+        # State of the scan being resumed, set by load()
+        self.skip = frozenset()
+        self.resumed_from = None
+        self.writer_state = None
+        self.finalized = False
+        self.carried_errors = 0
+        self._nodes = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str, scan: Dict, interval: float = 60.0) -> 'ScanCheckpoint':
+        """
+        Read the checkpoint of an interrupted scan to resume it
+
+        Raises:
+            ValueError: The checkpoint is unreadable or belongs to a different scan
+        """
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except OSError as e:
+            raise ValueError(f"Cannot read checkpoint {path}: {e}")
+        except ValueError:
+            raise ValueError(f"Checkpoint {path} is corrupt")
+        if data.get('version') != cls.VERSION:
+            raise ValueError(f"Checkpoint {path} has unsupported version {data.get('version')}")
+        if data.get('scan') != scan:
+            raise ValueError(f"Checkpoint {path} was written by a scan with different roots or options")
+
+        checkpoint = cls(path, scan, interval)
+        checkpoint.completed = {dir_name: counts for dir_name, counts in data['completed'].items()}
+        checkpoint.skip = frozenset(checkpoint.completed)
+        checkpoint.resumed_from = data['token']
+        checkpoint.writer_state = data['writer']
+        checkpoint.finalized = data['finalized']
+        checkpoint.carried_errors = sum(errors for _, errors in checkpoint.completed.values())
+        return checkpoint
+
+    def is_completed(self, dir_name: str) -> bool:
+        """Whether dir_name lies in a subtree finished by the scan being resumed"""
+        while dir_name not in self.skip:
+            parent = os.path.dirname(dir_name)
+            if parent == dir_name:
+                return False
+            dir_name = parent
+        return True
+
+    def _node(self, dir_path: str) -> _DirProgress:
+        node = self._nodes.get(dir_path)
+        if node is None:
+            node = self._nodes[dir_path] = _DirProgress()
+        return node
+
+    def _settle(self, dir_path: str, node: _DirProgress):
+        """Mark finished directories complete, walking up while parents finish too"""
+        while node.listed and node.pending == 0:
+            files, errors = node.files, node.errors
+            for child in node.children:
+                counts = self.completed.pop(child, None)
+                if counts is not None:
+                    files += counts[0]
+                    errors += counts[1]
+            self.completed[dir_path] = [files, errors]
+            del self._nodes[dir_path]
+            if node.parent is None:
+                return
+            dir_path = node.parent
+            node = self._nodes[dir_path]
+            node.pending -= 1
+
+    def listed(self, dir_path: str, files: int, subdirs: List[str]):
+        """
+        Walker: dir_path has been listed
+
+        Args:
+            dir_path: Directory path
+            files: Number of files emitted from it
+            subdirs: Subdirectories queued for walking
+        """
+        with self._lock:
+            node = self._node(dir_path)
+            node.listed = True
+            node.pending += files + len(subdirs)
+            node.children = subdirs
+            for subdir in subdirs:
+                self._nodes[subdir] = _DirProgress(dir_path)
+            self._settle(dir_path, node)
+
+    def done(self, items: List[Tuple[str, Union[Dict, bool, None], int]]):
+        """
+        Aggregator: a batch of (dirpath, result, tier) items was handled
+
+        None results are errors; False marks a file skipped because it is no
+        longer a regular file, which counts as neither.
+        """
+        with self._lock:
+            for dir_path, result, _ in items:
+                node = self._node(dir_path)
+                node.pending -= 1
+                if result is None:
+                    node.errors += 1
+                elif result:
+                    node.files += 1
+                self._settle(dir_path, node)
+
+    def save(self, writer_state: Dict, finalized: bool = False):
+        """
+        Write the checkpoint file (atomically)
+
+        Args:
+            writer_state: ResultWriter.sync() state matching the completed subtrees
+            finalized: The output was closed as a partial manifest
+        """
+        with self._lock:
+            completed = dict(self.completed)
+        data = {
+            'version': self.VERSION,
+            'token': self.token,
+            'saved': datetime.utcnow().isoformat() + 'Z',
+            'scan': self.scan,
+            'writer': writer_state,
+            'finalized': finalized,
+            'completed': completed
+        }
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        """Delete the checkpoint file once the scan has completed"""
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class _CounterShard:
+    """Scan counters of one thread; only that thread updates them"""
+
+    __slots__ = ('files', 'errors', 'reused', 'hardlinks', 'quick')
+
+    def __init__(self):
+        self.files = 0
+        self.errors = 0
+        self.reused = 0
+        self.hardlinks = 0
+        self.quick = 0
+
+
+class _DeferredFiles:
+    """
+    Files put off until the walk is complete, spooled to a temporary file
+
+    In budget mode the walker defers files of no particular interest so the
+    hashing workers see the priority files first. Each directory's deferred
+    names are appended as one block, so memory use does not grow with the
+    number of deferred files.
+    """
+
+    BLOCK = struct.Struct('<III')
+    NAME = struct.Struct('<H')
+
+    def __init__(self):
+        self.count = 0
+        self._file = tempfile.TemporaryFile(prefix='file_hasher-deferred-')
+        self._devices = []
+        self._device_ids = {}
+        self._lock = threading.Lock()
+
+    def add(self, dirpath: str, device, names: List[str]):
+        """Defer the named files of one directory"""
+        dir_bytes = os.fsencode(dirpath)
+        parts = []
+        for name in names:
+            name_bytes = os.fsencode(name)
+            parts.append(self.NAME.pack(len(name_bytes)))
+            parts.append(name_bytes)
+        with self._lock:
+            device_id = self._device_ids.get(device)
+            if device_id is None:
+                device_id = self._device_ids[device] = len(self._devices)
+                self._devices.append(device)
+            self._file.write(self.BLOCK.pack(device_id, len(dir_bytes), len(names)) + dir_bytes + b''.join(parts))
+            self.count += len(names)
+
+    def __iter__(self):
+        """Yield (dirpath, device, names) blocks in the order they were deferred"""
+        f = self._file
+        f.seek(0)
+        while True:
+            header = f.read(self.BLOCK.size)
+            if not header:
+                return
+            device_id, dir_len, count = self.BLOCK.unpack(header)
+            dirpath = os.fsdecode(f.read(dir_len))
+            names = []
+            for _ in range(count):
+                name_len, = self.NAME.unpack(f.read(self.NAME.size))
+                names.append(os.fsdecode(f.read(name_len)))
+            yield dirpath, self._devices[device_id], names
+
+    def close(self):
+        """Delete the spool"""
+        self._file.close()
+
+
+# Marker for directories the walker must not descend into
+_SKIP = object()
+
+# Open flag that skips atime updates (Linux only)
+_O_NOATIME = getattr(os, 'O_NOATIME', 0)
+
+# Whether lseek can report the holes of sparse files
+_SEEK_HOLES = hasattr(os, 'SEEK_DATA') and hasattr(os, 'SEEK_HOLE')
+
+# Shared zero-filled block fed to the hashers for the holes of sparse files
+_ZERO_BLOCK = memoryview(bytes(1024 * 1024))
+
+
+class FileHasher:
+    """High-performance multi-threaded file hasher"""
+
+    # Directories to skip (OS-specific)
+    SKIP_DIRS = {
+        'linux': {'/proc', '/sys', '/dev', '/run', '/tmp'},
+        'darwin': {'/dev', '/private/tmp', '/private/var/tmp', '/Volumes'},
+        'windows': {'C:\\$Recycle.Bin', 'C:\\Windows\\Temp', 'C:\\Temp'},
+        'freebsd': {'/proc', '/dev', '/tmp'},
+        'openbsd': {'/proc', '/dev', '/tmp'},
+        'netbsd': {'/proc', '/dev', '/tmp'}
+    }
+
+    # Hashed first in budget mode, along with the directories on PATH
+    PRIORITY_DIRS = {
+        'linux': {'/etc', '/bin', '/sbin', '/usr/bin', '/usr/sbin', '/usr/local/bin', '/usr/local/sbin'},
+        'darwin': {'/private/etc', '/bin', '/sbin', '/usr/bin', '/usr/sbin', '/usr/local/bin', '/usr/local/sbin'},
+        'windows': {'C:\\Windows\\System32', 'C:\\Windows\\SysWOW64'},
+        'freebsd': {'/etc', '/bin', '/sbin', '/usr/bin', '/usr/sbin', '/usr/local/bin', '/usr/local/sbin',
+                    '/usr/local/etc'},
+        'openbsd': {'/etc', '/bin', '/sbin', '/usr/bin', '/usr/sbin', '/usr/local/bin', '/usr/local/sbin'},
+        'netbsd': {'/etc', '/bin', '/sbin', '/usr/bin', '/usr/sbin', '/usr/pkg/bin', '/usr/pkg/sbin'}
+    }
+
+    # Budget mode tiers: files under PRIORITY_DIRS, executable or recently
+    # modified files, everything else
+    TIERS = ('priority_dirs', 'exec_or_recent', 'other')
+
+    # Results per result queue item from a hashing worker
+    RESULT_BATCH = 64
+
+    # Seconds a scan stopped by its budget keeps collecting files already being
+    # hashed; with a deadline, at most STOP_GRACE_SHARE of it, taken from the deadline
+    STOP_GRACE = 5.0
+    STOP_GRACE_SHARE = 0.1
+
+    # Read-ahead ring shared by the per-algorithm threads of _feed_parallel
+    RING_SLOTS = 4
+    RING_SLOT_SIZE = 1024 * 1024
+
+    def __init__(self, root_paths: List[str], num_threads: int = 32, chunk_size: int = 65536, hash_algorithms: List[str] = None,
+                 queue_size: Optional[int] = None, walk_threads: Optional[int] = None,
+                 index: Optional[HashIndex] = None, full_rehash: bool = False,
+                 worker_mode: str = 'threads', num_processes: Optional[int] = None, batch_size: int = 256,
+                 mmap_threshold: int = 64 * 1024 * 1024, dedup_hardlinks: bool = True,
+                 one_file_system: bool = False, include_network_fs: bool = False,
+                 skip_fs_types: Optional[List[str]] = None, hdd_threads: int = 2, network_threads: int = 4,
+                 mode: str = 'full', quick_sample: int = 64 * 1024,
+                 full_for: Optional[List[str]] = None, recent_days: float = 7.0,
+                 throttle: Optional[IoThrottle] = None, fadvise: bool = True,
+                 parallel_digest_threshold: int = 16 * 1024 * 1024,
+                 metrics_interval: float = 10.0, metrics_path: Optional[str] = None,
+                 prometheus_path: Optional[str] = None, matcher: Optional[HashMatcher] = None,
+                 shard: Optional[Tuple[int, int]] = None, shard_by: str = 'dir',
+                 checkpoint: Optional[ScanCheckpoint] = None, deadline: Optional[float] = None,
+                 max_bytes: Optional[int] = None, priority: Optional[bool] = None,
+                 files: Optional[Iterable[str]] = None, files_dir_name: Optional[str] = None):
+        """
+        Initialize the file hasher
+
+        Args:
+            root_paths: List of root directories to scan
+            num_threads: Number of worker threads
+            chunk_size: File read chunk size in bytes
+            hash_algorithms: List of hash algorithms to use (names in HASH_ALGORITHMS)
+            queue_size: Capacity of the work and result queues (default: 4 per thread)
+            walk_threads: Number of directory walker threads (default: min(threads, 8))
+            index: Persistent hash index used to skip unchanged files
+            full_rehash: Hash every file even if the index has its digests
+            worker_mode: 'threads' (one thread pool) or 'processes' (a pool of
+                processes sharing num_threads threads between them)
+            num_processes: Number of worker processes (default: CPU count)
+            batch_size: Number of files sent to a worker process at a time
+            mmap_threshold: Files of at least this many bytes are hashed through
+                mmap instead of read buffers (0 disables mmap)
+            dedup_hardlinks: Hash each multiply-linked inode once and report
+                later links with hardlink_of
+            one_file_system: Do not descend into other mounted filesystems
+            include_network_fs: Descend into network filesystems (NFS, CIFS, ...)
+            skip_fs_types: Extra filesystem types to skip (default: pseudo filesystems)
+            hdd_threads: Concurrent workers per rotational disk
+            network_threads: Concurrent workers per network filesystem (always
+                fewer than num_threads, so a slow mount cannot take every worker)
+            mode: 'full' hashes every file; 'quick' records a fingerprint of the
+                size, first, middle and last quick_sample bytes instead
+            quick_sample: Bytes read from each sampled region in quick mode
+            full_for: Files that still get full digests in quick mode:
+                'exec' (any execute bit) and/or 'recent' (modified within recent_days)
+            recent_days: Age limit for 'recent'
+            throttle: Rate limits and iowait backoff applied to every file read
+            fadvise: Advise the kernel of sequential reads and drop each file
+                from the page cache once hashed (posix_fadvise)
+            parallel_digest_threshold: With several hash algorithms, hash files of
+                at least this many bytes with one thread per algorithm; 0 disables
+            metrics_interval: Seconds between progress reports during scan()
+            metrics_path: Append metrics as JSON lines here ('-' for stderr)
+            prometheus_path: Keep a Prometheus textfile-collector file here
+            matcher: Check every result against local hash sets (--match-db)
+            shard: (index, count) to hash only this shard's part of the roots
+            shard_by: 'dir' (each directory's files by a hash of its path) or
+                'top' (whole top-level directories under each root)
+            checkpoint: Track finished subtrees and save them periodically, and
+                close the output as a partial manifest when interrupted
+            deadline: Stop the scan after this many seconds
+            max_bytes: Stop the scan once this many bytes have been hashed
+            priority: Hash the TIERS in order: walk PRIORITY_DIRS and PATH first
+                and put off other files until the walk is done (default: on
+                when a budget is set)
+            files: Hash these paths instead of walking root_paths (--files,
+                --files-from); the iterable is consumed as the scan runs
+            files_dir_name: Report listed files under this dir_name instead
+                of their directory ('specified_files' for --files)
+        """
+        self.root_paths = root_paths
+        self.num_threads = num_threads
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size or num_threads * 4
+        self.walk_threads = walk_threads or min(num_threads, 8)
+        self.walk_stats = {'dirs': 0, 'entries': 0, 'seconds': 0.0}
+        self.hash_algorithms = hash_algorithms or ['sha512']
+        self.results = ResultStore(self.hash_algorithms)
+        self.lock = threading.Lock()
+        self._shards = []
+        self.hardlinks = HardlinkTable() if dedup_hardlinks else None
+        self.writer = None
+        self.index = index
+        self.full_rehash = full_rehash
+        self.worker_mode = worker_mode
+        self.num_processes = num_processes or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.mmap_threshold = mmap_threshold
+        self._local = threading.local()
+        self.os_type = self._detect_os()
+        self.skip_dirs = self._get_skip_dirs()
+        self.one_file_system = one_file_system
+        self.include_network_fs = include_network_fs
+        self.skip_fs_types = MountTable.PSEUDO_FS_TYPES | set(skip_fs_types or [])
+        self.hdd_threads = hdd_threads
+        self.network_threads = network_threads
+        self.mode = mode
+        self.quick_sample = quick_sample
+        self.full_for = set(full_for if full_for is not None else ['exec', 'recent'])
+        self.recent_seconds = recent_days * 86400
+        self.throttle = throttle
+        self._tree_pool = None
+        self.parallel_digest_threshold = parallel_digest_threshold
+        self.metrics = ScanMetrics()
+        self.metrics_interval = metrics_interval
+        self.metrics_path = metrics_path
+        self.prometheus_path = prometheus_path
+        self.matcher = matcher
+        self.shard = shard
+        self.shard_by = shard_by
+        self.checkpoint = checkpoint
+        self.deadline = deadline
+        self.max_bytes = max_bytes
+        self.priority = priority if priority is not None else bool(deadline or max_bytes)
+        self.files = files
+        self.files_dir_name = files_dir_name
+        self.stopped_by = None
+        self._stopped = False
+        self._stop_event = None
+        self._walk_complete = False
+        self._tier_found = [0] * len(self.TIERS)
+        self._tier_hashed = [0] * len(self.TIERS)
+        self._walk_pending = None
+        self._result_queue = None
+        self._queued_files = 0
+        self.fadvise = fadvise and hasattr(os, 'posix_fadvise')
+        self.mounts = MountTable.load() if self.os_type == 'linux' else None
+        self._scheduler = None
+
+    def _counters(self) -> '_CounterShard':
+        """This thread's counter shard (registered on first use)"""
+        counters = getattr(self._local, 'counters', None)
+        if counters is None:
+            counters = _CounterShard()
+            with self.lock:
+                self._shards.append(counters)
+            self._local.counters = counters
+        return counters
+
+    def _total(self, field: str) -> int:
+        """Sum of one counter over all thread shards"""
+        with self.lock:
+            shards = list(self._shards)
+        return sum(getattr(counters, field) for counters in shards)
+
+    @property
+    def file_count(self) -> int:
+        """Files hashed or reused"""
+        return self._total('files')
+
+    @property
+    def error_count(self) -> int:
+        """Files that could not be read"""
+        return self._total('errors')
+
+    @property
+    def reused_count(self) -> int:
+        """Files whose digests came from the index"""
+        return self._total('reused')
+
+    @property
+    def hardlink_count(self) -> int:
+        """Files whose digests came from an earlier hardlink"""
+        return self._total('hardlinks')
+
+    @property
+    def quick_count(self) -> int:
+        """Files recorded with a quick fingerprint"""
+        return self._total('quick')
+
+    def _detect_os(self) -> str:
+        """Detect operating system"""
+        system = platform.system().lower()
+        if system == 'linux':
+            return 'linux'
+        elif system == 'darwin':
+            return 'darwin'
+        elif system == 'windows':
+            return 'windows'
+        elif 'bsd' in system:
+            return system
+        return 'unknown'
+
+    def _get_skip_dirs(self) -> set:
+        """Get directories to skip based on OS"""
+        return self.SKIP_DIRS.get(self.os_type, set())
+
+    def _should_skip_dir(self, dir_path: str) -> bool:
+        """Check if directory should be skipped"""
+        for skip_dir in self.skip_dirs:
+            if dir_path.startswith(skip_dir):
+                return True
+        return False
+
+    def _shard_key(self, dir_path: str) -> str:
+        """Path whose hash decides the shard of the files in a directory"""
+        if self.shard_by != 'top':
+            return dir_path
+        for root in self.root_paths:
+            if dir_path == root:
+                return root
+            prefix = os.path.join(root, '')
+            if dir_path.startswith(prefix):
+                return prefix + dir_path[len(prefix):].split(os.sep, 1)[0]
+        return dir_path
+
+    def _in_shard(self, dir_path: str) -> bool:
+        """Whether the files directly in a directory belong to this shard"""
+        if self.shard is None:
+            return True
+        index, count = self.shard
+        return shard_of(self._shard_key(dir_path), count) == index
+
+    def _descend_shard(self, subdir: str, dir_path: str) -> bool:
+        """Whether a subdirectory can hold files of this shard (with shard_by 'top')"""
+        if self.shard is None or self.shard_by != 'top' or dir_path not in self.root_paths:
+            return True
+        index, count = self.shard
+        return shard_of(subdir, count) == index
+
+    def _priority_paths(self) -> Tuple[set, set]:
+        """
+        Directories hashed first in budget mode, and the directories leading to them
+
+        Returns:
+            (PRIORITY_DIRS plus the absolute PATH entries, their ancestors)
+        """
+        dirs = set(self.PRIORITY_DIRS.get(self.os_type, ()))
+        for path_dir in os.environ.get('PATH', '').split(os.pathsep):
+            if os.path.isabs(path_dir):
+                dirs.add(os.path.normpath(path_dir))
+        ancestors = set()
+        for dir_path in dirs:
+            parent = os.path.dirname(dir_path)
+            while parent != dir_path:
+                ancestors.add(parent)
+                dir_path, parent = parent, os.path.dirname(parent)
+        return dirs, ancestors
+
+    def _in_priority_dir(self, dir_path: str, priority_dirs: set) -> bool:
+        """Whether dir_path is one of priority_dirs or lies below one"""
+        while dir_path not in priority_dirs:
+            parent = os.path.dirname(dir_path)
+            if parent == dir_path:
+                return False
+            dir_path = parent
+        return True
+
+    def _file_tier(self, entry: os.DirEntry, recent_cutoff: float) -> int:
+        """Tier of a file outside PRIORITY_DIRS: 1 if executable or recently modified, else 2"""
+        try:
+            st = entry.stat(follow_symlinks=False)
+        except OSError:
+            return 2
+        return 1 if st.st_mode & 0o111 or st.st_mtime >= recent_cutoff else 2
+
+    def _stop_grace(self) -> float:
+        """Seconds a budget stop keeps collecting files already being hashed"""
+        if self.deadline:
+            return min(self.STOP_GRACE, self.deadline * self.STOP_GRACE_SHARE)
+        return self.STOP_GRACE
+
+    def _budget_exhausted(self) -> Optional[str]:
+        """
+        'deadline' once only the stop grace is left of the deadline, 'max_bytes'
+        once that budget is used up, else None
+        """
+        if self.deadline and time.time() - self.metrics.start >= self.deadline - self._stop_grace():
+            return 'deadline'
+        if self.max_bytes and self.metrics.bytes_read() >= self.max_bytes:
+            return 'max_bytes'
+        return None
+
+    def coverage(self) -> Dict:
+        """How much of the roots a budgeted scan got through, per tier"""
+        tiers = {
+            name: {'found': found, 'hashed': hashed}
+            for name, found, hashed in zip(self.TIERS, self._tier_found, self._tier_hashed)
+        }
+        return {
+            'elapsed_seconds': round(time.time() - self.metrics.start, 3),
+            'bytes_hashed': self.metrics.bytes_read(),
+            'walk_complete': self._walk_complete,
+            'dirs_walked': self.walk_stats['dirs'],
+            'files_found': sum(self._tier_found),
+            'files_hashed': sum(self._tier_hashed),
+            'tiers': tiers
+        }
+
+    def _get_hostname(self) -> str:
+        """Get system hostname"""
+        try:
+            return socket.gethostname()
+        except Exception:
+            return "unknown"
+
+    def _get_local_ip(self) -> str:
+        """Get local IP address"""
+        try:
+            # Create a socket to determine local IP
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.connect(("8.8.8.8", 80))
+            ip = s.getsockname()[0]
+            s.close()
+            return ip
+        except Exception:
+            return "127.0.0.1"
+
+    def _get_public_ip(self) -> str:
+        """Get public IP address"""
+        try:
+            # Try multiple services for reliability
+            services = [
+                'https://api.ipify.org',
+                'https://icanhazip.com',
+                'https://ifconfig.me/ip'
+            ]
+
+            for service in services:
+                try:
+                    req = urllib.request.Request(service, headers={'User-Agent': 'Mozilla/5.0'})
+                    with urllib.request.urlopen(req, timeout=5) as response:
+                        return response.read().decode('utf-8').strip()
+                except Exception:
+                    continue
+
+            return "unknown"
+        except Exception:
+            return "unknown"
+
+    def _read_buffer(self) -> bytearray:
+        """Get this thread's reusable read buffer"""
+        buf = getattr(self._local, 'buffer', None)
+        if buf is None:
+            buf = bytearray(self.chunk_size)
+            self._local.buffer = buf
+        return buf
+
+    def _open_file(self, file_path: str):
+        """
+        Open a file for hashing: unbuffered, without updating its atime
+        where permitted, after any throttle delay
+
+        Returns:
+            Unbuffered binary file object
+        """
+        if self.throttle is not None:
+            self.throttle.before_file()
+        start = time.perf_counter()
+        fd = None
+        if _O_NOATIME:
+            try:
+                fd = os.open(file_path, os.O_RDONLY | _O_NOATIME)
+            except PermissionError:
+                # O_NOATIME needs file ownership or CAP_FOWNER
+                fd = None
+        if fd is None:
+            fd = os.open(file_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        f = open(fd, 'rb', buffering=0)
+        if self.fadvise:
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                pass
+        self.metrics.observe('open', time.perf_counter() - start)
+        return f
+
+    def _release_file(self, f):
+        """Drop a hashed file's pages from the page cache so the working set stays cached"""
+        if self.fadvise:
+            try:
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            except OSError:
+                pass
+
+    def _feed_readinto(self, f, hashers: Dict):
+        """
+        Feed a file to the hashers through the thread's preallocated buffer
+
+        Args:
+            f: Unbuffered binary file object
+            hashers: Dict of hash objects to update
+        """
+        buf = self._read_buffer()
+        view = memoryview(buf)
+        full = len(buf)
+        throttle = self.throttle
+        clock = time.perf_counter
+        read_time = hash_time = 0.0
+        while True:
+            t0 = clock()
+            n = f.readinto(buf)
+            t1 = clock()
+            read_time += t1 - t0
+            if not n:
+                break
+            if throttle is not None:
+                # Charge what was read: short files and the EOF read cost nothing extra
+                throttle.after_read(n)
+                t1 = clock()
+            chunk = view if n == full else view[:n]
+            for hasher in hashers.values():
+                hasher.update(chunk)
+            hash_time += clock() - t1
+        self.metrics.observe('read', read_time)
+        self.metrics.observe('hash', hash_time)
+
+    def _feed_sparse(self, f, hashers: Dict, size: int) -> bool:
+        """
+        Feed a sparse file to the hashers, reading only its data extents
+
+        Holes found with SEEK_DATA/SEEK_HOLE are fed from a shared zero
+        block without any I/O, so the digests equal those of a dense read.
+
+        Args:
+            f: Unbuffered binary file object
+            hashers: Dict of hash objects to update
+            size: File size from fstat
+
+        Returns:
+            False if the filesystem does not report holes (nothing was fed)
+        """
+        fd = f.fileno()
+        buf = self._read_buffer()
+        view = memoryview(buf)
+        offset = 0
+        while offset < size:
+            try:
+                data = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # No data after offset: the rest of the file is a hole
+                    data = size
+                elif offset == 0:
+                    return False
+                else:
+                    raise
+            data = min(data, size)
+
+            # Hole between offset and data
+            while offset < data:
+                zeros = _ZERO_BLOCK[:min(len(_ZERO_BLOCK), data - offset)]
+                for hasher in hashers.values():
+                    hasher.update(zeros)
+                offset += len(zeros)
+            if offset >= size:
+                break
+
+            # Data extent between data and the next hole
+            hole = min(os.lseek(fd, data, os.SEEK_HOLE), size)
+            f.seek(data)
+            while offset < hole:
+                want = min(len(buf), hole - offset)
+                if self.throttle is not None:
+                    self.throttle.before_read(want)
+                n = f.readinto(view[:want])
+                if not n:
+                    raise OSError(errno.EIO, f"{f.name}: file shrank while hashing")
+                chunk = view[:n]
+                for hasher in hashers.values():
+                    hasher.update(chunk)
+                offset += n
+        return True
+
+    def _feed_mmap(self, f, hashers: Dict):
+        """
+        Feed a file to the hashers straight from a read-only memory mapping
+
+        Args:
+            f: Unbuffered binary file object
+            hashers: Dict of hash objects to update
+        """
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(mm) as view:
+                if len(hashers) == 1 and self.throttle is None:
+                    next(iter(hashers.values())).update(view)
+                    return
+                # Window the mapping so every hasher reads a chunk while it is in CPU cache
+                step = self.chunk_size
+                for offset in range(0, len(view), step):
+                    window = view[offset:offset + step]
+                    if self.throttle is not None:
+                        self.throttle.before_read(len(window))
+                    for hasher in hashers.values():
+                        hasher.update(window)
+                    window.release()
+
+    def _ring_buffers(self) -> List[bytearray]:
+        """Get this thread's reusable read-ahead ring"""
+        ring = getattr(self._local, 'ring', None)
+        if ring is None:
+            ring = [bytearray(self.RING_SLOT_SIZE) for _ in range(self.RING_SLOTS)]
+            self._local.ring = ring
+        return ring
+
+    def _feed_parallel(self, f, hashers: Dict):
+        """
+        Feed a file to several hashers at once, one thread per algorithm
+
+        This thread reads ahead into a ring of RING_SLOTS buffers; every
+        hasher thread consumes the slots in order, and a slot is refilled
+        once all hashers are done with it. hashlib releases the GIL on
+        large buffers, so the algorithms run concurrently and adding one
+        costs little wall-clock time.
+
+        Args:
+            f: Unbuffered binary file object
+            hashers: Dict of hash objects to update
+        """
+        ring = self._ring_buffers()
+        views = [memoryview(buf) for buf in ring]
+        lengths = [0] * len(ring)
+        pending = [0] * len(ring)      # hashers still to consume each slot
+        state = {'filled': 0, 'eof': False, 'failed': False}
+        cond = threading.Condition()
+
+        def consume(hasher):
+            seq = 0
+            while True:
+                with cond:
+                    while seq >= state['filled'] and not state['eof'] and not state['failed']:
+                        cond.wait()
+                    if seq >= state['filled'] or state['failed']:
+                        return
+                slot = seq % len(ring)
+                try:
+                    hasher.update(views[slot][:lengths[slot]])
+                except Exception:
+                    with cond:
+                        state['failed'] = True
+                        cond.notify_all()
+                    return
+                with cond:
+                    pending[slot] -= 1
+                    cond.notify_all()
+                seq += 1
+
+        threads = [threading.Thread(target=consume, args=(hasher,), name='digest', daemon=True)
+                   for hasher in hashers.values()]
+        for thread in threads:
+            thread.start()
+        try:
+            seq = 0
+            while True:
+                slot = seq % len(ring)
+                with cond:
+                    while pending[slot] and not state['failed']:
+                        cond.wait()
+                    if state['failed']:
+                        raise OSError(errno.EIO, "digest thread failed")
+                n = f.readinto(ring[slot])
+                if self.throttle is not None:
+                    self.throttle.after_read(n)
+                with cond:
+                    if not n:
+                        state['eof'] = True
+                        cond.notify_all()
+                        break
+                    lengths[slot] = n
+                    pending[slot] = len(hashers)
+                    state['filled'] = seq + 1
+                    cond.notify_all()
+                seq += 1
+        except BaseException:
+            with cond:
+                state['failed'] = True
+                cond.notify_all()
+            raise
+        finally:
+            for thread in threads:
+                thread.join()
+        if state['failed']:
+            raise OSError(errno.EIO, "digest thread failed")
+
+    def _tree_parallel(self, hashers: Dict, size: int) -> bool:
+        """Whether a file's tree hash should be computed by the leaf pool"""
+        return (len(hashers) == 1 and TreeHash.name in hashers and self.num_threads > 1
+                and size >= 2 * TreeHash.LEAF_SIZE and hasattr(os, 'pread'))
+
+    def _leaf_pool(self) -> ThreadPoolExecutor:
+        """Shared pool that hashes tree leaves (created on first use)"""
+        with self.lock:
+            if self._tree_pool is None:
+                self._tree_pool = ThreadPoolExecutor(max_workers=self.num_threads, thread_name_prefix='leaf')
+            return self._tree_pool
+
+    def _hash_leaf(self, fd: int, offset: int, length: int) -> bytes:
+        """Read one tree leaf with pread and return its digest"""
+        if self.throttle is not None:
+            self.throttle.before_read(length)
+        leaf = TreeHash.new_leaf()
+        while length:
+            data = os.pread(fd, length, offset)
+            if not data:
+                raise OSError(errno.EIO, "file shrank while hashing")
+            leaf.update(data)
+            offset += len(data)
+            length -= len(data)
+        return leaf.digest()
+
+    def _tree_leaves(self, f, size: int) -> List[bytes]:
+        """
+        Hash all leaves of a file in parallel
+
+        At most two leaves per pool thread are in flight, so memory stays
+        bounded for files of any size.
+
+        Args:
+            f: Unbuffered binary file object
+            size: File size from fstat
+
+        Returns:
+            Leaf digests in file order
+        """
+        pool = self._leaf_pool()
+        fd = f.fileno()
+        leaf_size = TreeHash.LEAF_SIZE
+        pending = deque()
+        leaves = []
+        try:
+            for offset in range(0, size, leaf_size):
+                pending.append(pool.submit(self._hash_leaf, fd, offset, min(leaf_size, size - offset)))
+                if len(pending) >= 2 * self.num_threads:
+                    leaves.append(pending.popleft().result())
+            while pending:
+                leaves.append(pending.popleft().result())
+        finally:
+            # Never let a leaf read outlive the file descriptor
+            for future in pending:
+                future.cancel()
+            for future in pending:
+                if not future.cancelled():
+                    try:
+                        future.result()
+                    except Exception:
+                        pass
+        return leaves
+
+    def _hash_file(self, file_path: str) -> Optional[Dict[str, str]]:
+        """
+        Compute hash(es) of a file using specified algorithms
+
+        Args:
+            file_path: Path to file
+
+        Returns:
+            Dict mapping algorithm name to hex digest, or None on error
+        """
+        try:
+            # Initialize hash objects for all requested algorithms
+            hashers = {}
+            for algo in self.hash_algorithms:
+                if algo not in HASH_ALGORITHMS:
+                    raise ValueError(f"Unsupported hash algorithm: {algo}")
+                hashers[algo] = HASH_ALGORITHMS[algo]()
+
+            # Read file once and update all hashers
+            with self._open_file(file_path) as f:
+                st = os.fstat(f.fileno())
+                size = st.st_size
+                # Fewer allocated blocks than the size implies holes
+                sparse = (_SEEK_HOLES and size >= len(_ZERO_BLOCK)
+                          and getattr(st, 'st_blocks', size) * 512 < size)
+                start = time.perf_counter()
+                streamed = False
+                if self._tree_parallel(hashers, size):
+                    hashers[TreeHash.name].leaves = self._tree_leaves(f, size)
+                elif sparse and self._feed_sparse(f, hashers, size):
+                    pass
+                elif (len(hashers) > 1 and self.parallel_digest_threshold
+                      and size >= self.parallel_digest_threshold):
+                    self._feed_parallel(f, hashers)
+                elif self.mmap_threshold and size >= self.mmap_threshold:
+                    self._feed_mmap(f, hashers)
+                else:
+                    # Times its read and hash stages itself
+                    self._feed_readinto(f, hashers)
+                    streamed = True
+                if not streamed:
+                    self.metrics.observe('hash', time.perf_counter() - start)
+                self._release_file(f)
+            self.metrics.add_bytes(size)
+
+            # Return hex digests
+            return {algo: hasher.hexdigest() for algo, hasher in hashers.items()}
+        except (PermissionError, OSError, IOError, ValueError) as e:
+            # ValueError: mmap of a file truncated to zero after fstat
+            # Silently skip files we can't read
+            self.metrics.error(e)
+            return None
+
+    def _quick_hash(self, file_path: str) -> Optional[Dict]:
+        """
+        Fingerprint a file from its size and three sampled regions
+
+        The SHA-256 covers the size and quick_sample bytes from the start,
+        the middle and the end of the file.
+
+        Args:
+            file_path: Path to file
+
+        Returns:
+            Dict with the quick digest and size, or None on error
+        """
+        sample = self.quick_sample
+        try:
+            with self._open_file(file_path) as f:
+                size = os.fstat(f.fileno()).st_size
+                hasher = hashlib.sha256(struct.pack('<Q', size))
+                start = time.perf_counter()
+                for offset in (0, max(0, (size - sample) // 2), max(0, size - sample)):
+                    if self.throttle is not None:
+                        self.throttle.before_read(sample)
+                    f.seek(offset)
+                    data = f.read(sample)
+                    hasher.update(data)
+                self.metrics.observe('read', time.perf_counter() - start)
+                self._release_file(f)
+            self.metrics.add_bytes(min(size, 3 * sample))
+            return {QUICK_KEY: hasher.hexdigest(), 'size': size}
+        except (PermissionError, OSError, IOError) as e:
+            self.metrics.error(e)
+            return None
+
+    def _wants_full(self, st: os.stat_result) -> bool:
+        """Whether a file matches the quick mode interest criteria for full digests"""
+        if 'exec' in self.full_for and st.st_mode & 0o111:
+            return True
+        if 'recent' in self.full_for and st.st_mtime >= time.time() - self.recent_seconds:
+            return True
+        return False
+
+    def _digest(self, file_path: str, st: Optional[os.stat_result]) -> Optional[Dict]:
+        """Full digests, or a quick fingerprint in quick mode for files of no interest"""
+        # Files no larger than the three samples cost the same to hash in full
+        if self.mode == 'quick' and st.st_size > 3 * self.quick_sample and not self._wants_full(st):
+            return self._quick_hash(file_path)
+        return self._hash_file(file_path)
+
+    def _needs_stat(self) -> bool:
+        """Whether walked files must be stat'ed (index, hardlink tracking or quick mode)"""
+        return self.index is not None or self.hardlinks is not None or self.mode == 'quick'
+
+    def _lookup_or_hash(self, file_path: str,
+                        st: Optional[os.stat_result]) -> Tuple[Optional[Dict[str, str]], bool, Optional[str]]:
+        """
+        Get a file's digests from the index or an earlier hardlink, or hash it
+
+        Args:
+            file_path: Path to file
+            st: lstat result (required when an index or hardlink table is configured)
+
+        Returns:
+            (digests or None on error, True if the digests came from the index,
+            path of the earlier link the digests were taken from or None)
+        """
+        indexed = None
+        if self.index is not None and not self.full_rehash:
+            indexed = self.index.lookup(file_path, st, self.hash_algorithms)
+            if indexed is None and self.mode == 'quick' and st.st_size > 3 * self.quick_sample \
+                    and not self._wants_full(st):
+                fingerprint = self.index.lookup(file_path, st, [QUICK_KEY])
+                if fingerprint is not None:
+                    indexed = dict(fingerprint, size=st.st_size)
+
+        if self.hardlinks is not None and st.st_nlink > 1:
+            # Index hits still claim the link, so the table counts every link
+            # of the inode and later links can reuse the indexed digests
+            owner, entry = self.hardlinks.claim(file_path, st)
+            if indexed is not None:
+                if owner:
+                    self.hardlinks.publish(entry, indexed)
+                return indexed, True, None
+            if not owner:
+                entry.done.wait()
+                if entry.digests is not None:
+                    return entry.digests, False, entry.path
+                # The first link could not be read; try this one
+                return self._digest(file_path, st), False, None
+            file_hashes = None
+            try:
+                file_hashes = self._digest(file_path, st)
+            finally:
+                self.hardlinks.publish(entry, file_hashes)
+            return file_hashes, False, None
+
+        if indexed is not None:
+            return indexed, True, None
+        return self._digest(file_path, st), False, None
+
+    def _account(self, file_path: str, signature: Optional[tuple], file_hashes: Optional[Dict[str, str]],
+                 reused: bool, link_of: Optional[str] = None) -> Optional[Dict]:
+        """
+        Update counters and the index for one file and build its result entry
+
+        Args:
+            file_path: Path to file
+            signature: HashIndex signature of the file (when an index is configured)
+            file_hashes: Dict mapping algorithm name to hex digest (or a quick
+                fingerprint), or None on error
+            reused: True if the digests came from the index
+            link_of: Earlier hardlink of the same inode the digests were taken from
+
+        Returns:
+            Dict with file info or None
+        """
+        counters = self._counters()
+        if file_hashes is None:
+            counters.errors += 1
+            return None
+
+        if self.index is not None:
+            if reused:
+                self.index.touch(file_path)
+            else:
+                self.index.record(file_path, signature, file_hashes)
+
+        quick = QUICK_KEY in file_hashes
+        counters.files += 1
+        if reused:
+            counters.reused += 1
+        if link_of is not None:
+            counters.hardlinks += 1
+        if quick:
+            counters.quick += 1
+
+        # Build result with all hash algorithms
+        if quick:
+            result = make_quick_result(file_path, file_hashes)
+        else:
+            result = make_result(file_path, self.hash_algorithms, file_hashes)
+        if link_of is not None:
+            result['hardlink_of'] = link_of
+        return result
+
+    def _process_file(self, file_path: str, dir_name: str,
+                      entry: Optional[os.DirEntry] = None) -> Union[Dict, bool, None]:
+        """
+        Process a single file
+
+        Args:
+            file_path: Path to file
+            dir_name: Parent directory name
+            entry: Directory entry from the walker, already known to be a regular file
+
+        Returns:
+            Dict with file info, None on error, or False if the path is no
+            longer a regular file (skipped, not an error)
+        """
+        try:
+            start = time.perf_counter()
+            st = None
+            if entry is None:
+                # Skip symlinks to avoid loops and only process regular files
+                st = os.lstat(file_path)
+                if not stat.S_ISREG(st.st_mode):
+                    return False
+            elif self._needs_stat():
+                st = entry.stat(follow_symlinks=False)
+            if st is not None:
+                self.metrics.observe('stat', time.perf_counter() - start)
+
+            file_hashes, reused, link_of = self._lookup_or_hash(file_path, st)
+            signature = HashIndex.signature(st) if self.index is not None else None
+            result = self._account(file_path, signature, file_hashes, reused, link_of)
+            if result is not None:
+                self.metrics.file_done(file_path, time.perf_counter() - start)
+            return result
+
+        except Exception as e:
+            # E.g. a listed path that does not exist
+            self._counters().errors += 1
+            self.metrics.error(e)
+            return None
+
+    def _skip_mount(self, mount: 'MountTable.Mount') -> bool:
+        """Whether the filesystem type policy excludes a mount"""
+        if mount.fstype in self.skip_fs_types:
+            return True
+        return not self.include_network_fs and MountTable.is_network_fstype(mount.fstype)
+
+    def _root_device(self, root_path: str):
+        """Device key of a root path (mount device, st_dev, or None)"""
+        if self.mounts is not None:
+            mount = self.mounts.find(root_path)
+            return mount.device if mount is not None else None
+        if self.one_file_system:
+            try:
+                return os.stat(root_path).st_dev
+            except OSError:
+                return None
+        return None
+
+    def _subdir_device(self, entry: os.DirEntry, device):
+        """
+        Device of a subdirectory, or _SKIP if it must not be descended into
+
+        Args:
+            entry: Subdirectory entry
+            device: Device of the parent directory
+        """
+        if self.mounts is not None:
+            mount = self.mounts.get(entry.path)
+            if mount is None:
+                return device
+            if self.one_file_system and mount.device != device:
+                return _SKIP
+            if self._skip_mount(mount):
+                return _SKIP
+            return mount.device
+        if self.one_file_system:
+            if entry.stat(follow_symlinks=False).st_dev != device:
+                return _SKIP
+        return device
+
+    def _walk(self, emit: Callable[[str, str, os.DirEntry, object, int], None],
+              congested: Optional[Callable[[object], bool]] = None):
+        """
+        Walk all root paths with a pool of walker threads
+
+        Directories are work items in a shared deque; each walker lists one
+        directory with os.scandir, pushes its subdirectories back onto the deque
+        and hands regular files to emit. The DirEntry type information means
+        no extra stat is needed to tell files, directories and symlinks apart.
+        Mount points are checked against the filesystem policy and
+        --one-file-system as they are reached.
+
+        With priority set, directories in or leading to the priority
+        directories are walked first, and files that are neither in them nor
+        executable or recently modified are deferred and emitted (without a
+        DirEntry) after the walk.
+
+        Args:
+            emit: Called as emit(file_path, dirpath, entry, device, tier) for every
+                regular file; tier indexes TIERS (always 2 without priority)
+            congested: Optional check for devices whose work queue is full;
+                walkers prefer directories on other devices
+        """
+        if self.files is not None:
+            self._walk_list(emit)
+            return
+
+        checkpoint = self.checkpoint
+        skip = checkpoint.skip if checkpoint is not None else ()
+        pending = deque((r, self._root_device(r)) for r in self.root_paths
+                        if not self._should_skip_dir(r) and r not in skip)
+        self._walk_pending = pending
+        cond = threading.Condition()
+        active = [0]
+        start = time.monotonic()
+
+        priority = self.priority
+        urgent = deque()
+        deferred = None
+        if priority:
+            priority_dirs, leading_dirs = self._priority_paths()
+            recent_cutoff = time.time() - self.recent_seconds
+            deferred = _DeferredFiles()
+            for _ in range(len(pending)):
+                root = pending.popleft()
+                (urgent if root[0] in leading_dirs or self._in_priority_dir(root[0], priority_dirs)
+                 else pending).append(root)
+
+        def take():
+            if urgent:
+                return urgent.pop()
+            # Prefer the newest directory whose device can accept more work
+            if congested is not None:
+                for _ in range(len(pending)):
+                    if not congested(pending[-1][1]):
+                        break
+                    pending.rotate(1)
+            return pending.pop()
+
+        def walker():
+            while True:
+                with cond:
+                    while not pending and not urgent and active[0]:
+                        cond.wait()
+                    if not (pending or urgent) or self._stopped:
+                        # Nothing queued and nobody left to produce more
+                        cond.notify_all()
+                        return
+                    dirpath, device = take()
+                    active[0] += 1
+
+                subdirs = []
+                entries = 0
+                emitted = 0
+                emit_files = self._in_shard(dirpath)
+                if priority:
+                    in_priority = self._in_priority_dir(dirpath, priority_dirs)
+                    later = []
+                    found = [0] * len(self.TIERS)
+                try:
+                    with os.scandir(dirpath) as it:
+                        for entry in it:
+                            entries += 1
+                            try:
+                                if entry.is_dir(follow_symlinks=False):
+                                    if not self._should_skip_dir(entry.path) and entry.path not in skip and \
+                                            self._descend_shard(entry.path, dirpath):
+                                        subdir_device = self._subdir_device(entry, device)
+                                        if subdir_device is not _SKIP:
+                                            subdirs.append((entry.path, subdir_device))
+                                elif emit_files and entry.is_file(follow_symlinks=False):
+                                    tier = 2
+                                    if priority:
+                                        tier = 0 if in_priority else self._file_tier(entry, recent_cutoff)
+                                        found[tier] += 1
+                                        if tier == 2:
+                                            later.append(entry.name)
+                                            emitted += 1
+                                            continue
+                                    emit(entry.path, dirpath, entry, device, tier)
+                                    emitted += 1
+                            except OSError:
+                                continue
+                except (PermissionError, OSError):
+                    # Skip directories we can't access
+                    pass
+
+                if priority and later:
+                    deferred.add(dirpath, device, later)
+                if checkpoint is not None:
+                    # Before the subdirectories can be taken by other walkers
+                    checkpoint.listed(dirpath, emitted, [subdir for subdir, _ in subdirs])
+                with cond:
+                    if priority:
+                        for subdir in subdirs:
+                            (urgent if in_priority or subdir[0] in leading_dirs or subdir[0] in priority_dirs
+                             else pending).append(subdir)
+                        for tier, count in enumerate(found):
+                            self._tier_found[tier] += count
+                    else:
+                        pending.extend(subdirs)
+                    active[0] -= 1
+                    self.walk_stats['dirs'] += 1
+                    self.walk_stats['entries'] += entries
+                    cond.notify_all()
+
+        threads = [
+            threading.Thread(target=walker, name=f'walker-{i}', daemon=True)
+            for i in range(self.walk_threads)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.walk_stats['seconds'] = time.monotonic() - start
+        self._walk_complete = not self._stopped
+        self._report_walk()
+
+        if deferred is not None:
+            try:
+                for dirpath, device, names in deferred:
+                    if self._stopped:
+                        break
+                    for name in names:
+                        emit(os.path.join(dirpath, name), dirpath, None, device, 2)
+            finally:
+                deferred.close()
+
+    def _walk_list(self, emit: Callable[[str, str, os.DirEntry, object, int], None]):
+        """
+        Emit the listed files in place of a directory walk
+
+        Paths are emitted without a DirEntry; the workers lstat them and skip
+        anything that is not a regular file. Relative paths are made absolute.
+        """
+        start = time.monotonic()
+        last_dir = device = None
+        count = 0
+        for path in self.files:
+            if self._stopped:
+                break
+            file_path = os.path.abspath(path)
+            dirpath = os.path.dirname(file_path)
+            if dirpath != last_dir:
+                last_dir, device = dirpath, self._root_device(dirpath)
+            emit(file_path, dirpath, None, device, 2)
+            count += 1
+        self.walk_stats['entries'] = count
+        self.walk_stats['seconds'] = elapsed = time.monotonic() - start
+        print(f"Paths read: {count} in {elapsed:.2f}s", file=sys.stderr)
+
+    def _report_walk(self):
+        """Print walk throughput, independent of hashing throughput"""
+        elapsed = self.walk_stats['seconds'] or 1e-9
+        dirs = self.walk_stats['dirs']
+        entries = self.walk_stats['entries']
+        print(f"Walk complete: {dirs} directories, {entries} entries in {elapsed:.2f}s "
+              f"({dirs / elapsed:.0f} dirs/s, {entries / elapsed:.0f} entries/s)", file=sys.stderr)
+
+    def walk(self) -> Dict:
+        """
+        Walk the root paths without hashing anything
+
+        Returns:
+            Walk statistics (dirs, entries, files, seconds)
+        """
+        files = [0]
+
+        def count(file_path, dirpath, entry, device, tier):
+            files[0] += 1
+
+        self._walk(count)
+        return dict(self.walk_stats, files=files[0])
+
+    def _device_budget(self, device) -> int:
+        """Concurrent workers allowed on a device"""
+        if self.mounts is not None and isinstance(device, str):
+            if self.mounts.is_network(device):
+                return max(1, min(self.network_threads, self.num_threads - 1))
+            if self.mounts.is_rotational(device):
+                return self.hdd_threads
+        return self.num_threads
+
+    def _produce(self, result_queue: queue.Queue):
+        """
+        Walker thread: feed files to the hashing workers, then wait for them
+
+        Files are queued per device in a DeviceScheduler; the workers are
+        started here and joined once the walk is complete, after which a
+        single stop marker is sent to the aggregator.
+
+        Args:
+            result_queue: Queue of lists of (dirpath, result, tier) items for the aggregator
+        """
+        scheduler = DeviceScheduler(self._device_budget, self.queue_size)
+        self._scheduler = scheduler
+        workers = [
+            threading.Thread(target=self._consume, args=(scheduler, result_queue), name=f'hasher-{i}', daemon=True)
+            for i in range(self.num_threads)
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            self._walk(lambda file_path, dirpath, entry, device, tier:
+                       scheduler.put((file_path, dirpath, entry, tier), device),
+                       scheduler.congested)
+        finally:
+            scheduler.close()
+            for worker in workers:
+                worker.join()
+            result_queue.put(None)
+
+    def _consume(self, scheduler: DeviceScheduler, result_queue: queue.Queue):
+        """
+        Worker thread: hash files from the scheduler until it is drained
+
+        Results are handed to the aggregator in lists of RESULT_BATCH, so the
+        result queue's lock is taken once per batch rather than per file.
+
+        Args:
+            scheduler: Per-device queues of (file_path, dirpath, entry, tier) items
+            result_queue: Queue of lists of (dirpath, result, tier) items for the
+                aggregator; result is None for an error and False for a skipped file
+        """
+        track = self.checkpoint is not None
+        batch = []
+        while True:
+            got = scheduler.get()
+            if got is None:
+                break
+            (file_path, dirpath, entry, tier), device = got
+            if self._stopped:
+                # Scan stopped early: drop what is still queued
+                scheduler.done(device)
+                continue
+            try:
+                result = self._process_file(file_path, dirpath, entry)
+            except Exception:
+                self._counters().errors += 1
+                result = None
+            finally:
+                scheduler.done(device)
+            if result or track:
+                # A checkpoint also has to see the files that failed or were skipped
+                batch.append((dirpath, result, tier))
+                if len(batch) >= self.RESULT_BATCH:
+                    result_queue.put(batch)
+                    batch = []
+        if batch:
+            result_queue.put(batch)
+
+    def _produce_batches(self, result_queue: queue.Queue):
+        """
+        Walker thread for the process backend: shard files to worker processes
+
+        Files are sent in batches of batch_size (dirpath, name, tier) items, each
+        process hashes a batch with its own thread pool and returns the whole
+        batch in one reply. At most two batches per process are in flight.
+
+        Args:
+            result_queue: Queue of lists of (dirpath, result, tier) items for the aggregator
+        """
+        per_process_threads = max(1, self.num_threads // self.num_processes)
+        options = {
+            'hash_algorithms': self.hash_algorithms,
+            'chunk_size': self.chunk_size,
+            'mmap_threshold': self.mmap_threshold,
+            'dedup_hardlinks': self.hardlinks is not None,
+            'mode': self.mode,
+            'quick_sample': self.quick_sample,
+            'full_for': sorted(self.full_for),
+            'recent_days': self.recent_seconds / 86400,
+            'fadvise': self.fadvise,
+            'parallel_digest_threshold': self.parallel_digest_threshold,
+            'throttle': self.throttle.share(self.num_processes) if self.throttle is not None else None,
+            'threads': per_process_threads,
+            'index': self.index.db_path if self.index is not None and not self.full_rehash else None
+        }
+        in_flight = threading.BoundedSemaphore(self.num_processes * 2)
+        batch_lock = threading.Lock()
+        batch = []
+        # spawn rather than fork: the walker threads are already running
+        context = multiprocessing.get_context('spawn')
+        # Set once the scan stops, so the workers hand back the rest of their batches unhashed
+        self._stop_event = context.Event()
+
+        def submit(executor, items):
+            in_flight.acquire()
+            if self._stopped:
+                in_flight.release()
+                return
+            with self.lock:
+                self._queued_files += len(items)
+            future = executor.submit(_hash_batch, items)
+            future.add_done_callback(lambda f: self._absorb_batch(f, items, result_queue, in_flight))
+
+        try:
+            with ProcessPoolExecutor(max_workers=self.num_processes,
+                                     mp_context=context,
+                                     initializer=_init_process_worker,
+                                     initargs=(options, self._stop_event)) as executor:
+                def emit(file_path, dirpath, entry, device, tier):
+                    with batch_lock:
+                        if self._stopped:
+                            return
+                        batch.append((dirpath, entry.name if entry is not None else os.path.basename(file_path), tier))
+                        if len(batch) >= self.batch_size:
+                            submit(executor, batch[:])
+                            batch.clear()
+
+                self._walk(emit)
+                if batch and not self._stopped:
+                    submit(executor, batch[:])
+        finally:
+            result_queue.put(None)
+
+    def _absorb_batch(self, future: Future, items: List[Tuple[str, str, int]], result_queue: queue.Queue,
+                      in_flight: threading.BoundedSemaphore):
+        """
+        Account for a batch returned by a worker process
+
+        Args:
+            future: Completed _hash_batch future
+            items: The (dirpath, name, tier) items that were submitted
+            result_queue: Queue of lists of (dirpath, result, tier) items for the aggregator
+            in_flight: Semaphore limiting outstanding batches
+        """
+        track = self.checkpoint is not None
+        results = []
+        done = 0
+        with self.lock:
+            self._queued_files -= len(items)
+        try:
+            batch = future.result()
+            for item, (_, _, tier) in zip(batch, items):
+                done += 1
+                if item is None:
+                    # Handed back unhashed after a stop; its directory stays unfinished
+                    continue
+                dirpath, name, digests, reused, link_of, signature = item
+                if reused is None:
+                    # Skipped, but a checkpoint still has to count it
+                    if track:
+                        results.append((dirpath, False, tier))
+                    continue
+                file_path = os.path.join(dirpath, name)
+                if digests is None:
+                    self.metrics.error()
+                elif not reused and link_of is None:
+                    quick = isinstance(digests, dict)
+                    self.metrics.add_bytes(min(signature[2], 3 * self.quick_sample) if quick else signature[2])
+                if digests is None or isinstance(digests, dict):
+                    # Errors and quick fingerprints are passed through as is
+                    file_hashes = digests
+                else:
+                    file_hashes = dict(zip(self.hash_algorithms, digests))
+                result = self._account(file_path, signature, file_hashes, reused, link_of)
+                if result or track:
+                    results.append((dirpath, result or None, tier))
+        except Exception:
+            # Worker process died or the batch could not be unpickled: every
+            # file not yet accounted for is an error
+            self._counters().errors += len(items) - done
+            if track:
+                results.extend((dirpath, None, tier) for dirpath, _, tier in items[done:])
+        finally:
+            if results:
+                result_queue.put(results)
+            in_flight.release()
+
+    def _run_pipeline(self):
+        """Walk, hash and aggregate all files under the root paths"""
+        # Walker, hashing workers and this thread run concurrently; the bounded
+        # queues keep memory proportional to the thread count, not the file count
+        result_queue = queue.Queue(maxsize=self.queue_size)
+        self._result_queue = result_queue
+
+        target = self._produce_batches if self.worker_mode == 'processes' else self._produce
+        producer = threading.Thread(target=target, args=(result_queue,), name='walker', daemon=True)
+        producer.start()
+
+        # Aggregate results as workers finish them
+        checkpoint = self.checkpoint
+        next_save = time.monotonic() + checkpoint.interval if checkpoint is not None else None
+        budgeted = bool(self.deadline or self.max_bytes)
+        stop_at = None
+        while True:
+            try:
+                # With a budget, wake up to check the deadline even while no results arrive
+                item = result_queue.get(timeout=min(0.5, self._stop_grace()) if budgeted else None)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            for dirpath, result, tier in item:
+                if not result:
+                    # Error or skipped file, only the checkpoint needs it
+                    continue
+                if self.priority:
+                    self._tier_hashed[tier] += 1
+                start = time.perf_counter()
+                self._collect(dirpath, result)
+                self.metrics.observe('serialize', time.perf_counter() - start)
+            if checkpoint is not None:
+                checkpoint.done(item)
+                if time.monotonic() >= next_save:
+                    checkpoint.save(self.writer.sync())
+                    next_save = time.monotonic() + checkpoint.interval
+            if budgeted:
+                if stop_at is None:
+                    self.stopped_by = self._budget_exhausted()
+                    if self.stopped_by is not None:
+                        # Hand out no more work, but keep what the workers have already hashed
+                        self._stopped = True
+                        if self._stop_event is not None:
+                            # Worker processes return their batches with the files hashed so far
+                            self._stop_event.set()
+                        grace = self._stop_grace()
+                        if self.deadline:
+                            # The grace comes out of the deadline, so the scan still ends on time
+                            grace = min(grace, max(0.0, self.metrics.start + self.deadline - time.time()))
+                        stop_at = time.monotonic() + grace
+                elif time.monotonic() >= stop_at:
+                    self._stop()
+                    return
+
+        producer.join()
+
+        if self.index is not None:
+            self.index.flush()
+
+    def system_info(self) -> Dict:
+        """
+        Get the header fields of the output (system info, algorithms, scan date)
+
+        Returns:
+            Dictionary in output key order
+        """
+        header = {
+            'system_name': self._get_hostname(),
+            'system_ip': self._get_local_ip(),
+            'system_public': self._get_public_ip(),
+            'os_type': self.os_type,
+            'os_version': platform.platform(),
+            'hash_algorithms': self.hash_algorithms,
+            'scan_date': datetime.utcnow().isoformat() + 'Z'
+        }
+        if TreeHash.name in self.hash_algorithms:
+            header['tree_leaf_size'] = TreeHash.LEAF_SIZE
+        if self.mode == 'quick':
+            header['scan_mode'] = 'quick'
+            header['quick_sample_size'] = self.quick_sample
+        if self.shard is not None:
+            header['shard'] = f'{self.shard[0]}/{self.shard[1]}'
+            header['shard_by'] = self.shard_by
+        return header
+
+    def metrics_snapshot(self) -> Dict:
+        """Current metrics, file and error counts and queue depths"""
+        snap = self.metrics.snapshot()
+        snap['files'] = self.file_count
+        snap['errors'] = self.error_count
+        snap['walk_dirs'] = self.walk_stats['dirs']
+        if self.worker_mode == 'processes':
+            hash_depth = self._queued_files
+        else:
+            hash_depth = self._scheduler.depth() if self._scheduler is not None else 0
+        snap['queues'] = {
+            'walk': len(self._walk_pending) if self._walk_pending is not None else 0,
+            'hash': hash_depth,
+            'result': self._result_queue.qsize() if self._result_queue is not None else 0
+        }
+        return snap
+
+    def _collect(self, dir_name: str, result: Dict):
+        """Aggregator: hand one result to the writer, or keep it in memory"""
+        if self.files_dir_name is not None:
+            dir_name = self.files_dir_name
+        if self.matcher is not None and not self.matcher.check(dir_name, result):
+            return
+        if self.writer is not None:
+            self.writer.write(dir_name, result)
+        else:
+            self.results.add(dir_name, result)
+
+    def _carry_over(self, path: str):
+        """Copy the results of subtrees finished by the interrupted scan being resumed"""
+        checkpoint = self.checkpoint
+        counters = self._counters()
+        with ManifestReader(path) as reader:
+            for dir_name, result in reader:
+                if checkpoint.is_completed(dir_name):
+                    if self.index is not None:
+                        # Still on disk as far as we know; keep --prune-index from dropping it
+                        self.index.touch(result['file_name'])
+                    self._collect(dir_name, result)
+                    counters.files += 1
+                    if is_quick(result):
+                        counters.quick += 1
+        counters.errors += checkpoint.carried_errors
+        print(f"Resuming: {counters.files} results carried over from {len(checkpoint.skip)} finished subtrees",
+              file=sys.stderr)
+
+    def _stop(self):
+        """Stop walking after an interrupt and discard whatever is still in flight"""
+        self._stopped = True
+        if self._stop_event is not None:
+            self._stop_event.set()
+        if self.index is not None:
+            self.index.flush()
+        result_queue = self._result_queue
+
+        def drain():
+            while result_queue.get() is not None:
+                pass
+
+        threading.Thread(target=drain, name='drain', daemon=True).start()
+
+    def scan(self, writer: Optional[ResultWriter] = None, previous_output: Optional[str] = None) -> Dict:
+        """
+        Scan all files and generate hash mapping
+
+        With a checkpoint and a writer, Ctrl-C (or SIGTERM raised as
+        KeyboardInterrupt) closes the output as a partial manifest whose totals
+        carry partial and resume_token, and leaves the checkpoint in place.
+        A scan that runs out of its deadline or max_bytes budget stops the
+        same way; budgeted scans also report coverage in the totals.
+
+        Args:
+            writer: Stream results to this writer instead of keeping them in memory
+            previous_output: Output of the interrupted scan being resumed; results
+                of its finished subtrees are copied, then the file is removed
+
+        Returns:
+            Dictionary with system info and file hashes (without directories
+            when a writer is used)
+        """
+        if self.worker_mode == 'processes':
+            print(f"Starting scan with {self.num_processes} processes x "
+                  f"{max(1, self.num_threads // self.num_processes)} threads ({self.walk_threads} walkers)...",
+                  file=sys.stderr)
+        else:
+            print(f"Starting scan with {self.num_threads} threads ({self.walk_threads} walkers)...", file=sys.stderr)
+        print(f"OS: {self.os_type}", file=sys.stderr)
+        print(f"Hash algorithms: {', '.join(self.hash_algorithms)}", file=sys.stderr)
+        if self.files is not None:
+            print("Hashing listed files", file=sys.stderr)
+        else:
+            print(f"Root paths: {self.root_paths}", file=sys.stderr)
+
+        checkpoint = self.checkpoint if writer is not None else None
+        header = self.system_info()
+        if checkpoint is not None and checkpoint.resumed_from is not None:
+            header['resumed_from'] = checkpoint.resumed_from
+        self.writer = writer
+        if writer is not None:
+            writer.begin(header)
+        if checkpoint is not None:
+            if previous_output is not None:
+                self._carry_over(previous_output)
+            # The checkpoint now describes this output, not the previous one
+            checkpoint.save(writer.sync())
+            if previous_output is not None:
+                os.unlink(previous_output)
+
+        reporter = MetricsReporter(self, self.metrics_interval, self.metrics_path, self.prometheus_path)
+        reporter.start()
+        try:
+            self._run_pipeline()
+        except KeyboardInterrupt:
+            if checkpoint is None:
+                raise
+            self.stopped_by = 'interrupt'
+            self._stop()
+        finally:
+            reporter.stop()
+
+        if self.stopped_by == 'interrupt':
+            print("\nScan interrupted!", file=sys.stderr)
+        elif self.stopped_by is not None:
+            print(f"\nScan stopped: {self.stopped_by} budget used up", file=sys.stderr)
+        else:
+            print("\nScan complete!", file=sys.stderr)
+        print(f"Files processed: {self.file_count}", file=sys.stderr)
+        if self.index is not None:
+            print(f"Reused from index: {self.reused_count}", file=sys.stderr)
+        if self.hardlinks is not None:
+            print(f"Hardlinks reusing an earlier digest: {self.hardlink_count}", file=sys.stderr)
+        if self.mode == 'quick':
+            print(f"Quick fingerprints (not fully hashed): {self.quick_count}", file=sys.stderr)
+        if self.matcher is not None:
+            print(f"Match database hits: {self.matcher.matched}", file=sys.stderr)
+            print(f"Known-good files{' (dropped)' if self.matcher.drop_known_good else ''}: "
+                  f"{self.matcher.known_good}", file=sys.stderr)
+        print(f"Errors encountered: {self.error_count}", file=sys.stderr)
+        budgeted = bool(self.deadline or self.max_bytes)
+        if budgeted:
+            coverage = self.coverage()
+            walked = 'complete' if coverage['walk_complete'] else 'incomplete'
+            print(f"Coverage: {coverage['files_hashed']} of {coverage['files_found']} files found "
+                  f"({walked} walk of {coverage['dirs_walked']} directories), "
+                  f"{coverage['bytes_hashed']} bytes in {coverage['elapsed_seconds']:.1f}s", file=sys.stderr)
+            for name, counts in coverage['tiers'].items():
+                print(f"  {name}: {counts['hashed']} of {counts['found']}", file=sys.stderr)
+
+        totals = {
+            'total_files': self.file_count,
+            'total_errors': self.error_count
+        }
+        if self.mode == 'quick':
+            totals['quick_files'] = self.quick_count
+        if self.matcher is not None:
+            totals.update(self.matcher.totals())
+            if self.matcher.drop_known_good:
+                totals['total_files'] -= self.matcher.known_good
+        if budgeted:
+            totals['coverage'] = coverage
+        if self.stopped_by is not None:
+            totals['partial'] = True
+            totals['stopped_by'] = self.stopped_by
+            if checkpoint is not None:
+                totals['resume_token'] = checkpoint.token
+                state = writer.sync()
+                checkpoint.save(state)
+                writer.end(totals)
+                checkpoint.save(state, finalized=True)
+                return dict(header, **totals)
+        if writer is not None:
+            writer.end(totals)
+            if checkpoint is not None:
+                checkpoint.remove()
+            return dict(header, **totals)
+
+        # Build final output structure
+        directories = list(self.results.directories())
+
+        output = dict(header, **totals)
+        output['directories'] = directories
+
+        return output
+
+
+# Per-process state for the process backend, set up by _init_process_worker
+_process_hasher = None
+_process_pool = None
+_process_stop = None
+
+
+def _init_process_worker(options: Dict, stop_event=None):
+    """
+    Initialize a hashing worker process
+
+    Args:
+        options: hash_algorithms, chunk_size, threads and index path from the parent
+        stop_event: Set by the parent when the scan stops
+    """
+    global _process_hasher, _process_pool, _process_stop
+    _process_stop = stop_event
+    index = HashIndex(options['index'], readonly=True) if options['index'] else None
+    _process_hasher = FileHasher(
+        root_paths=[],
+        num_threads=options['threads'],
+        chunk_size=options['chunk_size'],
+        hash_algorithms=options['hash_algorithms'],
+        index=index,
+        mmap_threshold=options['mmap_threshold'],
+        dedup_hardlinks=options['dedup_hardlinks'],
+        mode=options['mode'],
+        quick_sample=options['quick_sample'],
+        full_for=options['full_for'],
+        recent_days=options['recent_days'],
+        throttle=IoThrottle(**options['throttle']) if options['throttle'] else None,
+        fadvise=options['fadvise'],
+        parallel_digest_threshold=options['parallel_digest_threshold']
+    )
+    _process_pool = ThreadPoolExecutor(max_workers=options['threads'])
+
+
+def _hash_one(item: Tuple[str, str, int]) -> Optional[tuple]:
+    """Hash one (dirpath, name, tier) item inside a worker process"""
+    dirpath, name, _ = item
+    if _process_stop is not None and _process_stop.is_set():
+        # The scan was stopped; hand the file back unhashed
+        return None
+    hasher = _process_hasher
+    file_path = os.path.join(dirpath, name)
+    try:
+        st = os.lstat(file_path)
+        if not stat.S_ISREG(st.st_mode):
+            # No longer a regular file; reused None marks it as skipped
+            return (dirpath, name, None, None, None, None)
+        file_hashes, reused, link_of = hasher._lookup_or_hash(file_path, st)
+    except Exception:
+        return (dirpath, name, None, False, None, None)
+    if file_hashes is None or QUICK_KEY in file_hashes:
+        digests = file_hashes
+    else:
+        digests = tuple(file_hashes[algo] for algo in hasher.hash_algorithms)
+    return (dirpath, name, digests, reused, link_of, HashIndex.signature(st))
+
+
+def _hash_batch(batch: List[Tuple[str, str, int]]) -> List[tuple]:
+    """
+    Hash a batch of files inside a worker process
+
+    Args:
+        batch: List of (dirpath, name, tier) items; the tier only matters to the parent
+
+    Returns:
+        One (dirpath, name, digests, reused, link_of, signature) tuple per
+        item, with digests in hash_algorithms order, a quick fingerprint
+        dict or None on error; reused is None for skipped items. Items left
+        unhashed because the scan stopped are None.
+    """
+    return list(_process_pool.map(_hash_one, batch))
+
+
+class WatchDaemon:
+    """
+    Keeps the index and the upload stream current from inotify events
+
+    Every directory under the roots gets a watch. Events only mark paths as
+    touched; once a path has been quiet for `debounce` seconds (or has kept
+    changing for max_delay seconds) it is rehashed on a pool of
+    hasher.num_threads threads through _process_file, like in a scan, and
+    compared with its previous index entry. Changes are reported as
+    'added', 'modified' and 'removed' records, as in --state-dir deltas,
+    and uploaded together; changes that could not be uploaded are sent
+    again with the next upload.
+
+    Directories that cannot be watched because the kernel watch limit
+    (fs.inotify.max_user_watches) is reached are rescanned every
+    rescan_interval seconds instead, comparing stat signatures against the
+    index, and watched again as soon as watches free up. A kernel event
+    queue overflow rescans every root.
+    """
+
+    DIR_MASK = (Inotify.CREATE | Inotify.DELETE | Inotify.MODIFY | Inotify.ATTRIB | Inotify.CLOSE_WRITE |
+                Inotify.MOVED_FROM | Inotify.MOVED_TO | Inotify.ONLYDIR | Inotify.DONT_FOLLOW |
+                Inotify.EXCL_UNLINK)
+    # Longest wait in read(), so a stop request is noticed promptly
+    POLL_INTERVAL = 1.0
+    UPLOAD_RETRY = 60.0
+
+    def __init__(self, hasher: 'FileHasher', config: Optional[Dict] = None,
+                 batch_size: int = UPLOAD_BATCH_SIZE, debounce: float = 2.0,
+                 max_delay: float = 30.0, rescan_interval: float = 300.0):
+        """
+        Args:
+            hasher: FileHasher with the roots to watch; it must have an index
+            config: Upload config, or None to only keep the index current
+            batch_size: Files per upload request
+            debounce: Seconds a path must be quiet before it is rehashed
+            max_delay: Rehash paths that keep changing at least this often
+            rescan_interval: Seconds between rescans of unwatched subtrees
+        """
+        if hasher.index is None:
+            raise ValueError("Watch mode needs an index")
+        self.hasher = hasher
+        self.index = hasher.index
+        # Paths are rehashed one at a time, long after the other links of
+        # an inode were seen, so a hardlink table would hand out stale digests
+        hasher.hardlinks = None
+        self.config = config
+        self.batch_size = batch_size
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.rescan_interval = rescan_interval
+        self.header = hasher.system_info()
+
+        self.inotify = Inotify()
+        self.watches = {}   # wd -> (directory, device)
+        self.watched = {}   # directory -> wd
+        self.polled = {}    # directory -> device, rescanned instead of watched
+        self.touched = {}   # path -> (first event, last event)
+        self.unsent = {}    # path -> (dir_name, change record)
+        self.counts = {'added': 0, 'modified': 0, 'removed': 0}
+        self.rescan_all = False
+        self.stopping = False
+        self.next_rescan = time.monotonic() + rescan_interval
+        self.next_upload = 0.0
+        self.pool = ThreadPoolExecutor(max_workers=hasher.num_threads)
+
+    def watch_roots(self):
+        """Add watches for every directory under the roots (call before the initial scan)"""
+        for root in self.hasher.root_paths:
+            if not self.hasher._should_skip_dir(root):
+                self._watch_tree(root, self.hasher._root_device(root))
+        print(f"Watching {len(self.watched)} directories", file=sys.stderr)
+        if self.polled:
+            print(f"{len(self.polled)} subtrees exceed the inotify watch limit and are rescanned "
+                  f"every {self.rescan_interval:.0f}s (raise fs.inotify.max_user_watches to watch them)",
+                  file=sys.stderr)
+
+    def _add_watch(self, dirpath: str, device) -> bool:
+        """Watch one directory; falls back to rescans when the watch limit is reached"""
+        try:
+            wd = self.inotify.add_watch(dirpath, self.DIR_MASK)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                self.polled[dirpath] = device
+            return False
+        self.watches[wd] = (dirpath, device)
+        self.watched[dirpath] = wd
+        return True
+
+    def _watch_tree(self, path: str, device, touch: bool = False):
+        """
+        Watch a directory and its subdirectories
+
+        Args:
+            path: Directory
+            device: Device key of the directory (see FileHasher._walk)
+            touch: Also mark the files found as touched (new or moved-in trees)
+        """
+        now = time.monotonic()
+        stack = [(path, device)]
+        while stack:
+            dirpath, device = stack.pop()
+            if not self._add_watch(dirpath, device):
+                # Unwatched subtrees are left to the rescans
+                continue
+            try:
+                with os.scandir(dirpath) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                if not self.hasher._should_skip_dir(entry.path):
+                                    subdir_device = self.hasher._subdir_device(entry, device)
+                                    if subdir_device is not _SKIP:
+                                        stack.append((entry.path, subdir_device))
+                            elif touch and entry.is_file(follow_symlinks=False):
+                                self._touch(entry.path, now)
+                        except OSError:
+                            continue
+            except OSError:
+                pass
+
+    def _unwatch_tree(self, path: str):
+        """Drop the watches of a directory moved away and of everything under it"""
+        prefix = os.path.join(path, '')
+        for dirpath in [d for d in self.watched if d == path or d.startswith(prefix)]:
+            wd = self.watched.pop(dirpath)
+            self.watches.pop(wd, None)
+            self.inotify.rm_watch(wd)
+        for dirpath in [d for d in self.polled if d == path or d.startswith(prefix)]:
+            del self.polled[dirpath]
+
+    def _touch(self, path: str, now: float):
+        """Mark a path as changed"""
+        if not self.hasher._in_shard(os.path.dirname(path)):
+            return
+        first, _ = self.touched.get(path, (now, now))
+        self.touched[path] = (first, now)
+
+    def _handle(self, wd: int, mask: int, name: str, now: float):
+        """Apply one inotify event"""
+        if mask & Inotify.Q_OVERFLOW:
+            print("inotify event queue overflowed - rescanning all roots", file=sys.stderr)
+            self.rescan_all = True
+            return
+        watch = self.watches.get(wd)
+        if watch is None:
+            return
+        dirpath, device = watch
+        if mask & Inotify.IGNORED:
+            # The directory was deleted or its filesystem unmounted
+            del self.watches[wd]
+            if self.watched.get(dirpath) == wd:
+                del self.watched[dirpath]
+            return
+        if not name:
+            return
+
+        path = os.path.join(dirpath, name)
+        if mask & Inotify.ISDIR:
+            if mask & (Inotify.CREATE | Inotify.MOVED_TO):
+                # A new directory is never a mount point, so it shares its parent's device
+                if not self.hasher._should_skip_dir(path):
+                    self._watch_tree(path, device, touch=True)
+            elif mask & Inotify.MOVED_FROM:
+                self._unwatch_tree(path)
+                self._forget(path)
+            elif mask & Inotify.DELETE:
+                # Its own watch goes away with IN_IGNORED
+                self._forget(path)
+            return
+        self._touch(path, now)
+
+    def _forget(self, path: str):
+        """Report the indexed files of a path that no longer exists as removed"""
+        for file_path, digests in self.index.remove(path):
+            self.touched.pop(file_path, None)
+            self._report('removed', os.path.dirname(file_path), self._previous_result(file_path, digests))
+
+    def _previous_result(self, file_path: str, digests: Dict[str, str]) -> Dict:
+        """Result entry for digests stored in the index"""
+        if all(algo in digests for algo in self.hasher.hash_algorithms):
+            return make_result(file_path, self.hasher.hash_algorithms, digests)
+        if QUICK_KEY in digests:
+            return {'file_name': file_path, 'quick_hash': digests[QUICK_KEY]}
+        return {'file_name': file_path}
+
+    def _refresh(self, file_path: str) -> Optional[Tuple[str, str, Dict]]:
+        """
+        Rehash one touched path (pool thread)
+
+        Returns:
+            (change, dir_name, result), or None if the file is unchanged,
+            unreadable, or was never indexed and is gone again
+        """
+        dir_name = os.path.dirname(file_path)
+        try:
+            st = os.lstat(file_path)
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            removed = self.index.remove(file_path)
+            if not removed:
+                return None
+            return 'removed', dir_name, self._previous_result(file_path, removed[0][1])
+
+        previous = self.index.get(file_path)
+        result = self.hasher._process_file(file_path, dir_name)
+        if not result:
+            return None
+        if previous is None:
+            return 'added', dir_name, result
+        if result == self._previous_result(file_path, previous[1]) or (
+                is_quick(result) and result['quick_hash'] == previous[1].get(QUICK_KEY)):
+            return None
+        return 'modified', dir_name, result
 
-        Returns:
-            Dictionary with system info and file hashes
-        """
-        print(f"Starting scan with {self.num_threads} threads...", file=sys.stderr)
-        print(f"OS: {self.os_type}", file=sys.stderr)
-        print(f"Hash algorithms: {', '.join(self.hash_algorithms)}", file=sys.stderr)
-        print(f"Root paths: {self.root_paths}", file=sys.stderr)
+    def _report(self, change: str, dir_name: str, result: Dict):
+        """Count a change and queue it for upload"""
+        matcher = self.hasher.matcher
+        if change != 'removed' and matcher is not None and not matcher.check(dir_name, result):
+            return
+        self.counts[change] += 1
+        print(f"{change.capitalize()}: {result['file_name']}", file=sys.stderr)
+        if self.config:
+            self.unsent[result['file_name']] = (dir_name, dict(result, change=change))
 
-        # Collect all files first
-        files_to_process = []
-        print("Building file list...", file=sys.stderr)
+    def _rescan(self, path: str, device):
+        """Touch the files under a directory whose signature differs from the index, and those gone"""
+        now = time.monotonic()
+        due = (now - self.max_delay, now - self.debounce)
+        seen = set()
+        stack = [(path, device)]
+        while stack:
+            dirpath, device = stack.pop()
+            try:
+                with os.scandir(dirpath) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                if not self.hasher._should_skip_dir(entry.path):
+                                    subdir_device = self.hasher._subdir_device(entry, device)
+                                    if subdir_device is not _SKIP:
+                                        stack.append((entry.path, subdir_device))
+                            elif entry.is_file(follow_symlinks=False):
+                                seen.add(entry.path)
+                                stored = self.index.get(entry.path)
+                                signature = HashIndex.signature(entry.stat(follow_symlinks=False))
+                                if (stored is None or stored[0] != signature) and self.hasher._in_shard(dirpath):
+                                    self.touched[entry.path] = due
+                        except OSError:
+                            continue
+            except OSError:
+                pass
+        for file_path in self.index.paths(path):
+            if file_path not in seen:
+                self.touched[file_path] = due
 
-        for root_path in self.root_paths:
-            for file_path, dirpath in self._walk_directory(root_path):
-                files_to_process.append((file_path, dirpath))
+    def _rescan_due(self, now: float):
+        """Rescan unwatched subtrees (or all roots after an overflow), retrying their watches first"""
+        if self.rescan_all:
+            self.rescan_all = False
+            for root in self.hasher.root_paths:
+                if not self.hasher._should_skip_dir(root):
+                    self._rescan(root, self.hasher._root_device(root))
+        if now < self.next_rescan:
+            return
+        self.next_rescan = now + self.rescan_interval
+        polled, self.polled = self.polled, {}
+        for dirpath, device in polled.items():
+            # Watch first so changes made during the rescan are not missed
+            self._watch_tree(dirpath, device)
+            self._rescan(dirpath, device)
+        if polled and not self.polled:
+            print(f"All {len(polled)} unwatched subtrees are watched again", file=sys.stderr)
 
-        print(f"Found {len(files_to_process)} files to process", file=sys.stderr)
+    def _process_due(self, now: float, everything: bool = False):
+        """Rehash the touched paths that are due and report the changes"""
+        due = [path for path, (first, last) in self.touched.items()
+               if everything or now - last >= self.debounce or now - first >= self.max_delay]
+        for path in due:
+            del self.touched[path]
+        if due:
+            futures = [self.pool.submit(self._refresh, path) for path in due]
+            for future in futures:
+                change = future.result()
+                if change is not None:
+                    self._report(*change)
+            self.index.flush()
+        if self.unsent and (everything or now >= self.next_upload):
+            self._upload(now)
 
-        # Process files in parallel
-        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
-            futures = []
-            for file_path, dirpath in files_to_process:
-                future = executor.submit(self._process_file, file_path, dirpath)
-                futures.append((future, dirpath))
+    def _upload(self, now: float):
+        """Upload all unsent changes as one delta document"""
+        changes = [self.unsent[path] for path in sorted(self.unsent)]
+        counts = {'added': 0, 'modified': 0, 'removed': 0}
+        for _, record in changes:
+            counts[record['change']] += 1
+        header = dict(self.header, delta=True, watch=True, scan_date=datetime.utcnow().isoformat() + 'Z')
+        totals = {'total_files': len(changes), 'total_errors': 0}
+        totals.update({f'files_{change}': count for change, count in counts.items()})
+        if upload_records(header, changes, lambda: totals, self.config, self.batch_size):
+            self.unsent = {}
+        else:
+            self.next_upload = now + self.UPLOAD_RETRY
+            print(f"✗ Upload failed - {len(self.unsent)} changes will be sent again in "
+                  f"{self.UPLOAD_RETRY:.0f}s", file=sys.stderr)
 
-            # Collect results
-            for future, dirpath in futures:
-                try:
-                    result = future.result()
-                    if result:
-                        with self.lock:
-                            self.results[dirpath]['files'].append(result)
-                except Exception as e:
-                    with self.lock:
-                        self.error_count += 1
-
-        print(f"\nScan complete!", file=sys.stderr)
-        print(f"Files processed: {self.file_count}", file=sys.stderr)
-        print(f"Errors encountered: {self.error_count}", file=sys.stderr)
+    def stop(self, *_):
+        """Ask run() to finish (also the SIGTERM handler)"""
+        self.stopping = True
 
-        # Build final output structure
-        directories = []
-        for dir_name, data in self.results.items():
-            if data['files']:  # Only include directories with files
-                directories.append({
-                    'dir_name': dir_name,
-                    'files': data['files']
-                })
-
-        output = {
-            'system_name': self._get_hostname(),
-            'system_ip': self._get_local_ip(),
-            'system_public': self._get_public_ip(),
-            'os_type': self.os_type,
-            'os_version': platform.platform(),
-            'hash_algorithms': self.hash_algorithms,
-            'scan_date': datetime.utcnow().isoformat() + 'Z',
-            'total_files': self.file_count,
-            'total_errors': self.error_count,
-            'directories': directories
-        }
+    def run(self):
+        """Process events until stop() or Ctrl-C, then hash what is still pending"""
+        previous = signal.signal(signal.SIGTERM, self.stop)
+        print(f"Watching for changes (debounce {self.debounce:g}s) - Ctrl-C to stop", file=sys.stderr)
+        try:
+            while not self.stopping:
+                now = time.monotonic()
+                deadlines = [self.next_rescan]
+                if self.touched:
+                    deadlines.append(min(min(first + self.max_delay, last + self.debounce)
+                                         for first, last in self.touched.values()))
+                if self.unsent:
+                    deadlines.append(self.next_upload)
+                timeout = min(self.POLL_INTERVAL, min(deadlines) - now)
+                for wd, mask, _, name in self.inotify.read(timeout):
+                    self._handle(wd, mask, name, time.monotonic())
+                now = time.monotonic()
+                self._rescan_due(now)
+                self._process_due(now)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+        print("\nStopping watch...", file=sys.stderr)
+        self._process_due(time.monotonic(), everything=True)
+        print(f"Watch summary: {self.counts['added']} added, {self.counts['modified']} modified, "
+              f"{self.counts['removed']} removed", file=sys.stderr)
 
-        return output
+    def close(self):
+        """Release the inotify instance and the hashing pool"""
+        self.pool.shutdown()
+        self.inotify.close()
 
 
 def get_default_roots() -> List[str]:
@@ -387,10 +5260,153 @@ def get_default_roots() -> List[str]:
         return ['/']
 
 
+def convert_main(argv: List[str]):
+    """Entry point for 'file_hasher.py convert'"""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='file_hasher.py convert',
+        description='Convert scan output between JSON, NDJSON and binary manifest formats'
+    )
+    parser.add_argument('input', help='Input file (format is detected)')
+    parser.add_argument('output', help='Output file')
+    parser.add_argument(
+        '--format',
+        choices=['json', 'ndjson', 'binary'],
+        default='json',
+        help='Output format (default: json)'
+    )
+    parser.add_argument(
+        '--compact',
+        action='store_true',
+        help='Write JSON output without indentation'
+    )
+    args = parser.parse_args(argv)
+
+    count = convert_manifest(args.input, args.output, args.format, args.compact)
+    print(f"Converted {count} file records to {args.output} ({args.format}, "
+          f"{os.path.getsize(args.output)} bytes)", file=sys.stderr)
+
+
+def upload_main(argv: List[str]):
+    """Entry point for 'file_hasher.py upload'"""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='file_hasher.py upload',
+        description='Upload (or resume uploading) an existing scan output file'
+    )
+    parser.add_argument('input', help='Scan output file (any format)')
+    parser.add_argument(
+        '--config',
+        type=str,
+        default='config.json',
+        help='Path to config file (default: config.json)'
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=UPLOAD_BATCH_SIZE,
+        help=f'Files per upload request (default: {UPLOAD_BATCH_SIZE})'
+    )
+    args = parser.parse_args(argv)
+
+    config = load_config(args.config)
+    if not config:
+        print(f"Error: No config found at {args.config}", file=sys.stderr)
+        sys.exit(1)
+    if not upload_file(args.input, config, args.batch_size):
+        print("✗ Upload failed - rerun to resume from the last acknowledged batch", file=sys.stderr)
+        sys.exit(1)
+    print("✓ Results uploaded successfully", file=sys.stderr)
+
+
+def merge_main(argv: List[str]):
+    """Entry point for 'file_hasher.py merge'"""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='file_hasher.py merge',
+        description='Combine the manifests of a sharded scan (--shard I/N) into one report'
+    )
+    parser.add_argument('inputs', nargs='+', help='Shard output files (any format)')
+    parser.add_argument('--output', '-o', required=True, help='Merged output file')
+    parser.add_argument(
+        '--format',
+        choices=['json', 'ndjson', 'binary'],
+        default='json',
+        help='Output format (default: json)'
+    )
+    parser.add_argument(
+        '--compact',
+        action='store_true',
+        help='Write JSON output without indentation'
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        totals = merge_manifests(args.inputs, args.output, args.format, args.compact)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(f"Merged {len(args.inputs)} manifests: {totals['total_files']} files, {totals['total_errors']} errors "
+          f"-> {args.output}", file=sys.stderr)
+    if totals['duplicates']:
+        print(f"Files present in more than one input (written once): {totals['duplicates']}", file=sys.stderr)
+
+
+def build_match_db_main(argv: List[str]):
+    """Entry point for 'file_hasher.py build-match-db'"""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='file_hasher.py build-match-db',
+        description='Build a --match-db hash set from lists of known-bad or known-good digests'
+    )
+    parser.add_argument('inputs', nargs='+',
+                        help="Text files with one digest per line (hash lists, sha256sum output, CSV); '-' for stdin")
+    parser.add_argument('--output', '-o', required=True, help='Hash set file to write')
+    parser.add_argument('--algorithm', choices=['sha256', 'sha512', 'sha1', 'md5', 'blake2b', 'sha3_256'],
+                        default=None, help='Digest algorithm (default: inferred from the digest length)')
+    parser.add_argument('--kind', choices=HashSet.KINDS, default='bad',
+                        help="'bad' to report matches, 'good' for known-good files (default: bad)")
+    parser.add_argument('--name', default=None, help='Name reported with matches (default: output file name)')
+    parser.add_argument('--bloom-bits', type=int, default=10,
+                        help='Bloom filter bits per digest (default: 10, about 1%% false positives)')
+    parser.add_argument('--run-size', type=int, default=4000000,
+                        help='Digests sorted in memory at a time (default: 4000000)')
+    args = parser.parse_args(argv)
+
+    start = time.monotonic()
+    try:
+        stats = build_hash_set(args.inputs, args.output, args.algorithm, args.kind, args.name,
+                               args.bloom_bits, args.run_size)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(f"{stats['digests']} {stats['hash_algorithm']} digests ({stats['duplicates']} duplicates dropped) "
+          f"written to {args.output} in {time.monotonic() - start:.1f}s", file=sys.stderr)
+    print(f"Bloom filter: {stats['bloom_bits'] // 8} bytes, {stats['bloom_hashes']} hashes, "
+          f"{stats['false_positive_rate']:.2%} false positives", file=sys.stderr)
+
+
+# Subcommands; anything else on the command line is a scan
+COMMANDS = {
+    'convert': convert_main,
+    'upload': upload_main,
+    'merge': merge_main,
+    'build-match-db': build_match_db_main
+}
+
+
 def main():
     """Main entry point"""
     import argparse
 
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser(
         description='Multi-threaded file hasher for system inventory'
     )
@@ -406,17 +5422,113 @@ def main():
         default=None,
         help='Specific file(s) to hash instead of scanning directories'
     )
+    parser.add_argument(
+        '--files-from',
+        type=str,
+        default=None,
+        metavar='PATH',
+        help="Hash the files listed in PATH ('-' for stdin), NUL- or newline-delimited as written by "
+             "find -print0 / find -print, instead of scanning directories"
+    )
     parser.add_argument(
         '--threads',
         type=int,
         default=32,
         help='Number of worker threads (default: 32)'
     )
+    parser.add_argument(
+        '--workers',
+        choices=['threads', 'processes'],
+        default='threads',
+        help='Hashing backend: one thread pool, or a process pool sharing --threads (default: threads)'
+    )
+    parser.add_argument(
+        '--processes',
+        type=int,
+        default=None,
+        help='Number of worker processes with --workers processes (default: CPU count)'
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=256,
+        help='Files per batch sent to a worker process (default: 256)'
+    )
+    parser.add_argument(
+        '--one-file-system',
+        action='store_true',
+        help='Do not descend into directories on other filesystems'
+    )
+    parser.add_argument(
+        '--include-network-fs',
+        action='store_true',
+        help='Also scan network filesystems (NFS, CIFS, sshfs, ...)'
+    )
+    parser.add_argument(
+        '--skip-fs-types',
+        nargs='+',
+        default=None,
+        help='Additional filesystem types to skip (Linux; pseudo filesystems are always skipped)'
+    )
+    parser.add_argument(
+        '--hdd-threads',
+        type=int,
+        default=2,
+        help='Concurrent hashing threads per rotational disk (default: 2)'
+    )
+    parser.add_argument(
+        '--network-threads',
+        type=int,
+        default=4,
+        help='Concurrent hashing threads per network filesystem, always fewer than --threads (default: 4)'
+    )
+    parser.add_argument(
+        '--shard',
+        type=parse_shard,
+        default=None,
+        metavar='I/N',
+        help='Hash only shard I of N (0-based) of the roots; combine the shard outputs with merge'
+    )
+    parser.add_argument(
+        '--shard-by',
+        choices=['dir', 'top'],
+        default='dir',
+        help="Split by a hash of each directory's path (dir, default) or by top-level directory (top)"
+    )
+    parser.add_argument(
+        '--walk-threads',
+        type=int,
+        default=None,
+        help='Number of directory walker threads (default: min(threads, 8))'
+    )
+    parser.add_argument(
+        '--walk-only',
+        action='store_true',
+        help='Only walk the directory tree and report walk throughput'
+    )
+    parser.add_argument(
+        '--queue-size',
+        type=int,
+        default=None,
+        help='Capacity of the work and result queues (default: 4 x threads)'
+    )
     parser.add_argument(
         '--output',
         type=str,
         default='file_hashes.json',
-        help='Output JSON file (default: file_hashes.json)'
+        help='Output file (default: file_hashes.json)'
+    )
+    parser.add_argument(
+        '--format',
+        choices=['json', 'ndjson', 'binary'],
+        default='json',
+        help='Output format: streamed JSON in the regular schema, one JSON record per line, '
+             'or a compact binary manifest (default: json)'
+    )
+    parser.add_argument(
+        '--compact',
+        action='store_true',
+        help='Write JSON output without indentation'
     )
     parser.add_argument(
         '--chunk-size',
@@ -424,19 +5536,219 @@ def main():
         default=65536,
         help='File read chunk size in bytes (default: 65536)'
     )
+    parser.add_argument(
+        '--mmap-threshold',
+        type=int,
+        default=64 * 1024 * 1024,
+        help='Hash files of at least this many bytes via mmap; 0 disables (default: 67108864)'
+    )
+    parser.add_argument(
+        '--max-read-rate',
+        type=float,
+        default=0,
+        help='Limit reads to this many MiB/s (default: unlimited)'
+    )
+    parser.add_argument(
+        '--max-file-rate',
+        type=float,
+        default=0,
+        help='Limit hashing to this many files/s (default: unlimited)'
+    )
+    parser.add_argument(
+        '--adaptive-io',
+        action='store_true',
+        help='Back off while system iowait is above --iowait-threshold (Linux)'
+    )
+    parser.add_argument(
+        '--iowait-threshold',
+        type=float,
+        default=20.0,
+        help='iowait percentage at which --adaptive-io backs off (default: 20)'
+    )
+    parser.add_argument(
+        '--no-fadvise',
+        action='store_true',
+        help='Do not drop hashed files from the page cache (posix_fadvise DONTNEED)'
+    )
+    parser.add_argument(
+        '--parallel-digest-threshold',
+        type=int,
+        default=16 * 1024 * 1024,
+        help='With several --hash algorithms, hash files of at least this many bytes '
+             'with one thread per algorithm; 0 disables (default: 16777216)'
+    )
+    parser.add_argument(
+        '--no-dedup-hardlinks',
+        action='store_true',
+        help='Hash every hardlink separately instead of once per inode'
+    )
     parser.add_argument(
         '--hash',
         nargs='+',
-        choices=['sha256', 'sha512'],
+        choices=list(HASH_ALGORITHMS),
         default=['sha512'],
         help='Hash algorithm(s) to use (default: sha512). Can specify multiple: --hash sha256 sha512'
     )
+    parser.add_argument(
+        '--tree-hash',
+        action='store_true',
+        help=f'Use the {TreeHash.name} Merkle digest (4 MiB leaves, hashed in parallel) instead of --hash'
+    )
+    parser.add_argument(
+        '--mode',
+        choices=['full', 'quick'],
+        default='full',
+        help='quick: fingerprint size and sampled blocks instead of full digests (fast triage)'
+    )
+    parser.add_argument(
+        '--quick-sample',
+        type=int,
+        default=64,
+        help='KiB read from the start, middle and end of each file in quick mode (default: 64)'
+    )
+    parser.add_argument(
+        '--full-for',
+        nargs='*',
+        choices=['exec', 'recent'],
+        default=['exec', 'recent'],
+        help='Files still fully hashed in quick mode (default: exec recent)'
+    )
+    parser.add_argument(
+        '--recent-days',
+        type=float,
+        default=7.0,
+        help="Files modified within this many days count as 'recent' (default: 7)"
+    )
+    parser.add_argument(
+        '--complete',
+        type=str,
+        default=None,
+        metavar='QUICK_OUTPUT',
+        help='Upgrade the quick fingerprints in a quick scan output to full digests '
+             '(only those given with --files, if any)'
+    )
+    parser.add_argument(
+        '--index',
+        type=str,
+        default=None,
+        help='Persistent hash index (SQLite); unchanged files reuse their stored digests'
+    )
+    parser.add_argument(
+        '--full',
+        action='store_true',
+        help='Rehash every file even if the index has its digests'
+    )
+    parser.add_argument(
+        '--prune-index',
+        action='store_true',
+        help='Remove index entries under the scanned roots that no longer exist'
+    )
     parser.add_argument(
         '--config',
         type=str,
         default='config.json',
         help='Path to config file (default: config.json)'
     )
+    parser.add_argument(
+        '--metrics-interval',
+        type=float,
+        default=10.0,
+        help='Seconds between progress reports (default: 10)'
+    )
+    parser.add_argument(
+        '--metrics-file',
+        type=str,
+        default=None,
+        help="Append metrics as JSON lines to this file ('-' for stderr)"
+    )
+    parser.add_argument(
+        '--prometheus-textfile',
+        type=str,
+        default=None,
+        help='Keep scan metrics in this Prometheus textfile-collector file (e.g. .../file_hasher.prom)'
+    )
+    parser.add_argument(
+        '--match-db',
+        type=str,
+        nargs='+',
+        default=None,
+        metavar='PATH',
+        help='Check every digest against these hash sets (built with build-match-db) as files are hashed'
+    )
+    parser.add_argument(
+        '--match-output',
+        type=str,
+        default=None,
+        help='NDJSON file for --match-db hits (default: <output>.matches.ndjson)'
+    )
+    parser.add_argument(
+        '--drop-known-good',
+        action='store_true',
+        help="Leave files found in a 'good' hash set out of the output and the upload"
+    )
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help='After the scan, keep running and rehash files as they change (Linux, needs --index)'
+    )
+    parser.add_argument(
+        '--watch-debounce',
+        type=float,
+        default=2.0,
+        help='With --watch, seconds a file must be left alone before it is rehashed (default: 2)'
+    )
+    parser.add_argument(
+        '--watch-rescan-interval',
+        type=float,
+        default=300.0,
+        help='With --watch, seconds between rescans of directories beyond the inotify watch limit '
+             '(default: 300)'
+    )
+    parser.add_argument(
+        '--deadline',
+        type=float,
+        default=None,
+        metavar='SECONDS',
+        help='Stop hashing after this many seconds and keep the partial result; system binaries, PATH, '
+             '/etc, executable and recently modified files are hashed first'
+    )
+    parser.add_argument(
+        '--max-bytes',
+        type=parse_size,
+        default=None,
+        help='Stop hashing once this many bytes have been read (K/M/G/T suffixes allowed); '
+             'prioritizes like --deadline'
+    )
+    parser.add_argument(
+        '--checkpoint-interval',
+        type=float,
+        default=0,
+        help='Save finished directories to <output>.checkpoint every this many seconds, so an interrupted '
+             'scan can be resumed with --resume (default: off; json and ndjson output only)'
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='Continue an interrupted scan from <output>.checkpoint, keeping the results of finished directories'
+    )
+    parser.add_argument(
+        '--state-dir',
+        type=str,
+        default=None,
+        help='Keep the previous scan here and report only added/modified/removed files'
+    )
+    parser.add_argument(
+        '--full-snapshot-every',
+        type=int,
+        default=7,
+        help='With --state-dir, report a full snapshot every N scans (default: 7)'
+    )
+    parser.add_argument(
+        '--upload-batch-size',
+        type=int,
+        default=UPLOAD_BATCH_SIZE,
+        help=f'Files per upload request (default: {UPLOAD_BATCH_SIZE})'
+    )
     parser.add_argument(
         '--no-upload',
         action='store_true',
@@ -445,102 +5757,304 @@ def main():
 
     args = parser.parse_args()
 
-    # Handle file-specific hashing
-    if args.files:
-        # Validate that all provided files exist
-        valid_files = []
-        for file_path in args.files:
-            if os.path.isfile(file_path):
-                valid_files.append(file_path)
-            else:
-                print(f"Warning: '{file_path}' is not a valid file, skipping", file=sys.stderr)
+    if args.format == 'binary' and (args.mode == 'quick' or args.complete):
+        parser.error('quick fingerprints cannot be stored in binary manifests; use --format json or ndjson')
 
-        if not valid_files:
-            print("Error: No valid files provided", file=sys.stderr)
-            sys.exit(1)
+    if args.tree_hash:
+        args.hash = [TreeHash.name]
 
-        print(f"Hashing {len(valid_files)} file(s)...", file=sys.stderr)
-        print(f"Hash algorithms: {', '.join(args.hash)}", file=sys.stderr)
+    listed = bool(args.files or args.files_from)
+    if args.files_from and args.complete:
+        parser.error('--complete takes the files to upgrade from --files; --files-from is not supported')
 
-        # Create a minimal hasher instance just for hashing
+    if args.shard:
+        if listed or args.complete:
+            parser.error('--shard splits the --root directories; it cannot be combined with '
+                         '--files, --files-from or --complete')
+        if args.output == parser.get_default('output'):
+            base, ext = os.path.splitext(args.output)
+            args.output = f"{base}.shard-{args.shard[0]}-of-{args.shard[1]}{ext}"
+
+    if args.watch:
+        if not Inotify.available():
+            parser.error('--watch needs inotify (Linux)')
+        if not args.index:
+            parser.error('--watch needs --index to tell changed files from unchanged ones')
+        if listed or args.complete or args.walk_only:
+            parser.error('--watch watches --root directories; it cannot be combined with '
+                         '--files, --files-from, --complete or --walk-only')
+
+    if args.deadline or args.max_bytes:
+        if listed or args.complete or args.walk_only or args.watch:
+            parser.error('--deadline and --max-bytes budget a --root scan; they cannot be combined with '
+                         '--files, --files-from, --complete, --walk-only or --watch')
+
+    # Checkpoints are opt-in: an explicit interval, or a --resume that keeps checkpointing
+    checkpoint_interval = args.checkpoint_interval
+    if args.resume and not checkpoint_interval:
+        checkpoint_interval = ScanCheckpoint.DEFAULT_INTERVAL
+    checkpoints = checkpoint_interval > 0 and args.format != 'binary'
+    if args.resume:
+        if listed or args.complete or args.walk_only:
+            parser.error('--resume continues a --root scan; it cannot be combined with '
+                         '--files, --files-from, --complete or --walk-only')
+        if not checkpoints:
+            parser.error('--resume needs json or ndjson output and a positive --checkpoint-interval')
+
+    matcher = None
+    if args.match_db:
+        if args.complete:
+            parser.error('--match-db checks files as they are hashed; it cannot be combined with --complete')
+        match_output = args.match_output or f"{os.path.splitext(args.output)[0]}.matches.ndjson"
+        try:
+            matcher = HashMatcher([HashSet(path) for path in args.match_db], args.hash, match_output,
+                                  args.drop_known_good)
+        except (OSError, ValueError) as e:
+            parser.error(f'--match-db: {e}')
+
+    index = HashIndex(args.index) if args.index else None
+    daemon = None
+    throttle = None
+    partial = False
+    if args.max_read_rate or args.max_file_rate or args.adaptive_io:
+        throttle = IoThrottle(args.max_read_rate * 1024 * 1024, args.max_file_rate,
+                              args.adaptive_io, args.iowait_threshold)
+
+    if args.complete:
+        # Upgrade quick fingerprints from an earlier --mode quick scan
+        with ManifestReader(args.complete) as reader:
+            algorithms = reader.header.get('hash_algorithms', args.hash)
+        print(f"Completing quick entries of {args.complete}...", file=sys.stderr)
         hasher = FileHasher(
             root_paths=[],
-            num_threads=1,
+            num_threads=args.threads,
             chunk_size=args.chunk_size,
-            hash_algorithms=args.hash
+            hash_algorithms=algorithms,
+            mmap_threshold=args.mmap_threshold,
+            throttle=throttle,
+            fadvise=not args.no_fadvise,
+            parallel_digest_threshold=args.parallel_digest_threshold
         )
-
-        # Hash each file
-        file_results = []
-        for file_path in valid_files:
-            abs_path = os.path.abspath(file_path)
-            path_obj = Path(abs_path)
-            result = hasher._process_file(path_obj, os.path.dirname(abs_path))
-            if result:
-                file_results.append(result)
-                print(f"Hashed: {file_path}", file=sys.stderr)
-            else:
-                print(f"Failed to hash: {file_path}", file=sys.stderr)
-
-        # Build results in the same format as directory scan
-        results = {
-            'system_name': hasher._get_hostname(),
-            'system_ip': hasher._get_local_ip(),
-            'system_public': hasher._get_public_ip(),
-            'os_type': hasher.os_type,
-            'os_version': platform.platform(),
-            'hash_algorithms': args.hash,
-            'scan_date': datetime.utcnow().isoformat() + 'Z',
-            'total_files': len(file_results),
-            'total_errors': len(valid_files) - len(file_results),
-            'directories': [{'dir_name': 'specified_files', 'files': file_results}] if file_results else []
-        }
+        print(f"\nWriting results to {args.output}...", file=sys.stderr)
+        totals = complete_manifest(args.complete, args.output, args.format, hasher, args.compact, args.files)
+        print(f"Upgraded to full digests: {totals['upgraded']}", file=sys.stderr)
+        print(f"Quick fingerprints remaining: {totals['quick_files']}", file=sys.stderr)
+    # Handle file-specific hashing
     else:
-        # Get root paths
-        root_paths = args.root if args.root else get_default_roots()
+        file_list = None
+        list_file = None
+        if listed:
+            # Files given on the command line are checked up front, listed ones as they are hashed
+            valid_files = []
+            for file_path in args.files or []:
+                if os.path.isfile(file_path):
+                    valid_files.append(file_path)
+                else:
+                    print(f"Warning: '{file_path}' is not a valid file, skipping", file=sys.stderr)
+
+            if not valid_files and not args.files_from:
+                print("Error: No valid files provided", file=sys.stderr)
+                sys.exit(1)
+
+            file_list = valid_files
+            if args.files_from:
+                try:
+                    list_file = sys.stdin.buffer if args.files_from == '-' else open(args.files_from, 'rb')
+                except OSError as e:
+                    parser.error(f'--files-from: {e}')
+
+                def listed_files():
+                    yield from valid_files
+                    yield from read_paths(list_file)
+
+                file_list = listed_files()
+            valid_roots = []
+        else:
+            # Get root paths
+            root_paths = args.root if args.root else get_default_roots()
 
-        # Verify root paths exist
-        valid_roots = [r for r in root_paths if os.path.exists(r)]
-        if not valid_roots:
-            print("Error: No valid root paths found", file=sys.stderr)
-            sys.exit(1)
+            # Verify root paths exist
+            valid_roots = [r for r in root_paths if os.path.exists(r)]
+            if not valid_roots:
+                print("Error: No valid root paths found", file=sys.stderr)
+                sys.exit(1)
+
+        checkpoint = None
+        previous_output = None
+        if checkpoints and not args.walk_only and not listed:
+            checkpoint_path = args.output + '.checkpoint'
+            scan_params = {
+                'roots': valid_roots,
+                'hash_algorithms': args.hash,
+                'format': args.format,
+                'compact': args.compact,
+                'mode': args.mode,
+                'shard': list(args.shard) if args.shard else None,
+                'shard_by': args.shard_by
+            }
+            if args.resume:
+                try:
+                    checkpoint = ScanCheckpoint.load(checkpoint_path, scan_params, checkpoint_interval)
+                except ValueError as e:
+                    parser.error(f'--resume: {e}')
+                # A previous resume may have stopped while copying; its source is still there
+                previous_output = args.output + '.resume'
+                if not os.path.exists(previous_output):
+                    try:
+                        os.replace(args.output, previous_output)
+                    except OSError as e:
+                        parser.error(f'--resume: cannot read the interrupted output: {e}')
+                    if not checkpoint.finalized:
+                        # Killed without closing the output: keep what the checkpoint covers
+                        writer_class = NdjsonResultWriter if args.format == 'ndjson' else JsonResultWriter
+                        writer_class.seal(previous_output, checkpoint.writer_state)
+            else:
+                checkpoint = ScanCheckpoint(checkpoint_path, scan_params, checkpoint_interval)
 
         # Create hasher and scan
         hasher = FileHasher(
             root_paths=valid_roots,
             num_threads=args.threads,
             chunk_size=args.chunk_size,
-            hash_algorithms=args.hash
+            hash_algorithms=args.hash,
+            queue_size=args.queue_size,
+            walk_threads=args.walk_threads,
+            index=index,
+            full_rehash=args.full,
+            worker_mode=args.workers,
+            num_processes=args.processes,
+            batch_size=args.batch_size,
+            mmap_threshold=args.mmap_threshold,
+            dedup_hardlinks=not args.no_dedup_hardlinks,
+            one_file_system=args.one_file_system,
+            include_network_fs=args.include_network_fs,
+            skip_fs_types=args.skip_fs_types,
+            hdd_threads=args.hdd_threads,
+            network_threads=args.network_threads,
+            metrics_interval=args.metrics_interval,
+            metrics_path=args.metrics_file,
+            prometheus_path=args.prometheus_textfile,
+            mode=args.mode,
+            quick_sample=args.quick_sample * 1024,
+            full_for=args.full_for,
+            recent_days=args.recent_days,
+            throttle=throttle,
+            fadvise=not args.no_fadvise,
+            parallel_digest_threshold=args.parallel_digest_threshold,
+            matcher=matcher,
+            shard=args.shard,
+            shard_by=args.shard_by,
+            checkpoint=checkpoint,
+            deadline=args.deadline,
+            max_bytes=args.max_bytes,
+            files=file_list,
+            # --files on its own keeps grouping its results under one entry
+            files_dir_name='specified_files' if args.files and not args.files_from else None
         )
 
-        results = hasher.scan()
+        if args.walk_only:
+            stats = hasher.walk()
+            print(f"Regular files found: {stats['files']}", file=sys.stderr)
+            return
+
+        if args.watch:
+            # Watches go in before the scan so nothing changed during it is missed
+            daemon = WatchDaemon(
+                hasher,
+                config=None if args.no_upload else load_config(args.config),
+                batch_size=args.upload_batch_size,
+                debounce=args.watch_debounce,
+                rescan_interval=args.watch_rescan_interval
+            )
+            daemon.watch_roots()
 
-    # Write output to local file
-    print(f"\nWriting results to {args.output}...", file=sys.stderr)
-    with open(args.output, 'w') as f:
-        json.dump(results, f, indent=2)
+        print(f"\nWriting results to {args.output}...", file=sys.stderr)
+        if checkpoint is not None:
+            # Let a service manager's stop close the output like Ctrl-C does
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+        output = hasher.scan(writer=open_writer(args.output, args.format, args.compact),
+                             previous_output=previous_output)
+        if list_file is not None and list_file is not sys.stdin.buffer:
+            list_file.close()
+
+        if output.get('resume_token'):
+            print(f"Partial output written to {args.output} (resume token {output['resume_token']})",
+                  file=sys.stderr)
+            command = ' '.join(arg for arg in sys.argv if arg != '--resume')
+            print(f"  Resume with: {command} --resume", file=sys.stderr)
+        partial = output.get('partial', False)
+        if output.get('stopped_by') == 'interrupt':
+            for closable in (index, throttle, matcher):
+                if closable is not None:
+                    closable.close()
+            sys.exit(130)
+
+        if index is not None and args.prune_index and not partial:
+            removed = index.prune(valid_roots)
+            print(f"Pruned {removed} deleted entries from index", file=sys.stderr)
+
+    if index is not None:
+        index.flush()
 
     print(f"Output written to {args.output}", file=sys.stderr)
     print(f"File size: {os.path.getsize(args.output)} bytes", file=sys.stderr)
+    if matcher is not None:
+        print(f"Match database hits written to {matcher.output_path}", file=sys.stderr)
+
+    # Report only the changes since the previous scan when state is kept
+    report_path = args.output
+    delta_state = None
+    if args.state_dir and partial:
+        print("Partial scan: sending it in full and keeping the previous delta state", file=sys.stderr)
+    elif args.state_dir:
+        delta_state = DeltaState(args.state_dir, args.full_snapshot_every)
+        base, ext = os.path.splitext(args.output)
+        delta_format = 'ndjson' if args.format == 'binary' else args.format
+        report_path, _ = delta_state.prepare(args.output, f"{base}.delta{ext}", delta_format, args.compact)
 
     # Upload results if config exists and upload is not disabled
     if not args.no_upload:
         config = load_config(args.config)
         if config:
             print(f"\nConfig found at {args.config}", file=sys.stderr)
-            if upload_results(results, config):
+            if upload_file(report_path, config, args.upload_batch_size):
                 print("✓ Results uploaded successfully", file=sys.stderr)
+                if delta_state is not None:
+                    delta_state.commit()
             else:
                 print("✗ Upload failed - results saved locally only", file=sys.stderr)
+                # The checkpoint is keyed on the batch size, so the rerun must use the same one
+                print(f"  Resume with: {sys.argv[0]} upload {report_path} --config {args.config} "
+                      f"--batch-size {args.upload_batch_size}", file=sys.stderr)
         else:
             print(f"\nNo config found at {args.config} - skipping upload", file=sys.stderr)
+            if delta_state is not None:
+                delta_state.commit()
     else:
         print("\nUpload disabled - results saved locally only", file=sys.stderr)
+        if delta_state is not None:
+            delta_state.commit()
+
+    if daemon is not None:
+        try:
+            daemon.run()
+        finally:
+            daemon.close()
+
+    if index is not None:
+        index.close()
+    if throttle is not None:
+        throttle.close()
+    if matcher is not None:
+        matcher.close()
 
     print("\nComplete!", file=sys.stderr)
 
 
 if __name__ == '__main__':
+    # Required for --workers processes in PyInstaller builds
+    multiprocessing.freeze_support()
+
     # On Unix systems, check if we should use setuid behavior
     if platform.system() != 'Windows':
         # Set process to only read files (drop write permissions where possible)
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+Tests for file_hasher
+Run with: python3 -m unittest -v test_file_hasher (or pytest)
+"""
+
+import os
+import sys
+import gzip
+import json
+import shutil
+import hashlib
+import tempfile
+import unittest
+import threading
+import contextlib
+import http.server
+
+from file_hasher import (FileHasher, ManifestReader, MountTable, ScanCheckpoint, complete_manifest, is_quick,
+                         open_writer, upload_file)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+@contextlib.contextmanager
+def quiet_stderr():
+    """Silence FileHasher progress output"""
+    saved = sys.stderr
+    sys.stderr = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stderr.close()
+        sys.stderr = saved
+
+
+class TreeTestCase(unittest.TestCase):
+    """Runs every test in a scratch directory (not under /tmp, which scans skip)"""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.workdir = tempfile.mkdtemp(prefix='.test_hasher_', dir=HERE)
+        os.chdir(self.workdir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    @staticmethod
+    def write(path: str, data: bytes, old: bool = False):
+        """Create a file; old ones fall outside the quick mode recent window"""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        if old:
+            os.utime(path, (0, 0))
+
+
+class CompleteManifestTest(TreeTestCase):
+    """--complete upgrades quick fingerprints to full digests"""
+
+    def test_relative_root(self):
+        for name in ('a', 'b'):
+            self.write(os.path.join('tree', 'c', name), os.urandom(64 * 1024), old=True)
+        hasher = FileHasher(['tree'], num_threads=2, hash_algorithms=['sha256'], mode='quick', quick_sample=4096)
+        with quiet_stderr():
+            hasher.scan(open_writer('quick.json', 'json'))
+            totals = complete_manifest('quick.json', 'full.json', 'json', hasher,
+                                       paths=[os.path.join('tree', 'c', 'a')])
+        self.assertEqual(totals['upgraded'], 1)
+        with ManifestReader('full.json') as reader:
+            quick = {result['file_name']: is_quick(result) for _, result in reader}
+        self.assertEqual(quick, {os.path.join('tree', 'c', 'a'): False, os.path.join('tree', 'c', 'b'): True})
+
+
+class SparseFileTest(TreeTestCase):
+    """Files with holes hash to the same digests as a dense read"""
+
+    SIZE = 4 * 1024 * 1024
+    EXTENT = 64 * 1024
+    LAYOUTS = {
+        'all-hole': [],
+        'data-in-middle': [SIZE // 2],
+        'hole-at-start': [SIZE - EXTENT],
+        'hole-at-end': [0],
+        'scattered': list(range(EXTENT, SIZE, 16 * EXTENT)),
+    }
+
+    def make_sparse(self, path: str, extents):
+        with open(path, 'wb') as f:
+            f.truncate(self.SIZE)
+            for offset in extents:
+                f.seek(offset)
+                f.write(os.urandom(self.EXTENT))
+
+    @staticmethod
+    def dense_digests(path: str, algorithms):
+        hashers = [hashlib.new(algo) for algo in algorithms]
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                for hasher in hashers:
+                    hasher.update(block)
+        return {algo: hasher.hexdigest() for algo, hasher in zip(algorithms, hashers)}
+
+    def check(self, path: str, algorithms, expect_sparse: bool):
+        hasher = FileHasher([], num_threads=2, hash_algorithms=algorithms, fadvise=False)
+        used = []
+        feed_sparse = hasher._feed_sparse
+
+        def recording(*args):
+            used.append(True)
+            return feed_sparse(*args)
+
+        hasher._feed_sparse = recording
+        self.assertEqual(hasher._hash_file(path), self.dense_digests(path, algorithms))
+        if expect_sparse:
+            self.assertTrue(used, "the sparse read path was not taken")
+
+    def test_layouts(self):
+        for name, extents in self.LAYOUTS.items():
+            path = os.path.join(self.workdir, name)
+            self.make_sparse(path, extents)
+            holes = os.stat(path).st_blocks * 512 < self.SIZE
+            for algorithms in (['sha256'], ['sha256', 'sha512']):
+                with self.subTest(layout=name, algorithms=algorithms):
+                    self.check(path, algorithms, expect_sparse=holes)
+
+    def test_dense(self):
+        path = os.path.join(self.workdir, 'dense')
+        self.write(path, os.urandom(self.SIZE))
+        for algorithms in (['sha256'], ['sha256', 'sha512']):
+            with self.subTest(algorithms=algorithms):
+                self.check(path, algorithms, expect_sparse=False)
+
+    def test_hole_at_end_after_extension(self):
+        # Data written first, then the file extended with a hole
+        path = os.path.join(self.workdir, 'extended')
+        self.write(path, os.urandom(3 * self.EXTENT + 123))
+        os.truncate(path, self.SIZE + 4567)
+        self.check(path, ['sha512'], expect_sparse=os.stat(path).st_blocks * 512 < self.SIZE)
+
+
+class DeviceBudgetTest(TreeTestCase):
+    """Per-device worker budgets of the thread backend"""
+
+    MOUNTINFO = (
+        '22 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw\n'
+        '40 22 0:53 / /mnt/nfs rw,relatime shared:20 - nfs4 server:/export rw\n'
+        '41 22 0:54 / /mnt/share rw,relatime shared:21 - cifs //server/share rw\n'
+    )
+
+    def hasher(self, num_threads: int, network_threads: int) -> FileHasher:
+        with open('mountinfo', 'w') as f:
+            f.write(self.MOUNTINFO)
+        hasher = FileHasher([], num_threads=num_threads, network_threads=network_threads)
+        hasher.mounts = MountTable.load('mountinfo')
+        return hasher
+
+    def test_network_mounts_are_bounded(self):
+        hasher = self.hasher(num_threads=32, network_threads=4)
+        self.assertEqual(hasher._device_budget('0:53'), 4)
+        self.assertEqual(hasher._device_budget('0:54'), 4)
+        self.assertEqual(hasher._device_budget('8:1'), hasher.hdd_threads if hasher.mounts.is_rotational('8:1')
+                         else 32)
+
+    def test_network_budget_leaves_a_worker(self):
+        # A network mount never gets every worker, whatever --network-threads says
+        self.assertEqual(self.hasher(num_threads=4, network_threads=8)._device_budget('0:53'), 3)
+        self.assertEqual(self.hasher(num_threads=1, network_threads=8)._device_budget('0:53'), 1)
+
+
+class CheckpointTest(TreeTestCase):
+    """Finished-directory accounting of scan checkpoints"""
+
+    def test_skipped_file_is_not_an_error(self):
+        # A deferred file replaced by a symlink before it was hashed
+        self.write(os.path.join('tree', 'a'), b'a')
+        self.write(os.path.join('tree', 'b'), b'b')
+        os.symlink('a', os.path.join('tree', 'c'))
+        hasher = FileHasher([], num_threads=1, hash_algorithms=['sha256'])
+        results = [(os.path.abspath('tree'), hasher._process_file(os.path.join('tree', name), 'tree'), 2)
+                   for name in ('a', 'b', 'c', 'missing')]
+        self.assertIs(results[2][1], False)
+        self.assertIsNone(results[3][1])
+        self.assertEqual(hasher.error_count, 1)
+
+        checkpoint = ScanCheckpoint('scan.checkpoint', {})
+        checkpoint.listed(os.path.abspath('tree'), len(results), [])
+        checkpoint.done(results)
+        self.assertEqual(checkpoint.completed, {os.path.abspath('tree'): [2, 1]})
+
+
+class UploadStub(http.server.ThreadingHTTPServer):
+    """
+    Local upload endpoint that records every request
+
+    failures maps a batch index to the status codes to answer its next
+    requests with (one per request); other requests get 200.
+    """
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            index = int(self.headers['X-Batch-Index'])
+            pending = self.server.failures.get(index)
+            status = pending.pop(0) if pending else 200
+            self.server.requests.append({'headers': dict(self.headers), 'body': body, 'status': status})
+            self.send_response(status)
+            if status == 503:
+                self.send_header('Retry-After', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), self.Handler)
+        self.requests = []
+        self.failures = {}
+
+
+class UploadTest(TreeTestCase):
+    """Batched upload protocol against a local stub server"""
+
+    FILES = 120
+    BATCH_SIZE = 50
+
+    def setUp(self):
+        super().setUp()
+        self.server = UploadStub()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.config = {'endpoint_url': f'http://127.0.0.1:{self.server.server_port}/upload',
+                       'email': 'test@example.com', 'api_key': 'test', 'upload_retries': 2, 'upload_timeout': 10}
+
+        self.path = 'upload.json'
+        self.expected = []
+        writer = open_writer(self.path, 'json')
+        writer.begin({'system_name': 'test', 'hash_algorithms': ['sha256']})
+        for i in range(self.FILES):
+            dir_name = f'/data/d{i // 20}'
+            result = {'file_name': f'{dir_name}/f{i}', 'file_hash': f'{i:064x}'}
+            writer.write(dir_name, result)
+            self.expected.append(result['file_name'])
+        writer.end({'total_files': self.FILES, 'total_errors': 0})
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super().tearDown()
+
+    def upload(self) -> bool:
+        with quiet_stderr():
+            return upload_file(self.path, self.config, self.BATCH_SIZE)
+
+    @staticmethod
+    def indices(requests):
+        return [int(request['headers']['X-Batch-Index']) for request in requests]
+
+    def test_retry_stop_and_resume(self):
+        batches = -(-self.FILES // self.BATCH_SIZE)
+        checkpoint = self.path + '.upload-checkpoint'
+
+        # Batch 0 is retried after a 503, batch 1 is rejected with a 400
+        self.server.failures = {0: [503], 1: [400]}
+        self.assertFalse(self.upload())
+        first_run = list(self.server.requests)
+        self.assertEqual(self.indices(first_run), [0, 0, 1], "a 4xx must stop the upload without a retry")
+        self.assertEqual(first_run[0]['headers']['Idempotency-Key'], first_run[1]['headers']['Idempotency-Key'])
+        self.assertTrue(os.path.exists(checkpoint))
+
+        # The rerun resumes after the last acknowledged batch, in the same session
+        self.assertTrue(self.upload())
+        resumed = self.server.requests[len(first_run):]
+        self.assertEqual(self.indices(resumed), list(range(1, batches)))
+        self.assertFalse(os.path.exists(checkpoint))
+
+        uploaded = []
+        sessions = set()
+        for request in first_run[1:2] + resumed:
+            headers = request['headers']
+            self.assertEqual(headers['Content-Encoding'], 'gzip')
+            payload = json.loads(gzip.decompress(request['body']))
+            sessions.add(payload['scan_session'])
+            self.assertEqual(headers['Idempotency-Key'], f"{payload['scan_session']}-{payload['batch_index']}")
+            uploaded.extend(result['file_name'] for entry in payload['directories'] for result in entry['files'])
+        self.assertEqual(len(sessions), 1, "the resumed upload started a new session")
+        self.assertEqual(uploaded, self.expected)
+        self.assertTrue(payload['batch_final'])
+        self.assertEqual((payload['batch_count'], payload['total_files']), (batches, self.FILES))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,6 +3,12 @@
 # Safe to run without sudo
 
 echo "=== File Hasher Test ==="
+echo "Running unit tests..."
+if ! python3 -m unittest test_file_hasher; then
+    echo "Unit tests failed!"
+    exit 1
+fi
+echo ""
 echo "Scanning current directory with both SHA256 and SHA512..."
 echo ""
 